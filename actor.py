@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from concurrent.futures import ThreadPoolExecutor
+
+import collections
+import logging
+import threading
+
+# A busy chat gives its worker back after this many messages so quieter chats aren't starved.
+MAX_BATCH = 16
+
+
+class ChatActors:
+    """
+    One mailbox per key (a chat), drained by a shared pool of workers. At
+    most one worker runs a given key's messages at a time and always in the
+    order they were told, while different keys run in parallel. Whatever a
+    key's messages touch, such as that chat's game, has a single writer.
+    """
+
+    def __init__(self, max_workers, name="actors"):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self.lock = threading.Lock()
+        # Only keys with messages queued or running have a mailbox.
+        self.mailboxes = {}
+        self.queued = 0
+
+    def tell(self, key, fn, *args, **kwargs):
+        """
+        Queues fn(*args, **kwargs) to run on the actor for key after everything already queued there.
+        """
+        with self.lock:
+            self.queued += 1
+            mailbox = self.mailboxes.get(key)
+            if mailbox is not None:
+                mailbox.append((fn, args, kwargs))
+                return
+            self.mailboxes[key] = collections.deque([(fn, args, kwargs)])
+        self.executor.submit(self.drain, key)
+
+    def drain(self, key):
+        for i in range(MAX_BATCH):
+            with self.lock:
+                mailbox = self.mailboxes[key]
+                if not mailbox:
+                    del self.mailboxes[key]
+                    return
+                fn, args, kwargs = mailbox.popleft()
+                self.queued -= 1
+
+            try:
+                fn(*args, **kwargs)
+            except Exception:
+                logging.getLogger(__name__).exception("Message for %s failed", key)
+
+        # Still busy; go to the back of the pool's queue. The mailbox stays, so tell keeps appending to it.
+        self.executor.submit(self.drain, key)
+
+    def get_queued(self):
+        return self.queued
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import fake_bot_api
+import loadtest
+
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+# Compares the threaded, asyncio and sharded modes on the same stream of updates: each mode
+# runs as the real bot, against a fake Bot API that takes a fixed time to answer, while
+# loadtest's players post updates to its webhook and time how long each takes to answer.
+# Sends aren't paced to Telegram's rate limits here, so what differs is how each mode
+# dispatches updates and makes its calls.
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+MODES = {"threaded": ["telegram_interaction.py"], "async": ["async_mode.py"], "sharded": ["sharding.py"]}
+START_TIMEOUT = 30
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def is_listening(port):
+    try:
+        socket.create_connection(("127.0.0.1", port), 1).close()
+        return True
+    except OSError:
+        return False
+
+
+async def run_mode(command, args):
+    """
+    Starts the bot with command, plays args.games games in each of args.chats chats against it and
+    returns the LoadTest and how long it took.
+    """
+    api = fake_bot_api.FakeBotAPI(args.latency)
+    api_url = await fake_bot_api.serve(api)
+    port = get_free_port()
+    directory = tempfile.mkdtemp(prefix="uno-benchmark-")
+    env = dict(os.environ, BOT_API_URL=api_url, WEBHOOK_URL="http://127.0.0.1:%d/" % port, PORT=str(port),
+               STATE_DIR=os.path.join(directory, "state"), MOVE_LOG_DIR=os.path.join(directory, "games"),
+               PACE_OUTBOUND="0")
+    process = subprocess.Popen([sys.executable] + command, cwd=ROOT, env=env)
+    try:
+        started = time.perf_counter()
+        # The threaded mode sets its webhook while its server may still be starting.
+        while not (api.webhook is not None and is_listening(port)):
+            if process.poll() is not None or time.perf_counter() - started > START_TIMEOUT:
+                raise RuntimeError("The bot didn't start: %s" % " ".join(command))
+            await asyncio.sleep(0.1)
+
+        test = loadtest.LoadTest(api.webhook, args.settle, args.reply_timeout, args.max_moves, 0)
+        api.listeners.append(test.on_call)
+        elapsed = await test.run(args.chats, args.games, args.players, 0, 0)
+        return test, elapsed
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def report(name, test, elapsed):
+    updates = len(test.latencies) + test.unanswered
+    print("%s: %d games, %d updates in %.1fs -> %.1f updates/sec" %
+          (name, test.games, updates, elapsed, updates / elapsed))
+    print("    update to reply: p50 %.1fms, p99 %.1fms, max %.1fms, %d unanswered" %
+          (loadtest.percentile(test.latencies, 0.5) * 1000, loadtest.percentile(test.latencies, 0.99) * 1000,
+           max(test.latencies or [0]) * 1000, test.unanswered))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the bot's modes on the same updates against a slow Bot API.")
+    parser.add_argument("--mode", choices=sorted(MODES) + ["all"], default="all")
+    parser.add_argument("--workers", type=int, default=2, help="worker processes in the sharded mode")
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--games", type=int, default=1)
+    parser.add_argument("--players", type=int, default=4)
+    parser.add_argument("--max-moves", type=int, default=1000)
+    parser.add_argument("--settle", type=float, default=0.05)
+    parser.add_argument("--reply-timeout", type=float, default=10)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds the fake Bot API takes per call")
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    for mode in sorted(MODES) if args.mode == "all" else [args.mode]:
+        command = MODES[mode] + (["--workers", str(args.workers)] if mode == "sharded" else [])
+        test, elapsed = loop.run_until_complete(run_mode(command, args))
+        report(mode, test, elapsed)
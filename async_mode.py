@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import telegram_interaction
+
+import telegram
+from telegram.error import TelegramError, Unauthorized, BadRequest, RetryAfter, NetworkError, TimedOut
+from fanout import Batch
+import log_writer
+import ingestion
+import metrics
+
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import os
+import ssl
+import threading
+import time
+from urllib.parse import urlsplit
+
+# The same bot can run this way instead of on python-telegram-bot's threaded Updater:
+# updates are handled one after another on an event loop, and every Bot API call the
+# handlers make becomes a task on that loop, so a handler never waits on the network.
+
+API_URL = "https://api.telegram.org/bot"
+MAX_CONNECTIONS = 64
+REQUEST_TIMEOUT = 10
+POLL_TIMEOUT = 30
+
+
+class APIResult(dict):
+    # Lets handlers read fields of a returned message the way they would on a telegram.Message.
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def encode_params(params):
+    encoded = {}
+    for key, value in params.items():
+        if value is None:
+            continue
+        encoded[key] = value.to_dict() if hasattr(value, "to_dict") else value
+    return encoded
+
+
+def raise_for_response(status, response):
+    description = response.get("description", "HTTP %d" % status)
+    if status == 403:
+        raise Unauthorized(description)
+    if status == 400:
+        raise BadRequest(description)
+    if status == 429:
+        raise RetryAfter(response.get("parameters", {}).get("retry_after", 1))
+    raise NetworkError(description)
+
+
+class BotAPIClient:
+    """
+    A small Bot API client on asyncio streams. Requests share a pool of
+    keep-alive connections, at most max_connections of them open at once;
+    any further requests wait for a free connection instead of a thread.
+    """
+
+    def __init__(self, token, api_url=API_URL, max_connections=MAX_CONNECTIONS):
+        url = urlsplit(api_url + token)
+        self.secure = url.scheme == "https"
+        self.host = url.hostname
+        self.port = url.port or (443 if self.secure else 80)
+        self.path = url.path.rstrip("/")
+        self.max_connections = max_connections
+        self.idle = []
+        self.slots = None
+
+    async def call(self, method, request_timeout=REQUEST_TIMEOUT, **params):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_connections)
+        body = json.dumps(encode_params(params)).encode("utf-8")
+        start = time.perf_counter()
+        try:
+            async with self.slots:
+                try:
+                    status, data = await asyncio.wait_for(self.request(method, body), request_timeout)
+                except asyncio.TimeoutError:
+                    raise TimedOut()
+
+            try:
+                response = json.loads(data.decode("utf-8"))
+            except ValueError:
+                raise NetworkError("Bot API answered %d with a body that isn't JSON" % status)
+            if not response.get("ok"):
+                raise_for_response(status, response)
+        except Exception as e:
+            metrics.observe_api_call(method, start, e)
+            raise
+        metrics.observe_api_call(method, start)
+        result = response.get("result")
+        return APIResult(result) if isinstance(result, dict) else result
+
+    async def request(self, method, body):
+        request = ("POST %s/%s HTTP/1.1\r\nHost: %s\r\nContent-Type: application/json\r\n"
+                   "Content-Length: %d\r\nConnection: keep-alive\r\n\r\n" %
+                   (self.path, method, self.host, len(body))).encode("latin-1") + body
+
+        # A pooled connection may have been closed by the server while idle; retry once on a new one.
+        for attempt in range(2):
+            reused = len(self.idle) > 0
+            reader, writer = self.idle.pop() if reused else await self.connect()
+            try:
+                writer.write(request)
+                await writer.drain()
+                status, headers, data = await self.read_response(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused and attempt == 0:
+                    continue
+                raise NetworkError("Connection to the Bot API was lost")
+            except BaseException:
+                writer.close()
+                raise
+
+            if headers.get("connection", "").lower() == "close":
+                writer.close()
+            else:
+                self.idle.append((reader, writer))
+            return status, data
+
+    async def connect(self):
+        context = ssl.create_default_context() if self.secure else None
+        return await asyncio.open_connection(self.host, self.port, ssl=context)
+
+    async def read_response(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError()
+        status = int(status_line.split()[1])
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            return status, headers, b"".join(chunks)
+        return status, headers, await reader.readexactly(int(headers.get("content-length", 0)))
+
+    def close(self):
+        for reader, writer in self.idle:
+            writer.close()
+        self.idle = []
+
+
+class AsyncBot:
+    """
+    What the handlers see as the bot in this mode. Calls return at once
+    and run as tasks on the loop, from the loop thread or any other;
+    failures are logged the way the threaded dispatcher's error handler
+    would log them.
+    """
+
+    def __init__(self, client, loop):
+        self.client = client
+        self.loop = loop
+        self.thread = None
+
+    def call(self, method, **params):
+        return self.client.call(method, **params)
+
+    def schedule(self, coro, log=True):
+        if threading.current_thread() is self.thread:
+            future = self.loop.create_task(coro)
+        else:
+            future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        if log:
+            future.add_done_callback(log_failure)
+        return future
+
+    def call_soon(self, fn, *args):
+        """
+        Runs fn(*args) on the loop thread, where every handler runs.
+        """
+        self.loop.call_soon_threadsafe(fn, *args)
+
+    def send_message(self, chat_id, text, reply_markup=None, parse_mode=None, **kwargs):
+        self.schedule(self.call("sendMessage", chat_id=chat_id, text=text, reply_markup=reply_markup,
+                                parse_mode=parse_mode, **kwargs))
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, reply_markup=None, **kwargs):
+        self.schedule(self.call("editMessageText", chat_id=chat_id, message_id=message_id, text=text,
+                                reply_markup=reply_markup, **kwargs))
+
+    def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        self.schedule(self.call("answerCallbackQuery", callback_query_id=callback_query_id, text=text, **kwargs))
+
+    def fan_out(self, fn, jobs, on_done=None):
+        """
+        Runs the coroutine fn(*args) for every (key, args) pair in jobs on the loop.
+        """
+        jobs = list(jobs)
+        batch = Batch(len(jobs), on_done)
+        for key, args in jobs:
+            future = self.schedule(fn(*args), log=False)
+            future.add_done_callback(lambda f, key=key: batch.finish(key, f))
+        return batch
+
+
+def log_failure(future):
+    if future.cancelled() or future.exception() is None:
+        return
+    error = future.exception()
+    if isinstance(error, TelegramError):
+        logging.getLogger(__name__).warning("Telegram Error! %s", error)
+    else:
+        logging.getLogger(__name__).error("Bot API call failed", exc_info=error)
+
+
+class AsyncDispatcher:
+    """
+    Routes updates to the handlers in telegram_interaction's commands table,
+    passing them the same arguments python-telegram-bot's CommandHandler and
+    CallbackQueryHandler would.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.chat_data = collections.defaultdict(dict)
+        # Updates received but not yet handled.
+        self.queued = 0
+        self.commands = {}
+        for c in telegram_interaction.STATIC_COMMANDS:
+            self.commands[c] = (telegram_interaction.static_handler(c).callback, None)
+        for c in telegram_interaction.commands:
+            func = metrics.timed(c[0], telegram_interaction.coalesced(getattr(telegram_interaction, c[0] + "_handler")))
+            for alias in c[2]:
+                self.commands[alias] = (func, c[1])
+        self.button_handler = metrics.timed("button", telegram_interaction.coalesced(telegram_interaction.button_handler))
+
+    def enqueue(self, data):
+        self.queued += 1
+        asyncio.get_event_loop().call_soon(self.process_queued, data)
+
+    def process_queued(self, data):
+        self.queued -= 1
+        self.process_update(data)
+
+    def process_update(self, data):
+        update = telegram.Update.de_json(data, self.bot)
+        try:
+            self.dispatch(update)
+        except TelegramError as e:
+            telegram_interaction.handle_error(self.bot, update, e)
+        except Exception:
+            logging.getLogger(__name__).exception("Handler failed on update %s", data.get("update_id"))
+
+    def dispatch(self, update):
+        if update.callback_query is not None:
+            self.button_handler(self.bot, update, self.chat_data[update.effective_chat.id])
+            return
+
+        message = update.message
+        if message is None or not message.text or not message.text.startswith("/"):
+            return
+
+        words = message.text.split()
+        command = words[0][1:].split("@")[0].lower()
+        if command not in self.commands:
+            return
+
+        func, kind = self.commands[command]
+        args = words[1:]
+        chat_data = self.chat_data[message.chat_id]
+        if kind is None:
+            func(self.bot, update)
+        elif kind == 0:
+            func(self.bot, update, args)
+        elif kind == 1:
+            func(self.bot, update, chat_data)
+        elif kind == 2:
+            func(self.bot, update, chat_data, args)
+
+
+class WebhookProtocol(asyncio.Protocol):
+    """
+    Accepts Telegram's webhook POSTs on url_path, answers each one straight
+    away and hands the update to the dispatcher on the next loop iteration.
+    If there is an admission, an ingestion.Ingestion, it decides first
+    whether the update goes on or is dropped. GET /metrics returns the
+    metrics.
+    """
+
+    def __init__(self, dispatcher, url_path, admission=None):
+        self.dispatcher = dispatcher
+        self.url_path = url_path
+        self.admission = admission
+        self.buffer = b""
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        while True:
+            head, sep, rest = self.buffer.partition(b"\r\n\r\n")
+            if not sep:
+                return
+            lines = head.decode("latin-1").split("\r\n")
+            method, path = lines[0].split()[:2]
+            length = 0
+            for line in lines[1:]:
+                name, _, value = line.partition(":")
+                if name.strip().lower() == "content-length":
+                    length = int(value.strip())
+            if len(rest) < length:
+                return
+            body, self.buffer = rest[:length], rest[length:]
+            self.handle(method, path, body)
+
+    def handle(self, method, path, body):
+        if method == "GET" and path == "/metrics":
+            self.respond(b"200 OK", metrics.registry.render().encode("utf-8"), metrics.CONTENT_TYPE)
+            return
+        if method != "POST" or path != self.url_path:
+            self.respond(b"404 Not Found")
+            return
+        try:
+            data = json.loads(body.decode("utf-8"))
+        except ValueError:
+            self.respond(b"400 Bad Request")
+            return
+
+        if self.admission is not None and "update_id" in data:
+            message = data.get("message") or {}
+            outcome = self.admission.admit(data["update_id"], message.get("text"), "callback_query" in data)
+            if outcome != ingestion.ACCEPTED:
+                self.respond(b"200 OK")
+                return
+        self.respond(b"200 OK")
+        self.dispatcher.enqueue(data)
+
+    def respond(self, status, body=b"", content_type=None):
+        headers = b"HTTP/1.1 " + status + b"\r\nContent-Length: " + str(len(body)).encode("ascii") + b"\r\n"
+        if content_type is not None:
+            headers += b"Content-Type: " + content_type.encode("ascii") + b"\r\n"
+        self.transport.write(headers + b"\r\n" + body)
+
+
+async def poll(client, dispatcher):
+    offset = 0
+    while True:
+        try:
+            updates = await client.call("getUpdates", request_timeout=POLL_TIMEOUT + REQUEST_TIMEOUT,
+                                        offset=offset, timeout=POLL_TIMEOUT)
+        except TelegramError as e:
+            logging.getLogger(__name__).warning("getUpdates failed: %s", e)
+            await asyncio.sleep(1)
+            continue
+        for data in updates:
+            offset = max(offset, data["update_id"] + 1)
+            dispatcher.process_update(data)
+
+
+def start(loop, token, api_url=API_URL, max_connections=MAX_CONNECTIONS):
+    client = BotAPIClient(token, api_url, max_connections)
+    bot = AsyncBot(client, loop)
+    bot.thread = threading.current_thread()
+    return client, bot, AsyncDispatcher(bot)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the Uno bot on an asyncio event loop.")
+    parser.add_argument("--polling", action="store_true", help="use getUpdates instead of a webhook")
+    parser.add_argument("--api-url", default=telegram_interaction.BOT_API_URL)
+    args = parser.parse_args()
+
+    log_writer.setup_logging('logging.txt')
+
+    loop = asyncio.get_event_loop()
+    client, bot, dispatcher = start(loop, telegram_interaction.TOKEN, args.api_url)
+    telegram_interaction.register_metrics(dispatcher.chat_data, lambda: dispatcher.queued)
+    telegram_interaction.enable_persistence(bot, lambda chat_id: dispatcher.chat_data[chat_id],
+                                            lambda chat_id, fn, *args: bot.call_soon(fn, *args))
+    telegram_interaction.move_log = telegram_interaction.MoveLog(telegram_interaction.MOVE_LOG_DIR)
+    if os.environ.get('PROFILE'):
+        telegram_interaction.profiler.start()
+
+    if args.polling:
+        loop.run_until_complete(client.call("deleteWebhook"))
+        loop.create_task(poll(client, dispatcher))
+    else:
+        admission = ingestion.Ingestion(lambda: dispatcher.queued, telegram_interaction.INGEST_CAPACITY,
+                                        telegram_interaction.INGEST_POLICY, telegram_interaction.SHEDDABLE_COMMANDS)
+        loop.run_until_complete(loop.create_server(
+            lambda: WebhookProtocol(dispatcher, "/" + telegram_interaction.TOKEN, admission), "0.0.0.0",
+            telegram_interaction.PORT))
+        loop.run_until_complete(client.call("setWebhook", url=telegram_interaction.WEBHOOK_URL +
+                                            telegram_interaction.TOKEN))
+    loop.run_forever()
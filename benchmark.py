@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import uno
+import moves
+
+import argparse
+import random
+import time
+import tracemalloc
+
+# A game that hasn't finished after this many actions is abandoned.
+MAX_ACTIONS = 5000
+
+
+def take_action(game, rng):
+    """
+    Makes one random but legal action for whoever the game is waiting on.
+    """
+    if game.is_wild_pending():
+        return moves.wild(game, game.waiting_for_wild_id, rng.choice(uno.COLORS))
+
+    if game.is_advanced_rules() and game.is_seven_pending():
+        seat = game.get_player(game.waiting_for_seven_id).get_id()
+        other = rng.randrange(len(game.seat_ids) - 1)
+        return moves.seven(game, game.waiting_for_seven_id, other + 1 if other >= seat else other)
+
+    if game.is_uno_pending():
+        return moves.call_uno(game, rng.choice(game.seat_ids))
+
+    user_id = game.get_player_id_by_num(game.turn)
+    player = game.get_player(user_id)
+    if player.has_playable_card(game.get_topmost_card()):
+        playable = [i for i, c in enumerate(player.get_hand()) if game.deck.check_valid_play(c)]
+        return moves.play(game, user_id, rng.choice(playable))
+    return moves.draw(game, user_id)
+
+
+def new_game(seed, num_players, advanced):
+    game = uno.Game(seed, dict((i, "Player %d" % i) for i in range(num_players)), seed=seed)
+    game.set_advanced_rules(advanced)
+    game.set_ready_to_play(True)
+    game.play_initial_card()
+    game.drain_events()
+    return game
+
+
+def play_game(seed, num_players, advanced, trace=False):
+    """
+    Plays one game to the end and returns the number of actions taken, and
+    when tracing, the peak and retained bytes allocated over those actions.
+    """
+    game = new_game(seed, num_players, advanced)
+    rng = random.Random("driver-%d" % seed)
+    actions = 0
+    peak = 0
+    retained = 0
+    while actions < MAX_ACTIONS and game.check_for_win() is None:
+        if trace:
+            tracemalloc.clear_traces()
+        take_action(game, rng)
+        game.drain_events()
+        if trace:
+            current, action_peak = tracemalloc.get_traced_memory()
+            peak += action_peak
+            retained += current
+        actions += 1
+    return actions, peak, retained
+
+
+def run(games, num_players, advanced, seed, alloc_games):
+    start = time.perf_counter()
+    turns = 0
+    for i in range(games):
+        turns += play_game(seed + i, num_players, advanced)[0]
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    traced_turns = 0
+    peak = 0
+    retained = 0
+    for i in range(alloc_games):
+        result = play_game(seed + i, num_players, advanced, trace=True)
+        traced_turns += result[0]
+        peak += result[1]
+        retained += result[2]
+    tracemalloc.stop()
+
+    print("%s: %d games, %d turns in %.2fs -> %.0f turns/sec; %.0f B/turn allocated at peak, %.0f B/turn retained" %
+          ("advanced" if advanced else "basic", games, turns, elapsed, turns / elapsed,
+           peak / max(traced_turns, 1), retained / max(traced_turns, 1)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plays random Uno games without Telegram and reports their cost.")
+    parser.add_argument("--games", type=int, default=2000)
+    parser.add_argument("--players", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--alloc-games", type=int, default=50,
+                        help="how many of the games to replay under tracemalloc for the allocation figures")
+    parser.add_argument("--mode", choices=["basic", "advanced", "both"], default="both")
+    args = parser.parse_args()
+
+    if args.mode in ("basic", "both"):
+        run(args.games, args.players, False, args.seed, args.alloc_games)
+    if args.mode in ("advanced", "both"):
+        run(args.games, args.players, True, args.seed, args.alloc_games)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+# A hand button's callback data is "#<chat id>.<game id>.<hand version>.<slot>", each in base
+# 36. The chat id says where the tap goes, even before it reaches the process that runs the
+# game (see sharding.py). The game id is the game's seed, so it survives restarts, and the
+# version is the one the hand had when it was sent, so a button from an older hand can't play
+# whatever card has since moved into its slot. Telegram allows 64 bytes; this takes about 30.
+PREFIX = "#"
+DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def to_base36(n):
+    if n < 0:
+        return "-" + to_base36(-n)
+    digits = []
+    while True:
+        n, digit = divmod(n, 36)
+        digits.append(DIGITS[digit])
+        if n == 0:
+            return "".join(reversed(digits))
+
+
+def encode(chat_id, game_id, version, slot):
+    return PREFIX + ".".join(to_base36(n) for n in (chat_id, game_id, version, slot))
+
+
+def decode(data):
+    """
+    Returns (chat id, game id, hand version, slot) for a hand button's callback data, or None if it
+    isn't one.
+    """
+    if not data or not data.startswith(PREFIX):
+        return None
+    parts = data[len(PREFIX):].split(".")
+    if len(parts) != 4:
+        return None
+    # int() would also take signs, spaces, underscores and other scripts' digits. Only the chat id
+    # can be negative.
+    sign = -1 if parts[0].startswith("-") else 1
+    if sign < 0:
+        parts[0] = parts[0][1:]
+    if not all(part and all(c in DIGITS for c in part) for part in parts):
+        return None
+    chat_id, game_id, version, slot = (int(part, 36) for part in parts)
+    return sign * chat_id, game_id, version, slot
+
+
+class GameRoutes:
+    """
+    Which chat each running game belongs to, by game id. Hand buttons are
+    tapped in the player's private chat, so this is how a tap finds its
+    game. A game is only found while it is still its chat's game.
+    """
+
+    def __init__(self):
+        self.routes = {}
+
+    def add(self, game, chat_id, chat_data):
+        self.routes[game.seed] = (chat_id, chat_data, game)
+
+    def remove(self, game):
+        route = self.routes.get(game.seed)
+        if route is not None and route[2] is game:
+            del self.routes[game.seed]
+
+    def get(self, game_id):
+        """
+        Returns (chat_id, chat_data, game) for the game, or None if it has ended.
+        """
+        route = self.routes.get(game_id)
+        if route is None or route[1].get("game_obj") is not route[2]:
+            return None
+        return route
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+# Reasons an InvalidPlay can carry. Those ending in _WAITING name the player being waited on.
+NOT_BOOLEAN = "not_boolean"
+INITIAL_CARD_PLAYED = "initial_card_played"
+NOT_YOUR_TURN = "not_your_turn"
+UNKNOWN_PLAYER = "unknown_player"
+UNKNOWN_TARGET = "unknown_target"
+NOT_IN_GAME = "not_in_game"
+NO_SEVEN = "no_seven"
+SEVEN_WAITING = "seven_waiting"
+SELF_SWAP = "self_swap"
+PLAY_SEVEN_WAITING = "play_seven_waiting"
+PLAY_WILD_WAITING = "play_wild_waiting"
+PLAY_UNO_PENDING = "play_uno_pending"
+PLAY_SEVEN_PENDING = "play_seven_pending"
+NO_SUCH_CARD = "no_such_card"
+INVALID_CARD = "invalid_card"
+DRAW_WILD_WAITING = "draw_wild_waiting"
+DRAW_UNO_PENDING = "draw_uno_pending"
+DRAW_SEVEN_PENDING = "draw_seven_pending"
+NO_WILD = "no_wild"
+WILD_WAITING = "wild_waiting"
+INVALID_COLOR = "invalid_color"
+
+
+class Event(object):
+    """
+    Something a Game wants the players to know about. Games only record
+    events; the bot turns them into messages once the move is done.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, *args):
+        for name, value in zip(self.__slots__, args):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, ", ".join(repr(getattr(self, name)) for name in self.__slots__))
+
+
+class PlayerAdded(Event):
+    __slots__ = ("name",)
+
+
+class GameSetUp(Event):
+    __slots__ = ()
+
+
+class InvalidPlay(Event):
+    __slots__ = ("reason", "name")
+
+    def __init__(self, reason, name=""):
+        Event.__init__(self, reason, name)
+
+
+class HandsRotated(Event):
+    __slots__ = ()
+
+
+class SevenPending(Event):
+    __slots__ = ()
+
+
+class WildPending(Event):
+    __slots__ = ()
+
+
+class DirectionReversed(Event):
+    __slots__ = ()
+
+
+class PlayerSkipped(Event):
+    __slots__ = ()
+
+
+class UnoCalled(Event):
+    # in_time is False when someone else pressed the button first and the player drew a card.
+    __slots__ = ("name", "in_time")
+
+
+class StackMissed(Event):
+    # The player whose turn it was didn't stack on the pending draw card.
+    __slots__ = ("name", "value")
+
+
+class CannotStack(Event):
+    # The next player has no card to stack on the pending draw card.
+    __slots__ = ("name", "value")
+
+
+class ForcedDraw(Event):
+    __slots__ = ("name", "count")
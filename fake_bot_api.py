@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import random
+import threading
+import time
+from urllib.parse import parse_qsl
+
+# A local stand-in for the Telegram Bot API, for load tests and benchmarks. Run the bot
+# against it with BOT_API_URL=http://127.0.0.1:<port>/bot.
+
+ME = {"id": 1, "is_bot": True, "first_name": "Uno", "username": "uno_bot"}
+
+
+class FakeBotAPI:
+    """
+    Answers Bot API methods the way Telegram would, remembering the messages
+    it has "sent" so that edits fail like the real ones do. Each call is
+    answered latency seconds (plus up to jitter more) after it arrives;
+    rate_limit and errors are the fractions of calls answered with a 429 or
+    a 500 instead. Every accepted call is passed to each of listeners as
+    fn(method, params) when it arrives.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, rate_limit=0.0, errors=0.0, retry_after=1, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.errors = errors
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.message_ids = itertools.count(1)
+        # (chat_id, message_id) -> (text, reply_markup)
+        self.messages = {}
+        self.webhook = None
+        self.calls = collections.Counter()
+        self.failures = collections.Counter()
+        self.listeners = []
+
+    def get_delay(self):
+        return self.latency + (self.random.random() * self.jitter if self.jitter else 0)
+
+    def answer(self, method, params):
+        """
+        Returns the HTTP status and the response body for one call.
+        """
+        self.calls[method] += 1
+        roll = self.random.random()
+        if roll < self.rate_limit:
+            self.failures[429] += 1
+            return 429, {"ok": False, "error_code": 429,
+                         "description": "Too Many Requests: retry after %d" % self.retry_after,
+                         "parameters": {"retry_after": self.retry_after}}
+        if roll < self.rate_limit + self.errors:
+            self.failures[500] += 1
+            return 500, {"ok": False, "error_code": 500, "description": "Internal Server Error"}
+
+        for listener in self.listeners:
+            listener(method, params)
+
+        if method == "sendMessage":
+            message_id = next(self.message_ids)
+            self.messages[(params["chat_id"], message_id)] = (params.get("text"), params.get("reply_markup"))
+            return 200, {"ok": True, "result": self.get_message(params["chat_id"], message_id, params.get("text"))}
+        if method == "editMessageText":
+            key = (params.get("chat_id"), params.get("message_id"))
+            if key not in self.messages:
+                return 400, {"ok": False, "error_code": 400, "description": "Bad Request: message to edit not found"}
+            content = (params.get("text"), params.get("reply_markup"))
+            if self.messages[key] == content:
+                return 400, {"ok": False, "error_code": 400, "description": "Bad Request: message is not modified"}
+            self.messages[key] = content
+            return 200, {"ok": True, "result": self.get_message(key[0], key[1], params.get("text"))}
+        if method == "setWebhook":
+            self.webhook = params.get("url") or None
+        elif method == "deleteWebhook":
+            self.webhook = None
+        elif method == "getMe":
+            return 200, {"ok": True, "result": ME}
+        elif method == "getUpdates":
+            return 200, {"ok": True, "result": []}
+        return 200, {"ok": True, "result": True}
+
+    def get_message(self, chat_id, message_id, text):
+        chat_type = "private" if chat_id > 0 else "group"
+        return {"message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": chat_type},
+                "from": ME, "text": text}
+
+
+def parse_params(content_type, body):
+    if content_type.startswith("application/json"):
+        params = json.loads(body.decode("utf-8")) if body else {}
+    else:
+        params = dict(parse_qsl(body.decode("utf-8")))
+    # python-telegram-bot sends markup as a JSON string inside the JSON body.
+    if isinstance(params.get("reply_markup"), str):
+        params["reply_markup"] = json.loads(params["reply_markup"])
+    for key in ("chat_id", "message_id"):
+        if isinstance(params.get(key), str) and params[key].lstrip("-").isdigit():
+            params[key] = int(params[key])
+    return params
+
+
+class APIProtocol(asyncio.Protocol):
+    def __init__(self, api):
+        self.api = api
+        self.buffer = b""
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        while True:
+            head, sep, rest = self.buffer.partition(b"\r\n\r\n")
+            if not sep:
+                return
+            lines = head.decode("latin-1").split("\r\n")
+            path = lines[0].split()[1]
+            headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+            if len(rest) < length:
+                return
+            body, self.buffer = rest[:length], rest[length:]
+
+            method = path.split("?")[0].rsplit("/", 1)[-1]
+            try:
+                status, response = self.api.answer(method, parse_params(headers.get("content-type", ""), body))
+            except (ValueError, KeyError) as e:
+                status, response = 400, {"ok": False, "error_code": 400, "description": "Bad Request: %s" % e}
+            asyncio.get_event_loop().call_later(self.api.get_delay(), self.respond, status, response)
+
+    def respond(self, status, response):
+        body = json.dumps(response).encode("utf-8")
+        if not self.transport.is_closing():
+            self.transport.write(b"HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n" %
+                                 (status, b"OK" if status == 200 else b"Error", len(body)) + body)
+
+
+async def serve(api, host="127.0.0.1", port=0):
+    """
+    Serves api on the running loop and returns the base URL to give the bot.
+    """
+    server = await asyncio.get_event_loop().create_server(lambda: APIProtocol(api), host, port)
+    return "http://%s:%d/bot" % (host, server.sockets[0].getsockname()[1])
+
+
+def start_in_thread(api, host="127.0.0.1", port=0):
+    loop = asyncio.new_event_loop()
+    url = loop.run_until_complete(serve(api, host, port))
+    threading.Thread(target=loop.run_forever, name="fake-bot-api", daemon=True).start()
+    return url
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves a fake Telegram Bot API.")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds taken to answer each call")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many more seconds per call")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="fraction of calls answered with a 429")
+    parser.add_argument("--errors", type=float, default=0.0, help="fraction of calls answered with a 500")
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args()
+
+    api = FakeBotAPI(args.latency, args.jitter, args.rate_limit, args.errors, args.retry_after)
+    loop = asyncio.get_event_loop()
+    print("Serving the Bot API at %s" % loop.run_until_complete(serve(api, port=args.port)))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        print("Calls: %s, failures injected: %s" % (dict(api.calls), dict(api.failures)))
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from concurrent.futures import ThreadPoolExecutor
+
+import functools
+import threading
+
+
+class Batch:
+    """
+    Tracks one group of jobs handed to a FanOut. Failures are collected by
+    recipient so one blocked user doesn't stop delivery to the others.
+    """
+
+    def __init__(self, size, on_done):
+        self.remaining = size
+        self.failures = {}
+        self.on_done = on_done
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        if size == 0:
+            self.complete()
+
+    def finish(self, key, future):
+        error = future.exception()
+        with self.lock:
+            if error is not None:
+                self.failures[key] = error
+            self.remaining -= 1
+            done = self.remaining == 0
+        if done:
+            self.complete()
+
+    def complete(self):
+        self.finished.set()
+        if self.on_done is not None:
+            self.on_done(self)
+
+    def get_failures(self):
+        return self.failures
+
+    def wait(self, timeout=None):
+        return self.finished.wait(timeout)
+
+
+class FanOut:
+    def __init__(self, max_workers, name="fanout"):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+
+    def submit(self, fn, jobs, on_done=None):
+        """
+        Runs fn(*args) for every (key, args) pair in jobs on the pool and
+        returns right away. on_done is called with the Batch once every job
+        has finished, successfully or not.
+        """
+        jobs = list(jobs)
+        batch = Batch(len(jobs), on_done)
+        for key, args in jobs:
+            future = self.executor.submit(fn, *args)
+            future.add_done_callback(functools.partial(batch.finish, key))
+        return batch
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from telegram.error import BadRequest
+
+import asyncio
+import itertools
+import threading
+
+
+class HandMessages:
+    """
+    Remembers the last hand message sent to each player of each game, along
+    with the hand version and text it showed. Delivering a hand is then a
+    no-op if nothing changed, an edit of that message if something did, and
+    a new message only when there is nothing left to edit.
+
+    Hands for a player can be delivered on different threads, so each one
+    carries the sequence number it was rendered with, and a hand older than
+    the one last shown is dropped. A chat's records are kept from when its
+    hands are first sent until forget_chat, and hands still on their way
+    after that are dropped too.
+    """
+
+    def __init__(self):
+        # chat_id -> user_id -> (message_id, version, text, sequence)
+        self.records = {}
+        self.locks = {}
+        self.async_locks = {}
+        self.sequence = itertools.count()
+
+    def open_chat(self, chat_id):
+        """
+        Returns the sequence number for hands rendered now, keeping records for the chat from here on.
+        """
+        self.records.setdefault(chat_id, {})
+        return next(self.sequence)
+
+    def get_lock(self, locks, chat_id, user_id, factory):
+        return locks.setdefault(chat_id, {}).setdefault(user_id, factory())
+
+    def is_stale(self, records, user_id, version, text, sequence):
+        record = records.get(user_id) if records is not None else None
+        return records is None or (record is not None and
+                                   (record[3] > sequence or (record[1] == version and record[2] == text)))
+
+    def deliver(self, bot, chat_id, user_id, version, text, markup, sequence):
+        if chat_id not in self.records:
+            return
+        with self.get_lock(self.locks, chat_id, user_id, threading.Lock):
+            records = self.records.get(chat_id)
+            if self.is_stale(records, user_id, version, text, sequence):
+                return
+
+            record = records.get(user_id)
+            if record is not None and record[0] is not None:
+                try:
+                    bot.edit_message_text(chat_id=user_id, message_id=record[0], text=text, reply_markup=markup)
+                    records[user_id] = (record[0], version, text, sequence)
+                    return
+                except BadRequest as e:
+                    if "not modified" in str(e):
+                        records[user_id] = (record[0], version, text, sequence)
+                        return
+                    # The old message was deleted or can't be edited anymore; send a fresh one.
+
+            message = bot.send_message(chat_id=user_id, text=text, reply_markup=markup)
+            records[user_id] = (message.message_id, version, text, sequence)
+
+    async def deliver_async(self, bot, chat_id, user_id, version, text, markup, sequence):
+        """
+        The same as deliver, for a bot whose call coroutine speaks the Bot API directly.
+        """
+        if chat_id not in self.records:
+            return
+        async with self.get_lock(self.async_locks, chat_id, user_id, asyncio.Lock):
+            records = self.records.get(chat_id)
+            if self.is_stale(records, user_id, version, text, sequence):
+                return
+
+            record = records.get(user_id)
+            if record is not None and record[0] is not None:
+                try:
+                    await bot.call("editMessageText", chat_id=user_id, message_id=record[0], text=text,
+                                   reply_markup=markup)
+                    records[user_id] = (record[0], version, text, sequence)
+                    return
+                except BadRequest as e:
+                    if "not modified" in str(e):
+                        records[user_id] = (record[0], version, text, sequence)
+                        return
+
+            message = await bot.call("sendMessage", chat_id=user_id, text=text, reply_markup=markup)
+            records[user_id] = (message["message_id"], version, text, sequence)
+
+    def forget(self, chat_id, user_id):
+        """
+        Makes the next hand delivered to the player a new message.
+        """
+        records = self.records.get(chat_id, {})
+        record = records.get(user_id)
+        if record is not None:
+            # Hands older than the last one shown still mustn't be delivered.
+            records[user_id] = (None, None, None, record[3])
+
+    def forget_chat(self, chat_id):
+        self.records.pop(chat_id, None)
+        self.locks.pop(chat_id, None)
+        self.async_locks.pop(chat_id, None)
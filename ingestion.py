@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import metrics
+
+import collections
+import logging
+import queue
+import threading
+
+CAPACITY = 1000
+RECENT_IDS = 10000
+
+# What happens to an update that arrives while the bot is full. Under REJECT it is dropped.
+# Under SHED only the ones nothing depends on (commands that only answer with text, and
+# messages that aren't commands at all) are dropped, and moves in games still go on. Either
+# way a dropped update is acknowledged like any other: refusing it would only have Telegram
+# deliver it again, and again, while the bot is least able to take it.
+REJECT = "reject"
+SHED = "shed"
+
+ACCEPTED = "accepted"
+DUPLICATE = "duplicate"
+SHEDDED = "shed"
+REJECTED = "rejected"
+
+
+class RecentIds:
+    """
+    The last size ids added, for membership tests.
+    """
+
+    def __init__(self, size=RECENT_IDS):
+        self.ids = set()
+        self.order = collections.deque()
+        self.size = size
+
+    def __contains__(self, id):
+        return id in self.ids
+
+    def add(self, id):
+        self.ids.add(id)
+        self.order.append(id)
+        if len(self.order) > self.size:
+            self.ids.discard(self.order.popleft())
+
+
+def get_command(text):
+    if not text or not text.startswith("/"):
+        return None
+    return text.split()[0][1:].split("@")[0].lower()
+
+
+class Ingestion:
+    """
+    Decides, as each update arrives, whether it goes on to the dispatcher.
+    Telegram delivers an update again when the bot is slow to acknowledge
+    it, so one whose id was seen recently is dropped rather than applied
+    twice. Past capacity updates waiting anywhere, as counted by depth, new
+    ones are dropped according to policy. Dropped updates are logged and
+    counted.
+    """
+
+    def __init__(self, depth, capacity=CAPACITY, policy=SHED, sheddable=(), recent=RECENT_IDS):
+        self.depth = depth
+        self.capacity = capacity
+        self.policy = policy
+        self.sheddable = set(sheddable)
+        self.recent = RecentIds(recent)
+        self.lock = threading.Lock()
+
+    def is_sheddable(self, text, is_callback):
+        if is_callback:
+            return False
+        command = get_command(text)
+        return command is None or command in self.sheddable
+
+    def admit(self, update_id, text=None, is_callback=False):
+        with self.lock:
+            if update_id in self.recent:
+                outcome = DUPLICATE
+            elif self.depth() < self.capacity:
+                outcome = ACCEPTED
+            elif self.policy != SHED:
+                outcome = REJECTED
+            elif self.is_sheddable(text, is_callback):
+                outcome = SHEDDED
+            else:
+                outcome = ACCEPTED
+            self.recent.add(update_id)
+        metrics.updates.inc(outcome)
+        if outcome in (SHEDDED, REJECTED):
+            logging.getLogger(__name__).warning("Dropped update %d (%s) with %d waiting", update_id, outcome,
+                                                self.depth())
+        return outcome
+
+
+class IngestionQueue(queue.Queue):
+    """
+    The dispatcher's update queue, with an Ingestion in front of it. The
+    webhook acknowledges an update once it is put here, whether or not it
+    was let in. backlog returns how many updates have already left the
+    queue but haven't been handled yet.
+    """
+
+    def __init__(self, capacity=CAPACITY, policy=SHED, sheddable=(), backlog=None):
+        queue.Queue.__init__(self)
+        self.ingestion = Ingestion(lambda: self.qsize() + (backlog() if backlog is not None else 0),
+                                   capacity, policy, sheddable)
+
+    def put(self, item, block=True, timeout=None):
+        # The updater also puts things that aren't updates, such as errors and its stop signal.
+        update_id = getattr(item, "update_id", None)
+        if update_id is not None:
+            message = item.message
+            outcome = self.ingestion.admit(update_id, message.text if message is not None else None,
+                                           item.callback_query is not None)
+            if outcome != ACCEPTED:
+                return
+        queue.Queue.put(self, item, block, timeout)
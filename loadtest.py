@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import callbacks
+import fake_bot_api
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from urllib.parse import urlsplit
+
+# Plays full games in many group chats at once against a running bot. The load test serves
+# the fake Bot API itself, so it sees every reply the bot makes and can measure how long
+# each update took to answer. Start it, then start the bot with
+#   BOT_API_URL=http://127.0.0.1:<api port>/bot WEBHOOK_URL=http://127.0.0.1:<bot port>/
+# and the load test posts updates to the webhook the bot sets.
+
+COLORS = "RGBY"
+HAND_TEXT = "Your current hand:\n"
+
+
+class WebhookClient:
+    """
+    Posts updates to the bot's webhook over one keep-alive connection.
+    """
+
+    def __init__(self, url):
+        url = urlsplit(url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.path = url.path
+        self.connection = None
+
+    async def post(self, update):
+        body = json.dumps(update).encode("utf-8")
+        request = ("POST %s HTTP/1.1\r\nHost: %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n" %
+                   (self.path, self.host, len(body))).encode("latin-1") + body
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = await asyncio.open_connection(self.host, self.port)
+            reader, writer = self.connection
+            try:
+                writer.write(request)
+                status = int((await reader.readline()).split()[1])
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    if name.strip().lower() == "content-length":
+                        length = int(value.strip())
+                await reader.readexactly(length)
+                return status
+            except (ConnectionError, IndexError, asyncio.IncompleteReadError):
+                writer.close()
+                self.connection = None
+                if attempt == 1:
+                    raise
+
+    def close(self):
+        if self.connection is not None:
+            self.connection[1].close()
+
+
+class ChatDriver:
+    """
+    Plays games in one group chat the way its players would, reading the
+    state of the game off the messages the bot sends: whose turn it is and
+    what they can play from the hands, pending wilds and wins from the
+    group. One update at a time, each followed by a wait for its reply.
+    """
+
+    def __init__(self, test, index, players, hpt_lap):
+        self.test = test
+        self.chat_id = -1000000 - index
+        self.user_ids = [(index + 1) * 100 + i for i in range(players)]
+        self.hpt_lap = hpt_lap
+        self.random = random.Random(index)
+        # user_id -> (text, callback data of each button) of the player's hand message
+        self.hands = {}
+        self.group = []
+        self.reply = None
+        self.last_call = 0
+        self.client = WebhookClient(test.webhook)
+
+    def on_call(self, method, params):
+        self.last_call = time.perf_counter()
+        if self.reply is not None and not self.reply.done():
+            self.reply.set_result(self.last_call)
+
+        chat_id = params.get("chat_id")
+        if chat_id == self.chat_id and method == "sendMessage":
+            self.group.append(params.get("text", ""))
+        elif chat_id in self.user_ids and method in ("sendMessage", "editMessageText"):
+            buttons = [button["callback_data"] for row in params.get("reply_markup", {}).get("inline_keyboard", [])
+                       for button in row]
+            self.hands[chat_id] = (params.get("text", ""), buttons)
+
+    def get_user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": "Player%d" % user_id}
+
+    def get_chat(self):
+        return {"id": self.chat_id, "type": "group", "title": "Load test %d" % self.chat_id}
+
+    async def send(self, update, wait=True):
+        """
+        Posts update and waits for the bot's first call in reply, then for the rest of them to stop.
+        """
+        self.reply = asyncio.get_event_loop().create_future()
+        start = time.perf_counter()
+        await self.client.post(update)
+        if not wait:
+            return
+        try:
+            replied = await asyncio.wait_for(self.reply, self.test.reply_timeout)
+            self.test.latencies.append(replied - start)
+        except asyncio.TimeoutError:
+            self.test.unanswered += 1
+        while time.perf_counter() - self.last_call < self.test.settle:
+            await asyncio.sleep(self.test.settle)
+
+    async def command(self, user_id, text, wait=True):
+        update_id = next(self.test.update_ids)
+        command = text.split()[0]
+        await self.send({"update_id": update_id, "message": {
+            "message_id": update_id, "date": int(time.time()), "chat": self.get_chat(),
+            "from": self.get_user(user_id), "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}]}}, wait)
+
+    async def tap(self, user_id, data, chat=None, wait=True):
+        """
+        Taps a button on a message in chat, the group unless given.
+        """
+        update_id = next(self.test.update_ids)
+        chat = chat or self.get_chat()
+        await self.send({"update_id": update_id, "callback_query": {
+            "id": "%d:%d" % (self.chat_id, update_id), "from": self.get_user(user_id),
+            "chat_instance": str(chat["id"]), "data": data,
+            "message": {"message_id": update_id, "date": int(time.time()), "chat": chat}}}, wait)
+
+    async def play(self, user_id, slot, wait=True):
+        # Half the plays are taps on the hand's buttons, the other half /play.
+        if self.random.random() < 0.5:
+            private = {"id": user_id, "type": "private", "first_name": "Player%d" % user_id}
+            await self.tap(user_id, self.hands[user_id][1][slot], private, wait)
+        else:
+            await self.command(user_id, "/play %d" % slot, wait)
+
+    def get_turn(self):
+        # Only the current player's hand message shows the game state.
+        for user_id, (text, buttons) in self.hands.items():
+            if text != HAND_TEXT:
+                return user_id
+        return None
+
+    async def play_game(self):
+        self.hands = {}
+        self.group = []
+        first = self.user_ids[0]
+        await self.command(first, "/newgame")
+        for user_id in self.user_ids:
+            await self.command(user_id, "/join Player%d" % user_id)
+        if self.hpt_lap:
+            await self.command(first, "/hpt %d" % self.hpt_lap)
+        await self.command(first, "/startgame")
+        for user_id in self.user_ids:
+            await self.command(user_id, "/ready")
+
+        last_player = None
+        for i in range(self.test.max_moves):
+            group, self.group = self.group, []
+            # Messages sent while handling one update arrive joined together.
+            if any(" has won!" in text for text in group):
+                self.test.games += 1
+                return
+
+            if any("Now choose a color" in text for text in group) and last_player is not None:
+                await self.command(last_player, "/wild %s" % self.random.choice(COLORS))
+                continue
+
+            if self.hpt_lap and self.random.random() < self.test.stall:
+                await asyncio.sleep(self.hpt_lap + 0.5)
+                continue
+
+            # A hand message lost to an API error leaves the turn unknown or wrong; ask for them all again.
+            user_id = self.get_turn()
+            if user_id is None or any("not currently your turn" in text for text in group):
+                for user_id in self.user_ids:
+                    await self.command(user_id, "/hand")
+                continue
+            last_player = user_id
+            buttons = self.hands[user_id][1]
+            playable = [i for i, data in enumerate(buttons) if data.startswith(callbacks.PREFIX)]
+            if not playable:
+                await self.command(user_id, "/draw")
+                continue
+            if len(buttons) != 2:
+                await self.play(user_id, self.random.choice(playable))
+            else:
+                # Down to one card, the game waits for Uno to be called, so the play itself gets
+                # no answer. Whoever taps first, the player or someone else, gets it.
+                await self.play(user_id, self.random.choice(playable), False)
+                await self.tap(self.random.choice(self.user_ids), str(user_id))
+
+        await self.command(self.user_ids[0], "/endgame")
+
+    async def run(self, games):
+        for i in range(games):
+            await self.play_game()
+        self.client.close()
+
+
+class LoadTest:
+    def __init__(self, webhook, settle, reply_timeout, max_moves, stall):
+        self.webhook = webhook
+        self.settle = settle
+        self.reply_timeout = reply_timeout
+        self.max_moves = max_moves
+        self.stall = stall
+        self.update_ids = itertools.count(1)
+        self.latencies = []
+        self.unanswered = 0
+        self.games = 0
+        self.drivers = {}
+
+    def on_call(self, method, params):
+        if method == "answerCallbackQuery":
+            chat_id = int(params["callback_query_id"].split(":")[0])
+        else:
+            chat_id = params.get("chat_id")
+        driver = self.drivers.get(chat_id)
+        if driver is not None:
+            driver.on_call(method, params)
+
+    async def run(self, chats, games, players, hpt_every, hpt_lap):
+        drivers = [ChatDriver(self, i, players, hpt_lap if hpt_every and i % hpt_every == 0 else 0)
+                   for i in range(chats)]
+        for driver in drivers:
+            self.drivers[driver.chat_id] = driver
+            for user_id in driver.user_ids:
+                self.drivers[user_id] = driver
+        start = time.perf_counter()
+        await asyncio.gather(*[driver.run(games) for driver in drivers])
+        return time.perf_counter() - start
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plays games against a running bot through a fake Bot API.")
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--games", type=int, default=1, help="games played one after another in each chat")
+    parser.add_argument("--players", type=int, default=4)
+    parser.add_argument("--hpt-every", type=int, default=4, help="every this many chats play Hot Potato")
+    parser.add_argument("--hpt-lap", type=int, default=2)
+    parser.add_argument("--stall", type=float, default=0.02,
+                        help="chance a Hot Potato player lets the timer run out on a turn")
+    parser.add_argument("--max-moves", type=int, default=1000, help="moves after which a game is ended")
+    parser.add_argument("--settle", type=float, default=0.05,
+                        help="seconds without a reply after which an update is taken as fully answered")
+    parser.add_argument("--reply-timeout", type=float, default=10)
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds the fake Bot API takes per call")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="fraction of calls answered with a 429")
+    parser.add_argument("--errors", type=float, default=0.0, help="fraction of calls answered with a 500")
+    parser.add_argument("--webhook", help="the bot's webhook URL, if it is already running")
+    args = parser.parse_args()
+
+    api = fake_bot_api.FakeBotAPI(args.latency, args.jitter, args.rate_limit, args.errors)
+    loop = asyncio.get_event_loop()
+    print("Serving the Bot API at %s" % loop.run_until_complete(fake_bot_api.serve(api, port=args.api_port)))
+
+    webhook = args.webhook
+    if webhook is None:
+        print("Waiting for the bot to set its webhook...")
+        while api.webhook is None:
+            loop.run_until_complete(asyncio.sleep(0.1))
+        webhook = api.webhook
+
+    test = LoadTest(webhook, args.settle, args.reply_timeout, args.max_moves, args.stall)
+    api.listeners.append(test.on_call)
+    elapsed = loop.run_until_complete(test.run(args.chats, args.games, args.players, args.hpt_every, args.hpt_lap))
+
+    updates = len(test.latencies) + test.unanswered
+    print("%d chats, %d games finished, %d updates in %.1fs -> %.1f updates/sec" %
+          (args.chats, test.games, updates, elapsed, updates / elapsed))
+    print("Update to reply: p50 %.1fms, p99 %.1fms, max %.1fms, %d unanswered" %
+          (percentile(test.latencies, 0.5) * 1000, percentile(test.latencies, 0.99) * 1000,
+           max(test.latencies or [0]) * 1000, test.unanswered))
+    print("Bot API calls: %s, failures injected: %s" % (dict(api.calls), dict(api.failures)))
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import atexit
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import threading
+import time
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+MAX_LOG_BYTES = 1024 * 1024
+LOG_BACKUPS = 5
+
+FEEDBACK_BATCH = 100
+FEEDBACK_INTERVAL = 1.0
+
+
+def gzip_namer(name):
+    return name + ".gz"
+
+
+def gzip_rotator(source, dest):
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def setup_logging(filename="logging.txt", level=logging.INFO, max_bytes=MAX_LOG_BYTES, when=None,
+                  backups=LOG_BACKUPS, compress=True):
+    """
+    Sends every log record through a queue to a file handler on a thread of
+    its own, so logging never waits on the disk. The file rotates at
+    max_bytes, or on the schedule given by when ("midnight", "H", ...) if
+    set, keeping backups old files, gzipped if compress.
+    """
+    if when is not None:
+        handler = logging.handlers.TimedRotatingFileHandler(filename, when=when, backupCount=backups)
+    else:
+        handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backups)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    if compress:
+        handler.namer = gzip_namer
+        handler.rotator = gzip_rotator
+
+    records = queue.Queue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(records))
+
+    listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+class FeedbackStore:
+    """
+    Appends feedback to a JSON-lines file from a background thread, a batch
+    at a time. add only queues the entry, so it never waits on the disk.
+    """
+
+    def __init__(self, path, batch_size=FEEDBACK_BATCH, interval=FEEDBACK_INTERVAL):
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        self.entries = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def add(self, user_id, name, text):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="feedback", daemon=True)
+                self.thread.start()
+                atexit.register(self.close)
+        self.entries.put({"time": time.time(), "user_id": user_id, "name": name, "text": text})
+
+    def run(self):
+        while True:
+            batch = [self.entries.get()]
+            deadline = time.monotonic() + self.interval
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.entries.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            closing = batch[-1] is None
+            entries = [entry for entry in batch if entry is not None]
+            if entries:
+                try:
+                    with open(self.path, "a") as f:
+                        f.write("".join(json.dumps(entry) + "\n" for entry in entries))
+                except IOError:
+                    logging.getLogger(__name__).exception("Couldn't save %d feedback entries", len(entries))
+            if closing:
+                return
+
+    def close(self):
+        """
+        Writes out whatever is queued and stops the thread.
+        """
+        if self.thread is not None and self.thread.is_alive():
+            self.entries.put(None)
+            self.thread.join()
+
+
+class BackgroundWriter:
+    """
+    Runs file writes on a thread of its own, in the order they were
+    submitted, so whoever submits them never waits on the disk. close runs
+    whatever is still queued before it returns.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.jobs = None
+        self.thread = None
+
+    def submit(self, fn, *args):
+        with self.lock:
+            if self.thread is None:
+                self.jobs = queue.Queue()
+                self.thread = threading.Thread(target=self.run, args=(self.jobs,), name=self.name, daemon=True)
+                self.thread.start()
+                atexit.register(self.close)
+            self.jobs.put((fn, args))
+
+    def run(self, jobs):
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            fn, args = job
+            try:
+                fn(*args)
+            except Exception:
+                logging.getLogger(__name__).exception("%s couldn't write", self.name)
+
+    def close(self):
+        with self.lock:
+            thread = self.thread
+            if thread is not None:
+                self.jobs.put(None)
+            self.thread = None
+        if thread is not None:
+            thread.join()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from telegram.utils.request import Request
+
+import bisect
+import functools
+import threading
+import time
+
+# Metrics are exposed in the Prometheus text format, which needs no client library to write.
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values, extra=""):
+    pairs = ['%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *values):
+        with self.lock:
+            self.values[values] = self.values.get(values, 0) + 1
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name]
+        with self.lock:
+            items = sorted(self.values.items())
+        for values, count in items:
+            lines.append("%s%s %d" % (self.name, format_labels(self.labels, values), count))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket, plus one for +Inf], sum
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(values)
+            if entry is None:
+                entry = self.values[values] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        with self.lock:
+            items = sorted((values, (list(counts), total)) for values, (counts, total) in self.values.items())
+        for values, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (self.name, format_labels(self.labels, values, 'le="%s"' % bound),
+                                                 cumulative))
+            lines.append("%s_sum%s %f" % (self.name, format_labels(self.labels, values), total))
+            lines.append("%s_count%s %d" % (self.name, format_labels(self.labels, values), cumulative))
+        return lines
+
+
+class Gauge:
+    """
+    A value read when scraped: fn returns a number, or a dict from tuples of
+    label values to numbers.
+    """
+
+    def __init__(self, name, help, fn, labels=()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labels = labels
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s gauge" % self.name]
+        value = self.fn()
+        items = sorted(value.items()) if isinstance(value, dict) else [((), value)]
+        for values, number in items:
+            lines.append("%s%s %s" % (self.name, format_labels(self.labels, values), number))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+command_seconds = registry.add(Histogram("uno_command_seconds", "Time spent handling each command.", ("command",)))
+api_calls = registry.add(Counter("uno_api_calls_total", "Bot API calls made, by method.", ("method",)))
+api_errors = registry.add(Counter("uno_api_errors_total", "Bot API calls that failed, by method and error.",
+                                  ("method", "error")))
+api_seconds = registry.add(Histogram("uno_api_call_seconds", "Bot API call latency, by method.", ("method",)))
+updates = registry.add(Counter("uno_updates_total", "Updates received, by what became of them.", ("outcome",)))
+
+
+def timed(command, handler):
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            command_seconds.observe(time.perf_counter() - start, command)
+    return wrapper
+
+
+def observe_api_call(method, start, error=None):
+    api_calls.inc(method)
+    api_seconds.observe(time.perf_counter() - start, method)
+    if error is not None:
+        api_errors.inc(method, type(error).__name__)
+
+
+class MeteredRequest(Request):
+    """
+    python-telegram-bot's Request, counting and timing every Bot API call.
+    """
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        try:
+            result = Request.post(self, url, data, timeout=timeout)
+        except Exception as e:
+            observe_api_call(method, start, e)
+            raise
+        observe_api_call(method, start)
+        return result
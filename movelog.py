@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import os
+
+import log_writer
+
+COMPACT = (",", ":")
+
+
+def get_game_name(game):
+    return "%s.%s.log" % (game.chat_id, game.seed)
+
+
+class MoveLog:
+    """
+    Writes one file per game: a header with everything needed to set the
+    game up again (seed, players in seat order, options) followed by one
+    line per accepted action, with the same arguments the handlers passed
+    to moves. replay.py turns such a file back into a Game at any move.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        # Only touched on the writer's thread.
+        self.files = {}
+        self.writer = log_writer.BackgroundWriter("movelog")
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def write(self, name, line, mode="a"):
+        f = self.files.get(name)
+        if f is None:
+            f = open(os.path.join(self.directory, name), mode)
+            self.files[name] = f
+        f.write(line)
+        f.flush()
+
+    def close_file(self, name):
+        f = self.files.pop(name, None)
+        if f is not None:
+            f.close()
+
+    def start(self, game):
+        """
+        Called once the game's first card is on the pile.
+        """
+        header = {"chat_id": game.chat_id,
+                  "seed": game.seed,
+                  "players": [[user_id, game.players_and_names[user_id]] for user_id in game.seat_ids],
+                  "hpt_lap": game.get_hpt_lap(),
+                  "advanced_rules": game.is_advanced_rules()}
+        self.writer.submit(self.write, get_game_name(game), json.dumps(header, separators=COMPACT) + "\n", "w")
+
+    def record(self, game, op, *args):
+        self.writer.submit(self.write, get_game_name(game), json.dumps([op] + list(args), separators=COMPACT) + "\n")
+
+    def finish(self, game):
+        self.writer.submit(self.close_file, get_game_name(game))
+
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+# The turn flow around each player action, shared by the Telegram handlers and anything else
+# that drives a uno.Game offline. Each move applies one action and says what happened next.
+
+# The action was refused; the game is unchanged apart from any rule message.
+REJECTED = "rejected"
+# The player has no cards left.
+WON = "won"
+# The action went through but the turn is held up by an Uno call, a wild color or a seven swap.
+WAITING = "waiting"
+# The player drew under the advanced rules and still has to play.
+CONTINUED = "continued"
+# The turn has passed to the next player.
+ADVANCED = "advanced"
+
+
+def play(game, user_id, card_id):
+    if not game.play_card(user_id, card_id):
+        return REJECTED
+
+    if len(game.get_player(user_id).get_hand()) == 1:
+        game.set_uno_pending(True, user_id)
+
+    if game.check_for_win() is not None:
+        return WON
+
+    if game.is_uno_pending() or game.is_wild_pending() or (game.is_advanced_rules() and game.is_seven_pending()):
+        return WAITING
+
+    game.finish_turn()
+    return ADVANCED
+
+
+def draw(game, user_id):
+    if not game.draw_and_continue(user_id):
+        return REJECTED
+
+    if game.is_advanced_rules():
+        return CONTINUED
+
+    game.finish_turn()
+    return ADVANCED
+
+
+def wild(game, user_id, color):
+    if not game.set_wild_color(user_id, color):
+        return REJECTED
+
+    if game.is_uno_pending() or game.is_seven_pending():
+        return WAITING
+
+    game.finish_turn()
+    return ADVANCED
+
+
+def seven(game, user_id, num):
+    if not game.play_seven(user_id, game.get_player_id_by_num(num)):
+        return REJECTED
+
+    if game.is_uno_pending() or game.is_wild_pending():
+        return WAITING
+
+    game.finish_turn()
+    return ADVANCED
+
+
+def call_uno(game, user_id):
+    if game.check_uno_caller(user_id) == -1:
+        return REJECTED
+
+    if game.is_wild_pending() or game.is_seven_pending():
+        return WAITING
+
+    game.finish_turn()
+    return ADVANCED
+
+
+def timeout(game):
+    if game.is_uno_pending() or game.is_wild_pending():
+        return WAITING
+
+    game.draw_and_continue(game.get_player_id_by_num(game.turn))
+    game.finish_turn()
+    return ADVANCED
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from telegram.error import TelegramError
+
+import functools
+import threading
+
+
+# Telegram rejects longer messages.
+MAX_MESSAGE_LENGTH = 4096
+SEPARATOR = "\n\n"
+
+_local = threading.local()
+
+
+class Outbox:
+    """
+    Stands in for the bot while one update is handled. Plain text sent to
+    a chat is held back and joined into as few messages as possible when
+    the handler finishes. A message with a reply markup picks up the text
+    queued before it so the order within a chat is kept; a message with a
+    parse mode is sent on its own.
+
+    Everything other than send_message is passed straight to the bot.
+
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.pending = {}
+        self.order = []
+
+    def __getattr__(self, name):
+        return getattr(self.bot, name)
+
+    def send_message(self, chat_id, text, **kwargs):
+        if chat_id not in self.pending:
+            self.pending[chat_id] = []
+            self.order.append(chat_id)
+        self.pending[chat_id].append((text.rstrip("\n"), kwargs))
+
+    def flush(self):
+        error = None
+        for chat_id in self.order:
+            for text, kwargs in coalesce(self.pending[chat_id]):
+                try:
+                    self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                except TelegramError as e:
+                    # Keep delivering to the other chats; the first error is raised at the end.
+                    error = error or e
+                    break
+        self.pending = {}
+        self.order = []
+        if error is not None:
+            raise error
+
+
+def coalesce(messages):
+    merged = []
+    texts = []
+    for text, kwargs in messages:
+        if kwargs.get("parse_mode") is not None:
+            merged.extend(join_texts(texts))
+            merged.append((text, kwargs))
+            texts = []
+        elif kwargs:
+            # Fold the queued text into the message carrying the markup, if it fits.
+            parts = join_texts(texts + [text]) or [(text, {})]
+            merged.extend(parts[:-1])
+            merged.append((parts[-1][0], kwargs))
+            texts = []
+        else:
+            texts.append(text)
+    merged.extend(join_texts(texts))
+    return merged
+
+
+def join_texts(texts):
+    chunks = []
+    current = ""
+    for text in texts:
+        if current and len(current) + len(SEPARATOR) + len(text) > MAX_MESSAGE_LENGTH:
+            chunks.append((current, {}))
+            current = ""
+        current = current + SEPARATOR + text if current else text
+    if current:
+        chunks.append((current, {}))
+    return chunks
+
+
+def unwrap(bot):
+    """
+    Returns the real bot behind an outbox, for sends that can't wait for the handler to finish
+    or are made from other threads.
+    """
+    return bot.bot if isinstance(bot, Outbox) else bot
+
+
+def coalesced(handler):
+    @functools.wraps(handler)
+    def wrapper(bot, *args, **kwargs):
+        outbox = getattr(_local, "outbox", None)
+        if outbox is not None:
+            return handler(outbox, *args, **kwargs)
+
+        outbox = Outbox(bot)
+        _local.outbox = outbox
+        try:
+            return handler(outbox, *args, **kwargs)
+        finally:
+            _local.outbox = None
+            outbox.flush()
+    return wrapper
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import log_writer
+import uno
+
+import collections
+import json
+import logging
+import os
+import random
+import threading
+
+# Cards are stored as value * 5 + the index of their color here.
+CARD_COLORS = ['', 'R', 'Y', 'G', 'B']
+
+# A snapshot is taken after this many journaled moves.
+SNAPSHOT_EVERY = 1000
+SNAPSHOT_FILE = "snapshot.json"
+JOURNAL_PREFIX = "journal."
+
+# Game attributes that are plain values and are stored as they are, in this order.
+GAME_FIELDS = ("turn", "ready_to_play", "waiting_for_wild", "waiting_for_wild_id", "waiting_for_wild_name",
+               "uno_pending", "uno_pending_id", "skip_pending", "dir", "reversed", "draw_fours_pending",
+               "draw_twos_pending", "hpt_lap", "advanced_rules", "waiting_for_seven", "waiting_for_seven_id",
+               "waiting_for_seven_name", "last_num_cards_drawn")
+CHAT_FIELDS = ("is_game_pending", "hpt_lap", "aa_rules")
+
+COMPACT = (",", ":")
+
+
+def encode_cards(cards):
+    return [c.value * 5 + CARD_COLORS.index(c.color) for c in cards]
+
+
+def decode_cards(codes):
+    return [uno.Card(code // 5, CARD_COLORS[code % 5]) for code in codes]
+
+
+def encode_game(game):
+    version, internal, gauss = game.rng.getstate()
+    return {"seed": game.seed,
+            "rng": [version, list(internal), gauss],
+            "seats": [[user_id, player.get_version(), encode_cards(player.get_hand()),
+                       game.players_and_ready.get(user_id, False)]
+                      for user_id, player in zip(game.seat_ids, game.seat_players)],
+            "deck": [encode_cards(game.deck.deck), encode_cards(game.deck.bottom), encode_cards(game.deck.played)],
+            "fields": [getattr(game, name) for name in GAME_FIELDS]}
+
+
+def decode_game(data, chat_id, names):
+    game = uno.Game.__new__(uno.Game)
+    game.chat_id = chat_id
+    game.players_and_names = names
+    game.events = []
+    game.state = game.state_key = None
+    game.seed = data["seed"]
+    game.rng = random.Random()
+    version, internal, gauss = data["rng"]
+    game.rng.setstate((version, tuple(internal), gauss))
+
+    game.deck = uno.Deck(0, game.rng)
+    game.deck.deck = decode_cards(data["deck"][0])
+    game.deck.bottom = collections.deque(decode_cards(data["deck"][1]))
+    game.deck.played = decode_cards(data["deck"][2])
+
+    game.players = {}
+    game.players_and_ready = {}
+    game.seat_ids = []
+    game.seat_players = []
+    for seat, (user_id, version, hand, ready) in enumerate(data["seats"]):
+        player = uno.Player(seat, decode_cards(hand))
+        player.version = version
+        game.players[user_id] = player
+        game.players_and_ready[user_id] = ready
+        game.seat_ids.append(user_id)
+        game.seat_players.append(player)
+
+    for name, value in zip(GAME_FIELDS, data["fields"]):
+        setattr(game, name, value)
+    return game
+
+
+def encode_chat(chat_data):
+    game = chat_data.get("game_obj")
+    state = dict((name, chat_data[name]) for name in CHAT_FIELDS if name in chat_data)
+    state["players"] = [[user_id, name] for user_id, name in chat_data.get("pending_players", {}).items()]
+    state["game"] = encode_game(game) if game is not None else None
+    return state
+
+
+def is_idle(state):
+    """
+    Whether a chat's encoded state is what a chat that never played would have, so needn't be kept.
+    """
+    return (state["game"] is None and not state.get("is_game_pending", False) and not state["players"] and
+            state.get("hpt_lap", -1) <= 0 and not state.get("aa_rules", False))
+
+
+def decode_chat(state, chat_id, chat_data):
+    for name in CHAT_FIELDS:
+        if name in state:
+            chat_data[name] = state[name]
+    chat_data["pending_players"] = dict((user_id, name) for user_id, name in state["players"])
+    # The game shares its names with pending_players, as it does when a game is started.
+    chat_data["game_obj"] = (decode_game(state["game"], chat_id, chat_data["pending_players"])
+                             if state["game"] is not None else None)
+
+
+class Store:
+    """
+    Keeps every chat's state on disk as a snapshot plus a journal of the
+    moves made since, so a move costs one appended line.
+
+    apply(chat_id, chat_data, op, args) redoes a journaled move while
+    recovering. post(chat_id, fn, *args) must run fn where the chat's own
+    updates run: snapshots ask each chat that changed to encode itself
+    there, so the state they save is never halfway through a move.
+
+    The journal is split into numbered segments. A snapshot starts a new
+    segment, and the older ones are deleted once every changed chat has
+    checkpointed, since all their moves are then in the snapshot. A chat
+    left idle, with its game over and nothing else to remember, is let go
+    once the segments holding its moves are gone.
+
+    The files themselves are written on a thread of their own, in the order
+    the moves were made, so a chat making a move never waits on the disk.
+    """
+
+    def __init__(self, directory, apply, post, snapshot_every=SNAPSHOT_EVERY, sync=False):
+        self.directory = directory
+        self.apply = apply
+        self.post = post
+        self.snapshot_every = snapshot_every
+        self.sync = sync
+        self.lock = threading.Lock()
+
+        self.seq = 0
+        self.segment = 0
+        self.journal = None
+        self.writer = log_writer.BackgroundWriter("journal")
+        self.since_snapshot = 0
+        # chat_id -> [seq of the chat's last journaled move, encoded state as of that move]
+        self.states = {}
+        self.last_seq = {}
+        # Chats with moves since their last checkpoint, and the chat_data to encode them from.
+        self.dirty = {}
+        self.checkpoints_pending = 0
+        self.covered_segment = 0
+        # The last move in the covered segments.
+        self.covered_seq = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get_segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith(JOURNAL_PREFIX) and name[len(JOURNAL_PREFIX):].isdigit():
+                segments.append(int(name[len(JOURNAL_PREFIX):]))
+        return sorted(segments)
+
+    def get_segment_path(self, segment):
+        return os.path.join(self.directory, JOURNAL_PREFIX + str(segment))
+
+    def recover(self, chat_data_for):
+        """
+        Rebuilds every chat from the snapshot and the journal after it,
+        filling the dicts chat_data_for(chat_id) returns, then writes a fresh
+        snapshot so the next recovery starts from here. Returns the chat ids
+        that were recovered.
+        """
+        chats = {}
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        if os.path.exists(path):
+            with open(path) as f:
+                snapshot = json.load(f)
+            self.seq = snapshot["seq"]
+            for chat_id, seq, state in snapshot["chats"]:
+                chat_data = chat_data_for(chat_id)
+                decode_chat(state, chat_id, chat_data)
+                chats[chat_id] = chat_data
+                self.last_seq[chat_id] = seq
+
+        segments = self.get_segments()
+        replayed = 0
+        for segment in segments:
+            with open(self.get_segment_path(segment)) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line of a segment is cut short if the process died while writing it.
+                        logging.getLogger(__name__).warning("Skipping a torn journal line in segment %d", segment)
+                        break
+                    seq, chat_id, op, args = entry[0], entry[1], entry[2], entry[3:]
+                    self.seq = max(self.seq, seq)
+                    if seq <= self.last_seq.get(chat_id, 0):
+                        continue
+                    if chat_id not in chats:
+                        chats[chat_id] = chat_data_for(chat_id)
+                    try:
+                        self.apply(chat_id, chats[chat_id], op, args)
+                    except Exception:
+                        logging.getLogger(__name__).exception("Couldn't replay move %d in chat %s", seq, chat_id)
+                    self.last_seq[chat_id] = seq
+                    replayed += 1
+
+        # Nothing else is running yet, so every chat can be encoded right here.
+        for chat_id, chat_data in chats.items():
+            self.states[chat_id] = [self.last_seq.get(chat_id, 0), encode_chat(chat_data)]
+        self.segment = segments[-1] + 1 if segments else 1
+        self.covered_segment = self.segment - 1
+        self.covered_seq = self.seq
+        self.writer.submit(self.open_segment, self.segment)
+        self.write_snapshot()
+
+        logging.getLogger(__name__).info("Recovered %d chats, replaying %d journaled moves", len(chats), replayed)
+        return list(chats.keys())
+
+    def open_segment(self, segment):
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = open(self.get_segment_path(segment), "a")
+
+    def write(self, line):
+        self.journal.write(line)
+        self.journal.flush()
+        if self.sync:
+            os.fsync(self.journal.fileno())
+
+    def record(self, chat_id, chat_data, op, *args):
+        """
+        Appends one move to the journal. Called where the chat's updates run, right after the move.
+        """
+        with self.lock:
+            self.seq += 1
+            line = json.dumps([self.seq, chat_id, op] + list(args), separators=COMPACT) + "\n"
+            self.writer.submit(self.write, line)
+            self.last_seq[chat_id] = self.seq
+            self.dirty[chat_id] = chat_data
+            self.since_snapshot += 1
+            if self.since_snapshot < self.snapshot_every or self.checkpoints_pending > 0:
+                return
+
+            self.since_snapshot = 0
+            self.covered_segment = self.segment
+            self.covered_seq = self.seq
+            self.segment += 1
+            self.writer.submit(self.open_segment, self.segment)
+            dirty = self.dirty
+            self.dirty = {}
+            self.checkpoints_pending = len(dirty)
+
+        for dirty_chat_id, dirty_chat_data in dirty.items():
+            self.post(dirty_chat_id, self.checkpoint, dirty_chat_id, dirty_chat_data)
+
+    def checkpoint(self, chat_id, chat_data):
+        state = encode_chat(chat_data)
+        with self.lock:
+            self.states[chat_id] = [self.last_seq[chat_id], state]
+            self.checkpoints_pending -= 1
+            done = self.checkpoints_pending == 0
+        if done:
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        with self.lock:
+            chats = [[chat_id, seq, state] for chat_id, (seq, state) in self.states.items()]
+            seq = self.seq
+            covered = self.covered_segment
+            covered_seq = self.covered_seq
+            self.writer.submit(self.save_snapshot, seq, chats, covered, covered_seq)
+
+    def save_snapshot(self, seq, chats, covered, covered_seq):
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"seq": seq, "chats": chats}, f, separators=COMPACT)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+        for segment in self.get_segments():
+            if segment <= covered:
+                os.remove(self.get_segment_path(segment))
+
+        # An idle chat's moves up to here are gone from the journal, so recovering without it
+        # comes to the same thing.
+        with self.lock:
+            for chat_id, last_seq, state in chats:
+                if last_seq <= covered_seq and is_idle(state) and self.states.get(chat_id, [None])[0] == last_seq:
+                    del self.states[chat_id]
+                    if self.last_seq.get(chat_id) == last_seq:
+                        del self.last_seq[chat_id]
+
+    def close_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def close(self):
+        """
+        Writes out whatever is queued and closes the journal.
+        """
+        self.writer.submit(self.close_journal)
+        self.writer.close()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import collections
+import os
+import sys
+import threading
+import time
+
+INTERVAL = 0.01
+# Functions that samples are grouped under; the outermost one on a thread's stack wins.
+ENTRY_POINTS = ("hpt_turn", "uno_prompt", "send_hands", "deliver", "publish")
+
+
+def is_entry_point(name):
+    return name.endswith("_handler") or name in ENTRY_POINTS
+
+
+def get_label(code):
+    return "%s:%s" % (os.path.splitext(os.path.basename(code.co_filename))[0], code.co_name)
+
+
+class Sampler:
+    """
+    Every interval seconds, looks at what each thread is running and, if it
+    is inside a handler (or another entry point), counts its stack under
+    that handler. Threads waiting for work aren't inside one, so they cost
+    a walk up their stack and nothing more. stop writes one collapsed-stack
+    file per handler, the format flamegraph.pl and speedscope read.
+    """
+
+    def __init__(self, directory, interval=INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.stacks = {}
+        # Labels by code object, as the same few functions come up on every tick.
+        self.labels = {}
+        self.samples = 0
+        self.started = None
+        self.thread = None
+        self.running = threading.Event()
+        self.lock = threading.Lock()
+
+    def is_running(self):
+        return self.running.is_set()
+
+    def start(self):
+        with self.lock:
+            if self.running.is_set():
+                return False
+            self.stacks = collections.defaultdict(collections.Counter)
+            self.samples = 0
+            self.started = time.time()
+            self.running.set()
+            self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+            self.thread.start()
+        return True
+
+    def run(self):
+        me = threading.get_ident()
+        while self.running.is_set():
+            self.sample(me)
+            time.sleep(self.interval)
+
+    def sample(self, me):
+        self.samples += 1
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            codes = []
+            handler = None
+            while frame is not None:
+                code = frame.f_code
+                codes.append(code)
+                if is_entry_point(code.co_name):
+                    handler = code.co_name
+                frame = frame.f_back
+            if handler is None:
+                continue
+
+            labels = []
+            for code in reversed(codes):
+                label = self.labels.get(code)
+                if label is None:
+                    label = self.labels[code] = get_label(code)
+                labels.append(label)
+            self.stacks[handler][";".join(labels)] += 1
+
+    def stop(self):
+        """
+        Stops sampling and writes the profiles. Returns (handler, samples, path) for each handler seen,
+        busiest first.
+        """
+        with self.lock:
+            if not self.running.is_set():
+                return []
+            self.running.clear()
+            self.thread.join()
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started))
+        written = []
+        for handler, stacks in self.stacks.items():
+            path = os.path.join(self.directory, "%s-%s.folded" % (stamp, handler))
+            with open(path, "w") as f:
+                for stack, count in stacks.most_common():
+                    f.write("%s %d\n" % (stack, count))
+            written.append((handler, sum(stacks.values()), path))
+        return sorted(written, key=lambda w: -w[1])
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from outbox import MAX_MESSAGE_LENGTH, SEPARATOR
+from telegram.error import RetryAfter, TelegramError
+
+import collections
+import itertools
+import logging
+import threading
+import time
+
+# Telegram allows about 30 messages a second in all, 20 a minute in a group and about one a
+# second in a private chat, with short bursts above that.
+GLOBAL_RATE = 30.0
+GLOBAL_BURST = 30
+GROUP_RATE = 20 / 60.0
+GROUP_BURST = 20
+PRIVATE_RATE = 1.0
+PRIVATE_BURST = 3
+# Buckets for idle chats are let go once there are this many.
+MAX_BUCKETS = 10000
+
+# Priority classes, most urgent first. The current player's hand and Uno prompts hold up the
+# game; what happened in the game comes next; everyone else's hand and private notes last.
+TURN = 0
+GAME = 1
+BACKGROUND = 2
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+        self.held_until = 0
+
+    def get_delay(self, now):
+        """
+        Returns how many seconds until a token can be taken.
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.held_until:
+            return self.held_until - now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def hold(self, until):
+        self.held_until = max(self.held_until, until)
+
+    def is_idle(self, now):
+        return now >= self.held_until and self.get_delay(now) == 0 and self.tokens >= self.burst
+
+
+class Job:
+    def __init__(self, priority, sequence, key, fn, args, kwargs, mergeable=False):
+        self.priority = priority
+        self.sequence = sequence
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.mergeable = mergeable
+
+
+class OutboundScheduler:
+    """
+    Sends to each chat in order, one call at a time, paced by a token bucket
+    for the chat and one for the bot as a whole. When more chats are ready
+    than the global bucket allows, the one whose next job has the most
+    urgent priority goes first.
+
+    Jobs wait until they can be sent, so they can still change: a job
+    submitted with the key of one that is waiting replaces it in its place,
+    and plain text for a chat is appended to the text waiting there. A job
+    that gets a RetryAfter holds its chat for as long as Telegram asks and
+    is then tried again. The calls themselves run on fanout's pool.
+    """
+
+    def __init__(self, fanout, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST, group_rate=GROUP_RATE,
+                 group_burst=GROUP_BURST, private_rate=PRIVATE_RATE, private_burst=PRIVATE_BURST, name="outbound",
+                 clock=time.monotonic):
+        self.fanout = fanout
+        self.clock = clock
+        self.group_limits = (group_rate, group_burst)
+        self.private_limits = (private_rate, private_burst)
+        self.global_bucket = TokenBucket(global_rate, global_burst, clock())
+        self.buckets = {}
+        # chat_id -> jobs waiting for that chat; only chats with jobs waiting have one.
+        self.queues = {}
+        self.keys = {}
+        # Chats with a call in flight.
+        self.busy = set()
+        self.queued = 0
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.name = name
+        self.thread = None
+
+    def submit(self, chat_id, priority, key, fn, *args):
+        """
+        Queues fn(*args) as a call to chat_id. If key isn't None and a job with
+        the same key is waiting, this one takes its place instead.
+        """
+        with self.condition:
+            job = self.keys.get(key) if key is not None else None
+            if job is not None:
+                job.priority = min(job.priority, priority)
+                job.fn = fn
+                job.args = args
+                return
+            self.enqueue(chat_id, Job(priority, next(self.sequence), key, fn, args, {}))
+
+    def send_message(self, bot, chat_id, text, priority, **kwargs):
+        """
+        Queues bot.send_message, merging plain text into plain text already waiting for the chat.
+        """
+        with self.condition:
+            queue = self.queues.get(chat_id)
+            last = queue[-1] if queue else None
+            if (not kwargs and last is not None and last.mergeable and last.fn == bot.send_message and
+                    len(last.kwargs["text"]) + len(SEPARATOR) + len(text) <= MAX_MESSAGE_LENGTH):
+                last.kwargs["text"] += SEPARATOR + text
+                last.priority = min(last.priority, priority)
+                return
+            kwargs.update(chat_id=chat_id, text=text)
+            self.enqueue(chat_id, Job(priority, next(self.sequence), None, bot.send_message, (), kwargs,
+                                     mergeable=len(kwargs) == 2))
+
+    def enqueue(self, chat_id, job, first=False):
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            queue = self.queues[chat_id] = collections.deque()
+        if first:
+            queue.appendleft(job)
+        else:
+            queue.append(job)
+        if job.key is not None:
+            self.keys[job.key] = job
+        self.queued += 1
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+            self.thread.start()
+        self.condition.notify()
+
+    def get_bucket(self, chat_id, now):
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            rate, burst = self.group_limits if chat_id < 0 else self.private_limits
+            bucket = self.buckets[chat_id] = TokenBucket(rate, burst, now)
+        return bucket
+
+    def next_job(self):
+        while True:
+            now = self.clock()
+            wait = self.global_bucket.get_delay(now) or None
+            best = None
+            if wait is None:
+                for chat_id, queue in self.queues.items():
+                    if chat_id in self.busy:
+                        continue
+                    delay = self.get_bucket(chat_id, now).get_delay(now)
+                    if delay > 0:
+                        wait = delay if wait is None else min(wait, delay)
+                    elif best is None or (queue[0].priority, queue[0].sequence) < (best[1].priority,
+                                                                                   best[1].sequence):
+                        best = (chat_id, queue[0])
+
+            if best is not None:
+                chat_id, job = best
+                self.global_bucket.take()
+                self.buckets[chat_id].take()
+                queue = self.queues[chat_id]
+                queue.popleft()
+                if not queue:
+                    del self.queues[chat_id]
+                if job.key is not None:
+                    del self.keys[job.key]
+                self.queued -= 1
+                self.busy.add(chat_id)
+                return best
+
+            if len(self.buckets) > MAX_BUCKETS:
+                for chat_id in [c for c, b in self.buckets.items()
+                                if c not in self.queues and c not in self.busy and b.is_idle(now)]:
+                    del self.buckets[chat_id]
+            self.condition.wait(wait)
+
+    def run(self):
+        while True:
+            with self.condition:
+                chat_id, job = self.next_job()
+            self.fanout.submit(self.send, [(chat_id, (chat_id, job))])
+
+    def send(self, chat_id, job):
+        try:
+            job.fn(*job.args, **job.kwargs)
+        except RetryAfter as e:
+            with self.condition:
+                now = self.clock()
+                self.get_bucket(chat_id, now).hold(now + e.retry_after)
+                # Unless a newer version has been queued since, it goes again first.
+                if job.key is None or job.key not in self.keys:
+                    self.enqueue(chat_id, job, first=True)
+        except TelegramError as e:
+            logging.getLogger(__name__).warning("Couldn't send to %s: %s", chat_id, e)
+        except Exception:
+            logging.getLogger(__name__).exception("Couldn't send to %s", chat_id)
+        finally:
+            with self.condition:
+                self.busy.discard(chat_id)
+                self.condition.notify()
+
+    def get_queued(self):
+        return self.queued
+
+
+class ScheduledBot:
+    """
+    Stands in for the bot in handlers so that what they send goes through
+    an OutboundScheduler. send_message returns nothing, as it only queues.
+    """
+
+    def __init__(self, bot, scheduler):
+        self.bot = bot
+        self.scheduler = scheduler
+
+    def __getattr__(self, name):
+        return getattr(self.bot, name)
+
+    def send_message(self, chat_id, text, **kwargs):
+        if kwargs.get("reply_markup") is not None and chat_id < 0:
+            priority = TURN
+        elif chat_id < 0:
+            priority = GAME
+        else:
+            priority = BACKGROUND
+        self.scheduler.send_message(self.bot, chat_id, text, priority, **kwargs)
+
+    def send_now(self, chat_id, text, **kwargs):
+        """
+        Sends at once, outside the rate limits, and raises whatever sending raises.
+        """
+        return self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+
+    def submit(self, chat_id, priority, key, fn, *args):
+        self.scheduler.submit(chat_id, priority, key, fn, *args)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import uno
+import moves
+
+import argparse
+import collections
+import json
+import time
+
+# A move log (see movelog.py) is a header line, then one action per line: the op and the
+# arguments the handler passed to moves.
+MOVES = {"draw": moves.draw, "play": moves.play, "uno": moves.call_uno, "wild": moves.wild,
+         "seven": moves.seven, "timeout": moves.timeout}
+
+
+def read_log(path):
+    """
+    Returns the header of the log at path and an iterator over its actions, read as they're needed.
+    """
+    f = open(path)
+    header = json.loads(f.readline())
+
+    def actions():
+        with f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    return header, actions()
+
+
+def new_game(header):
+    game = uno.Game(header["chat_id"], collections.OrderedDict(
+        (user_id, name) for user_id, name in header["players"]), header["seed"])
+    game.set_hpt_lap(header["hpt_lap"])
+    game.set_advanced_rules(header["advanced_rules"])
+    for user_id in game.get_players_and_ready():
+        game.get_players_and_ready()[user_id] = True
+    game.set_ready_to_play(True)
+    game.play_initial_card()
+    game.drain_events()
+    return game
+
+
+def apply(game, action):
+    return MOVES[action[0]](game, *action[1:])
+
+
+def rebuild(path, at=None):
+    """
+    Returns the game in the log at path as it was after its first at actions
+    (all of them by default), along with the events the last one recorded.
+    """
+    header, actions = read_log(path)
+    game = new_game(header)
+    last_events = []
+    for i, action in enumerate(actions):
+        if at is not None and i >= at:
+            break
+        apply(game, action)
+        last_events = game.drain_events()
+    return game, last_events
+
+
+def get_stats(path):
+    """
+    Replays a log keeping only running totals, not the game at each move.
+    """
+    header, actions = read_log(path)
+    game = new_game(header)
+    names = dict((user_id, name) for user_id, name in header["players"])
+    stats = {"actions": 0, "ops": collections.Counter(), "outcomes": collections.Counter(),
+             "played": collections.Counter(), "drawn": collections.Counter(), "reshuffles": 0}
+    for action in actions:
+        # Sevens and, under the advanced rules, zeros move whole hands between players, so draws are
+        # counted by how much each hand grew, wherever it ended up.
+        sizes = dict((id(player.get_hand()), len(player.get_hand())) for player in game.seat_players)
+        played_from = id(game.get_player(action[1]).get_hand()) if action[0] == "play" else None
+        played = len(game.deck.played)
+        stats["outcomes"][apply(game, action)] += 1
+        game.drain_events()
+
+        stats["actions"] += 1
+        stats["ops"][action[0]] += 1
+        if len(game.deck.played) < played:
+            stats["reshuffles"] += 1
+        # Only accepted actions are logged, so every play put a card down.
+        if action[0] == "play":
+            stats["played"][names[action[1]]] += 1
+        for user_id, player in zip(game.seat_ids, game.seat_players):
+            hand = player.get_hand()
+            grown = len(hand) - sizes.get(id(hand), 0) + (1 if id(hand) == played_from else 0)
+            stats["drawn"][names[user_id]] += grown
+
+    winner = game.check_for_win()
+    stats["winner"] = names[winner] if winner is not None else None
+    return stats
+
+
+def describe(game):
+    lines = [game.get_state()]
+    for user_id, player in zip(game.seat_ids, game.seat_players):
+        lines.append("(%d) %s: %s" % (player.get_id(), game.players_and_names[user_id],
+                                      ", ".join(str(c) for c in player.get_hand())))
+    lines.append("Draw pile: %d, bottom: %d, played: %d" %
+                 (len(game.deck.deck), len(game.deck.bottom), len(game.deck.played)))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuilds games from their move logs.")
+    parser.add_argument("logs", nargs="+")
+    parser.add_argument("--at", type=int, help="show the game after this many actions instead of at the end")
+    parser.add_argument("--stats", action="store_true", help="print totals for each log instead of the game")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    total_actions = 0
+    for path in args.logs:
+        if args.stats:
+            stats = get_stats(path)
+            total_actions += stats["actions"]
+            print("%s: %d actions, winner %s, %d reshuffles" %
+                  (path, stats["actions"], stats["winner"], stats["reshuffles"]))
+            print("  ops: %s" % dict(stats["ops"]))
+            print("  outcomes: %s" % dict(stats["outcomes"]))
+            print("  played: %s" % dict(stats["played"]))
+            print("  drawn: %s" % dict(stats["drawn"]))
+        else:
+            game, last_events = rebuild(path, args.at)
+            print(path)
+            print(describe(game))
+            if last_events:
+                print("Last action recorded: %s" % ", ".join(repr(e) for e in last_events))
+
+    if args.stats:
+        elapsed = time.perf_counter() - start
+        print("Replayed %d actions in %.3fs (%.0f actions/sec)" %
+              (total_actions, elapsed, total_actions / max(elapsed, 1e-9)))
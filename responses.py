@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+import os
+import threading
+
+
+class ResponseCatalog:
+    """
+    Holds the text of every file in the static responses directory in
+    memory so handlers never touch the disk when replying.
+
+    A file is read again only when its modification time changes, which
+    lets the responses be edited on a running bot. Any name listed in
+    required that has no matching file is reported when the catalog is
+    built rather than when a handler first asks for it.
+
+    """
+
+    def __init__(self, directory, required=()):
+        self.directory = directory
+        self.entries = {}
+        self.lock = threading.Lock()
+
+        for file_name in os.listdir(directory):
+            name, ext = os.path.splitext(file_name)
+            if ext == ".txt":
+                self.load(name)
+
+        missing = [name for name in required if name not in self.entries]
+        if missing:
+            raise IOError("Missing static responses in %s: %s" % (directory, ", ".join(sorted(missing))))
+
+    def get_path(self, name):
+        return os.path.join(self.directory, name + ".txt")
+
+    def load(self, name):
+        path = self.get_path(name)
+        mtime = os.stat(path).st_mtime
+        with io.open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        with self.lock:
+            self.entries[name] = (mtime, text)
+        return text
+
+    def get(self, name):
+        mtime, text = self.entries[name]
+        try:
+            if os.stat(self.get_path(name)).st_mtime != mtime:
+                return self.load(name)
+        except OSError:
+            # The file went away after startup; keep serving the last good copy.
+            pass
+        return text
+
+    def get_names(self):
+        return list(self.entries.keys())
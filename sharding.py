@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import telegram_interaction
+import async_mode
+import callbacks
+import ingestion
+import log_writer
+import metrics
+
+import argparse
+import asyncio
+import bisect
+import hashlib
+import multiprocessing
+import os
+import queue
+import signal
+
+# Runs the bot as several processes, so games in one chat don't wait on the GIL for games in
+# another: a front end takes Telegram's webhook posts and passes each update to the worker
+# that owns its chat, and every worker runs the bot on an event loop the way async_mode does,
+# for its own chats only. Each worker journals its chats under STATE_DIR/<worker>; the same
+# chat always goes to the same worker only while the number of workers stays the same, so
+# change it when no games are running.
+
+WORKERS = int(os.environ.get('WORKERS', str(os.cpu_count() or 1)))
+# Points each worker has on the hash ring; more spread the chats more evenly.
+REPLICAS = 100
+# Updates a worker takes off its queue at once.
+BATCH = 100
+
+
+def get_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hashing of chat ids onto shards. Each shard owns the arcs of
+    the ring that end at its points, so going from N shards to N + 1 moves
+    only about one chat in N + 1.
+    """
+
+    def __init__(self, shards, replicas=REPLICAS):
+        points = sorted((get_hash("%d-%d" % (shard, i)), shard) for shard in range(shards) for i in range(replicas))
+        self.hashes = [point[0] for point in points]
+        self.shards = [point[1] for point in points]
+
+    def get_shard(self, chat_id):
+        i = bisect.bisect(self.hashes, get_hash(str(chat_id)))
+        return self.shards[i % len(self.shards)]
+
+
+def get_chat_id(data):
+    """
+    Returns the chat whose game an update is for: the one in a hand
+    button's callback data, as those are tapped in private chats, or else
+    the one the update came from.
+    """
+    query = data.get("callback_query")
+    if query is not None:
+        token = callbacks.decode(query.get("data"))
+        if token is not None:
+            return token[0]
+        if query.get("message") is not None:
+            return query["message"]["chat"]["id"]
+        return query["from"]["id"]
+    for kind in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if data.get(kind) is not None:
+            return data[kind]["chat"]["id"]
+    return 0
+
+
+class ShardRouter:
+    """
+    Stands in for the dispatcher behind the front end's WebhookProtocol,
+    putting each update on the queue of the worker that owns its chat.
+    """
+
+    def __init__(self, queues):
+        self.queues = queues
+        self.ring = HashRing(len(queues))
+
+    def enqueue(self, data):
+        self.queues[self.ring.get_shard(get_chat_id(data))].put(data)
+
+    def get_depths(self):
+        return dict(((str(shard),), updates.qsize()) for shard, updates in enumerate(self.queues))
+
+    def get_queued(self):
+        return sum(updates.qsize() for updates in self.queues)
+
+
+def take(updates, size=BATCH):
+    # Waits for one update, then takes whatever else is already there.
+    batch = [updates.get()]
+    try:
+        while len(batch) < size:
+            batch.append(updates.get_nowait())
+    except queue.Empty:
+        pass
+    return batch
+
+
+async def consume(loop, updates, dispatcher):
+    while True:
+        for data in await loop.run_in_executor(None, take, updates):
+            if data is None:
+                return
+            dispatcher.process_update(data)
+
+
+def run_worker(shard, updates, api_url):
+    """
+    Runs one worker: handles the updates put on updates until it is given None.
+    Each worker keeps its own log, state and feedback files.
+    """
+    log_writer.setup_logging("logging-%d.txt" % shard)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    client, bot, dispatcher = async_mode.start(loop, telegram_interaction.TOKEN, api_url)
+    telegram_interaction.enable_persistence(bot, lambda chat_id: dispatcher.chat_data[chat_id],
+                                            lambda chat_id, fn, *args: bot.call_soon(fn, *args),
+                                            os.path.join(telegram_interaction.STATE_DIR, str(shard)))
+    telegram_interaction.move_log = telegram_interaction.MoveLog(telegram_interaction.MOVE_LOG_DIR)
+    telegram_interaction.feedback_store = log_writer.FeedbackStore("feedback-%d.jsonl" % shard)
+    loop.run_until_complete(consume(loop, updates, dispatcher))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the Uno bot as a front end and worker processes.")
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--api-url", default=telegram_interaction.BOT_API_URL)
+    args = parser.parse_args()
+
+    log_writer.setup_logging('logging.txt')
+
+    # Workers are started fresh rather than forked, so none inherits the front end's threads.
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue() for i in range(args.workers)]
+    workers = [context.Process(target=run_worker, args=(shard, updates, args.api_url), name="shard-%d" % shard,
+                               daemon=True) for shard, updates in enumerate(queues)]
+    for worker in workers:
+        worker.start()
+
+    router = ShardRouter(queues)
+    metrics.registry.add(metrics.Gauge("uno_shard_queue_depth", "Updates waiting for each worker.",
+                                       router.get_depths, ("shard",)))
+    admission = ingestion.Ingestion(router.get_queued, telegram_interaction.INGEST_CAPACITY * args.workers,
+                                    telegram_interaction.INGEST_POLICY, telegram_interaction.SHEDDABLE_COMMANDS)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(loop.create_server(
+        lambda: async_mode.WebhookProtocol(router, "/" + telegram_interaction.TOKEN, admission), "0.0.0.0",
+        telegram_interaction.PORT))
+    client = async_mode.BotAPIClient(telegram_interaction.TOKEN, args.api_url)
+    loop.run_until_complete(client.call("setWebhook", url=telegram_interaction.WEBHOOK_URL +
+                                        telegram_interaction.TOKEN))
+    # Daemon workers are only stopped when the front end exits normally, which SIGTERM skips.
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    loop.run_forever()
+
+    # Workers finish what is already on their queues first.
+    for updates in queues:
+        updates.put(None)
+    for worker in workers:
+        worker.join()
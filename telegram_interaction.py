@@ -2,13 +2,31 @@
 from __future__ import unicode_literals
 
 import uno
+import moves
+import events
+from responses import ResponseCatalog
+from outbox import coalesced, unwrap
+from fanout import FanOut
+from actor import ChatActors
+from timers import TimerWheel
+from persistence import Store
+from movelog import MoveLog
+from log_writer import setup_logging, FeedbackStore
+from profiler import Sampler
+from ingestion import IngestionQueue
+from ratelimit import OutboundScheduler, ScheduledBot, TURN, BACKGROUND
+import metrics
+from hand_messages import HandMessages
+import callbacks
 
 import telegram
 from telegram.ext import Updater, CommandHandler, CallbackQueryHandler
+from telegram.utils.webhookhandler import WebhookAppClass
+import tornado.web
 from telegram.error import TelegramError, Unauthorized
 import logging
 
-import sys, os, threading, time
+import sys, os, time
 
 # https://docs.google.com/document/d/11egPOVQx0rk9QYn6_hmUOVzY_TzZdpVGSUPND0AF_Z4/edit
 # https://github.com/python-telegram-bot/python-telegram-bot/wiki/Webhooks#heroku
@@ -18,41 +36,208 @@ with open("api_key.txt", 'r') as f:
 
 MIN_PLAYERS = 2
 THRESHOLD_PLAYERS = 10
+HAND_WORKERS = 8
+CHAT_WORKERS = 8
+UNPLAYABLE_CALLBACK = "x"
+UNO_PROMPT_DELAY = 5
 PORT = int(os.environ.get('PORT', '8443'))
+# Where the Bot API is and where Telegram should post updates; see fake_bot_api.py for local runs.
+BOT_API_URL = os.environ.get('BOT_API_URL', 'https://api.telegram.org/bot')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', 'https://la-uno-bot.herokuapp.com/')
+STATE_DIR = os.environ.get('STATE_DIR', 'state')
+MOVE_LOG_DIR = os.environ.get('MOVE_LOG_DIR', 'games')
+FEEDBACK_FILE = "feedback.jsonl"
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+# Updates that may wait to be handled before new ones are dropped; see ingestion.py.
+INGEST_CAPACITY = int(os.environ.get('INGEST_CAPACITY', '1000'))
+INGEST_POLICY = os.environ.get('INGEST_POLICY', 'shed')
+# Whether sends are paced to Telegram's rate limits; a fake Bot API doesn't need them.
+PACE_OUTBOUND = os.environ.get('PACE_OUTBOUND', '1') != '0'
+# Whoever may start and stop the profiler with /profile; nobody if unset.
+ADMIN_ID = int(os.environ.get('ADMIN_ID', '0')) or None
+
+STATIC_COMMANDS = ["start", "rules", "help"]
+REQUIRED_RESPONSES = STATIC_COMMANDS + [
+    "aa_arg_not_int", "aa_id_missing_failure", "aa_not_pending_failure", "end_game", "end_game_id_missing_failure",
+    "game_dne_failure", "game_ongoing", "game_pending", "hpt_arg_length_failure", "hpt_arg_not_int",
+    "hpt_id_missing_failure", "hpt_not_pending_failure", "hpt_removed", "invalid_nickname", "join_game_not_pending",
+    "leave_game_not_pending_failure", "leave_id_missing_failure", "listplayers_failure", "new_game",
+    "not_all_ready_failure", "ready_already_ready_failure", "ready_game_dne_failure", "ready_missing_failure",
+    "start_game", "start_game_failure", "start_game_id_missing_failure", "start_game_min_threshold",
+    "start_game_not_pending"]
+
+# Loaded once at startup; a missing file fails here instead of inside a handler.
+responses = ResponseCatalog("static_responses", REQUIRED_RESPONSES)
+
+# Hands are delivered to every player in parallel so a move doesn't wait on N round trips.
+hand_fanout = FanOut(HAND_WORKERS, name="hands")
+hand_messages = HandMessages()
+
+feedback_store = FeedbackStore(FEEDBACK_FILE)
+
+# Running games by id, for the hand buttons tapped in private chats.
+game_routes = callbacks.GameRoutes()
+
+# Every update, and every timer, for a chat runs on that chat's actor, so its game has one writer.
+chat_actors = ChatActors(CHAT_WORKERS, name="chats")
+
+# Deadlines for every game, on one thread, keyed by (kind, chat_id).
+chat_timers = TimerWheel(name="chat-timers")
+HPT = "hpt"
+UNO_PROMPT = "uno"
+
+# Samples handler stacks while running; started with /profile, or at startup if PROFILE is set.
+profiler = Sampler(PROFILE_DIR)
+
+# Where moves are journaled when the bot runs with persistence; see enable_persistence.
+store = None
+# Where each game's accepted actions are logged for replay.py, when set.
+move_log = None
 
 
 def static_handler(command):
-    text = open("static_responses/{}.txt".format(command), "r").read()
-
-    return CommandHandler(command,
-        lambda bot, update: bot.send_message(chat_id=update.message.chat.id, text=text))
+    return CommandHandler(command, metrics.timed(command,
+        lambda bot, update: bot.send_message(chat_id=update.message.chat.id, text=responses.get(command))))
+
+
+INVALID_PLAY_TEXT = {
+    events.NOT_BOOLEAN: "%s must be a Boolean value.",
+    events.INITIAL_CARD_PLAYED: "The starting card has already been played.",
+    events.NOT_YOUR_TURN: "It is not currently your turn!",
+    events.UNKNOWN_PLAYER: "You don't seem to exist!",
+    events.UNKNOWN_TARGET: "The player you chose doesn't seem to exist!",
+    events.NOT_IN_GAME: "You are not in the game!",
+    events.NO_SEVEN: "A seven is not on top of the played pile.",
+    events.SEVEN_WAITING: "You cannot swap! Waiting for %s to swap.",
+    events.SELF_SWAP: "You cannot swap hands with yourself!",
+    events.PLAY_SEVEN_WAITING: "You cannot play a card; waiting for %s to choose a player for swapping hands.",
+    events.PLAY_WILD_WAITING: "You cannot play a card; waiting for %s to set the wild color.",
+    events.PLAY_UNO_PENDING: "You cannot play a card; Uno is pending.",
+    events.PLAY_SEVEN_PENDING: "You cannot play a card; a seven is pending.",
+    events.NO_SUCH_CARD: "You cannot remove the card with this ID.",
+    events.INVALID_CARD: "This is not a valid card.",
+    events.DRAW_WILD_WAITING: "You cannot draw a card; waiting for %s to set the wild color.",
+    events.DRAW_UNO_PENDING: "You cannot draw a card; Uno is pending.",
+    events.DRAW_SEVEN_PENDING: "You cannot draw a card; a seven is pending.",
+    events.NO_WILD: "An uncolored Wild card is not on top of the played pile.",
+    events.WILD_WAITING: "You cannot set the wild color. Waiting for %s to set it.",
+    events.INVALID_COLOR: "That is not a valid color. Choose R, G, B, or Y."}
+
+DRAW_CARD_NAMES = {12: "draw two", 14: "draw four"}
+
+
+def render_invalid_play(e):
+    text = INVALID_PLAY_TEXT[e.reason]
+    return text % e.name if "%s" in text else text
+
+
+def render_uno_called(e):
+    if e.in_time:
+        return e.name + " called Uno first!"
+    return e.name + " didn't call Uno first! They've drawn a card."
+
+
+EVENT_RENDERERS = {
+    events.PlayerAdded: lambda e: e.name + " has been added to the game.",
+    events.GameSetUp: lambda e: "Everything has been set up. Waiting for players to /ready.",
+    events.InvalidPlay: render_invalid_play,
+    events.HandsRotated: lambda e: "Everyone's hands have rotated!",
+    events.SevenPending: lambda e: "Now choose a player with whom you'll swap hands using /seven [player_num]!",
+    events.WildPending: lambda e: "Now choose a color using /wild R, Y, G, or B!",
+    events.DirectionReversed: lambda e: "The direction of the game has been reversed!",
+    events.PlayerSkipped: lambda e: "The next player has been skipped!",
+    events.UnoCalled: render_uno_called,
+    events.StackMissed: lambda e: e.name + " failed to stack their " + DRAW_CARD_NAMES[e.value] + "!",
+    events.CannotStack: lambda e: e.name + " couldn't stack a " + DRAW_CARD_NAMES[e.value] + "!",
+    events.ForcedDraw: lambda e: e.name + " has to draw %d cards!" % e.count}
+
+
+def publish(bot, game):
+    """
+    Sends the events the game recorded during the move that just finished.
+    """
+    for event in game.drain_events():
+        bot.send_message(chat_id=game.chat_id, text=EVENT_RENDERERS[type(event)](event))
 
 
 def reset_chat_data(chat_data):
+    if chat_data.get("game_obj") is not None:
+        game_routes.remove(chat_data["game_obj"])
     chat_data["is_game_pending"] = False
     chat_data["pending_players"] = {}
     chat_data["game_obj"] = None
 
 
-def send_hand(bot, chat_id, game, user_id):
-    buttons = [[]]
-    hand = game.players.get(user_id).get_hand()
-    bucket = 0
+def render_hand(game, user_id):
+    player = game.players.get(user_id)
+    is_turn = player.get_id() == game.turn
+    top = game.get_topmost_card() if is_turn else None
+    # Off turn a hand renders the same whatever else happens, so it's only rebuilt when the hand
+    # changes; on turn, also when the top card does.
+    key = (player.get_version(), is_turn, top)
+    if player.rendered is not None and player.rendered[0] == key:
+        return player.get_version(), player.rendered[1], player.rendered[2]
+
+    hand = player.get_hand()
+    labels = player.get_labels()
+    # On the player's turn, cards they can't play are marked and answered without touching the game.
+    any_playable = is_turn and player.has_playable_card(top)
+    buttons = []
     for i in range(len(hand)):
-        if i > 0 and i % 3 == 0:
-            bucket += 1
+        if i % 3 == 0:
             buttons.append([])
-        buttons[bucket].append(telegram.InlineKeyboardButton(text="(" + str(i) + ") " + str(hand[i]),
-                                                             callback_data="!" + str(chat_id) + "!" + str(i)))
+        if is_turn and not (any_playable and game.deck.check_valid_play(hand[i])):
+            buttons[-1].append(telegram.InlineKeyboardButton(text=labels[i] + " ✗", callback_data=UNPLAYABLE_CALLBACK))
+        else:
+            buttons[-1].append(telegram.InlineKeyboardButton(
+                text=labels[i], callback_data=callbacks.encode(game.chat_id, game.seed, player.get_version(), i)))
+
+    # Only the current player's message carries the game state, so everyone else's
+    # message stays untouched until their own hand changes.
+    if is_turn:
+        text = "Your current hand:\n\n" + game.get_state() + "\n"
+    else:
+        text = "Your current hand:\n"
+
+    player.rendered = (key, text, telegram.InlineKeyboardMarkup(buttons or [[]]))
+    return player.get_version(), player.rendered[1], player.rendered[2]
+
+
+def send_hand(bot, chat_id, game, user_id):
+    return send_hands(bot, chat_id, game, {user_id: game.get_players()[user_id]})
 
-    bot.send_message(chat_id=user_id,
-                     text="Your current hand:\n\n" + game.get_state() + "\n",
-                     reply_markup=telegram.InlineKeyboardMarkup(buttons))
+
+def log_hand_failures(batch):
+    for user_id, error in batch.get_failures().items():
+        logging.getLogger(__name__).warning("Couldn't send a hand to %s: %s", user_id, error)
 
 
 def send_hands(bot, chat_id, game, players):
+    # Hands are rendered here, while the game can't change under us; only the sends run on the pool.
+    bot = unwrap(bot)
+
+    # A bot paced by Telegram's rate limits sends the current player's hand first, and a hand still
+    # waiting to go out is replaced by the newer one.
+    sequence = hand_messages.open_chat(chat_id)
+    submit = getattr(bot, "submit", None)
+    if submit is not None:
+        current = game.get_player_id_by_num(game.turn)
+        for user_id, nickname in players.items():
+            version, text, markup = render_hand(game, user_id)
+            submit(user_id, TURN if user_id == current else BACKGROUND, (chat_id, user_id), hand_messages.deliver,
+                   bot.bot, chat_id, user_id, version, text, markup, sequence)
+        return None
+
+    jobs = []
     for user_id, nickname in players.items():
-        send_hand(bot, chat_id, game, user_id)
+        version, text, markup = render_hand(game, user_id)
+        jobs.append((user_id, (bot, chat_id, user_id, version, text, markup, sequence)))
+
+    # A bot that runs on an event loop delivers hands itself, as coroutines.
+    fan_out = getattr(bot, "fan_out", None)
+    if fan_out is not None:
+        return fan_out(hand_messages.deliver_async, jobs, on_done=log_hand_failures)
+    return hand_fanout.submit(hand_messages.deliver, jobs, on_done=log_hand_failures)
 
 
 def newgame_handler(bot, update, chat_data):
@@ -62,11 +247,12 @@ def newgame_handler(bot, update, chat_data):
     if game is None and not chat_data.get("is_game_pending", False):
         reset_chat_data(chat_data)
         chat_data["is_game_pending"] = True
-        text = open("static_responses/new_game.txt", "r").read()
+        record(chat_id, chat_data, "newgame")
+        text = responses.get("new_game")
     elif game is not None:
-        text = open("static_responses/game_ongoing.txt", "r").read()
+        text = responses.get("game_ongoing")
     elif chat_data.get("is_game_pending", False):
-        text = open("static_responses/game_pending.txt", "r").read()
+        text = responses.get("game_pending")
     else:
         text = "Something has gone horribly wrong!"
 
@@ -97,7 +283,7 @@ def join_handler(bot, update, chat_data, args):
     user_id = update.message.from_user.id
 
     if not chat_data.get("is_game_pending", False):
-        text = open("static_responses/join_game_not_pending.txt", "r").read()
+        text = responses.get("join_game_not_pending")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
@@ -108,12 +294,13 @@ def join_handler(bot, update, chat_data, args):
 
     if is_nickname_valid(nickname, user_id, chat_data):
         chat_data["pending_players"][user_id] = nickname
+        record(chat_id, chat_data, "join", user_id, nickname)
         bot.send_message(chat_id=update.message.chat_id,
                          text="Joined with nickname %s!" % nickname)
         bot.send_message(chat_id=update.message.chat_id,
                          text="Current player count: %d" % len(chat_data.get("pending_players", {})))
     else:
-        text = open("static_responses/invalid_nickname.txt", "r").read()
+        text = responses.get("invalid_nickname")
         bot.send_message(chat_id=chat_id, text=text)
 
 
@@ -122,12 +309,14 @@ def leave_handler(bot, update, chat_data):
     user_id = update.message.from_user.id
 
     if not chat_data.get("is_game_pending", False):
-        text = open("static_responses/leave_game_not_pending_failure.txt", "r").read()
+        text = responses.get("leave_game_not_pending_failure")
     elif user_id not in chat_data.get("pending_players", {}):
-        text = open("static_responses/leave_id_missing_failure.txt", "r").read()
+        text = responses.get("leave_id_missing_failure")
     else:
         text = "You have left the current game."
         del chat_data["pending_players"][update.message.from_user.id]
+        hand_messages.forget(chat_id, user_id)
+        record(chat_id, chat_data, "leave", user_id)
 
     bot.send_message(chat_id=chat_id, text=text)
 
@@ -145,7 +334,7 @@ def listplayers_handler(bot, update, chat_data):
             num_cards_str = str(len(game.get_player(user_id).get_hand()))
             text += "(" + str(game.get_player(user_id).get_id()) + ") " + name + " - Cards: " + num_cards_str + "\n"
     else:
-        text = open("static_responses/listplayers_failure.txt", "r").read()
+        text = responses.get("listplayers_failure")
 
     bot.send_message(chat_id=chat_id, text=text)
 
@@ -153,55 +342,87 @@ def listplayers_handler(bot, update, chat_data):
 # Thanks Amrita!
 def feedback_handler(bot, update, args):
     """
-    Store feedback from users in a text file.
+    Store feedback from users in a JSON-lines file.
     """
     if args and len(args) > 0:
-        feedback = open("feedback.txt\n", "a+")
-        feedback.write(update.message.from_user.first_name + "\n")
         # Records User ID so that if feature is implemented, can message them
         # about it.
-        feedback.write(str(update.message.from_user.id) + "\n")
-        feedback.write(" ".join(args) + "\n")
-        feedback.close()
+        feedback_store.add(update.message.from_user.id, update.message.from_user.first_name, " ".join(args))
         bot.send_message(chat_id=update.message.chat_id, text="Thanks for the feedback!")
     else:
         bot.send_message(chat_id=update.message.chat_id, text="Format: /feedback [feedback]")
 
 
+def profile_handler(bot, update, args):
+    """
+    Lets the admin start and stop the profiler without restarting the bot.
+    """
+    chat_id = update.message.chat_id
+    if ADMIN_ID is None or update.message.from_user.id != ADMIN_ID:
+        return
+
+    if args == ["start"]:
+        if profiler.start():
+            bot.send_message(chat_id=chat_id, text="Profiling every %gs." % profiler.interval)
+        else:
+            bot.send_message(chat_id=chat_id, text="Already profiling.")
+    elif args == ["stop"]:
+        if not profiler.is_running():
+            bot.send_message(chat_id=chat_id, text="Not profiling.")
+            return
+        written = profiler.stop()
+        lines = ["%d samples over %ds." % (profiler.samples, time.time() - profiler.started)]
+        for handler, samples, path in written:
+            lines.append("%s: %d (%s)" % (handler, samples, path))
+        bot.send_message(chat_id=chat_id, text="\n".join(lines))
+    else:
+        bot.send_message(chat_id=chat_id, text="Format: /profile [start|stop]")
+
+
 def startgame_handler(bot, update, chat_data):
     chat_id = update.message.chat_id
     user_id = update.message.from_user.id
     pending_players = chat_data.get("pending_players", {})
 
     if not chat_data.get("is_game_pending", False):
-        text = open("static_responses/start_game_not_pending.txt", "r").read()
+        text = responses.get("start_game_not_pending")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
     if user_id not in chat_data.get("pending_players", {}):
-        text = open("static_responses/start_game_id_missing_failure.txt", "r").read()
+        text = responses.get("start_game_id_missing_failure")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
     if len(pending_players) < MIN_PLAYERS:
-        text = open("static_responses/start_game_min_threshold.txt", "r").read()
+        text = responses.get("start_game_min_threshold")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
+    # Sent right away, past the outbox and the rate limits, so a player who hasn't messaged the bot is caught here.
+    send_now = getattr(unwrap(bot), "send_now", unwrap(bot).send_message)
     try:
         for user_id, nickname in pending_players.items():
-            bot.send_message(chat_id=user_id, text="Trying to start game!")
+            send_now(chat_id=user_id, text="Trying to start game!")
     except Unauthorized as u:
-        text = open("static_responses/start_game_failure.txt", "r").read()
+        text = responses.get("start_game_failure")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
+    game = start_game(chat_id, chat_data)
+    record(chat_id, chat_data, "start", game.seed)
+    publish(bot, game)
+
+
+def start_game(chat_id, chat_data, seed=None):
     chat_data["is_game_pending"] = False
-    chat_data["game_obj"] = uno.Game(chat_id, pending_players)
+    chat_data["game_obj"] = uno.Game(chat_id, chat_data.get("pending_players", {}), seed)
     game = chat_data.get("game_obj")
 
     game.set_hpt_lap(chat_data.get("hpt_lap", -1))
     game.set_advanced_rules(chat_data.get("aa_rules", False))
+    game_routes.add(game, chat_id, chat_data)
+    return game
 
 
 def after_ready_startgame(bot, update, chat_data):
@@ -209,40 +430,43 @@ def after_ready_startgame(bot, update, chat_data):
     chat_id = update.message.chat_id
     pending_players = chat_data.get("pending_players", {})
 
-    text = open("static_responses/start_game.txt", "r").read()
+    text = responses.get("start_game")
     bot.send_message(chat_id=chat_id, text=text)
     game.play_initial_card()
+    publish(bot, game)
+    if move_log is not None:
+        move_log.start(game)
     bot.send_message(chat_id=chat_id, text=game.get_state())
 
+    hand_messages.forget_chat(chat_id)
     send_hands(bot, chat_id, game, pending_players)
 
     if game.get_hpt_lap() > 0:
-        chat_data["hpt"] = threading.Timer(game.get_hpt_lap(), hpt_turn, [bot, update, chat_data]).start()
+        start_hpt_timer(bot, chat_id, chat_data)
 
 
-def ready_handler(bot, update, chat_data, user_data):
+def ready_handler(bot, update, chat_data):
     chat_id = update.message.chat_id
     user_id = update.message.from_user.id
     game = chat_data.get("game_obj")
     players_and_ready = game.get_players_and_ready()
 
-    user_data["uno_chat_data"] = chat_data
-    user_data["uno_bot"] = bot
-    user_data["uno_update"] = update
-
     if not game:
-        text = open("static_responses/ready_game_dne_failure.txt", "r").read()
+        text = responses.get("ready_game_dne_failure")
     elif user_id not in chat_data.get("pending_players", {}):
-        text = open("static_responses/ready_missing_failure.txt", "r").read()
+        text = responses.get("ready_missing_failure")
     elif players_and_ready[user_id]:
-        text = open("static_responses/ready_already_ready_failure.txt", "r").read()
+        text = responses.get("ready_already_ready_failure")
     else:
         text = chat_data.get("pending_players", {})[user_id] + " is ready to play!"
         players_and_ready[user_id] = True
+        record(chat_id, chat_data, "ready", user_id)
 
     bot.send_message(chat_id=chat_id, text=text)
-    if all(ready for ready in players_and_ready.values()):
+    # Only the last player to ready up starts the game; a repeated /ready mustn't start it again.
+    if not game.get_ready_to_play() and all(ready for ready in players_and_ready.values()):
         game.set_ready_to_play(True)
+        publish(bot, game)
         after_ready_startgame(bot, update, chat_data)
 
 
@@ -253,22 +477,33 @@ def endgame_handler(bot, update, chat_data):
 
     if chat_data.get("is_game_pending", False):
         chat_data["is_game_pending"] = False
-        text = open("static_responses/end_game.txt", "r").read()
+        record(chat_id, chat_data, "end")
+        text = responses.get("end_game")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
     if game is None:
-        text = open("static_responses/game_dne_failure.txt", "r").read()
+        text = responses.get("game_dne_failure")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
     if user_id not in game.players_and_names:
-        text = open("static_responses/end_game_id_missing_failure.txt", "r").read()
+        text = responses.get("end_game_id_missing_failure")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
+    end_game(bot, chat_id, chat_data)
+
+
+def end_game(bot, chat_id, chat_data):
+    chat_timers.cancel((HPT, chat_id))
+    chat_timers.cancel((UNO_PROMPT, chat_id))
+    if move_log is not None:
+        move_log.finish(chat_data.get("game_obj"))
+    hand_messages.forget_chat(chat_id)
     reset_chat_data(chat_data)
-    text = open("static_responses/end_game.txt", "r").read()
+    record(chat_id, chat_data, "end")
+    text = responses.get("end_game")
     bot.send_message(chat_id=chat_id, text=text)
 
 
@@ -278,59 +513,68 @@ def draw_handler(bot, update, chat_data):
     game = chat_data.get("game_obj")
 
     if game is None:
-        text = open("static_responses/game_dne_failure.txt", "r").read()
+        text = responses.get("game_dne_failure")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
     if not game.get_ready_to_play():
-        text = open("static_responses/not_all_ready_failure.txt", "r").read()
+        text = responses.get("not_all_ready_failure")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
     winner = game.check_for_win()
     if winner is not None:
         bot.send_message(chat_id=chat_id, text=game.players_and_names[winner] + " has won!")
-        endgame_handler(bot, update, chat_data)
+        end_game(bot, chat_id, chat_data)
         return
 
-    result = game.draw_and_continue(user_id)
-    if not result:
+    outcome = moves.draw(game, user_id)
+    if outcome != moves.REJECTED:
+        record(chat_id, chat_data, "draw", user_id)
+    publish(bot, game)
+    if outcome == moves.REJECTED:
         return
 
-    if not game.is_advanced_rules():
-        game.next_turn(1)
+    if outcome == moves.ADVANCED:
         bot.send_message(chat_id=chat_id, text=game.players_and_names[user_id] + " has drawn a card!")
         bot.send_message(chat_id=chat_id, text=game.get_state())
         send_hands(bot, chat_id, game, game.get_players())
     else:
         bot.send_message(chat_id=chat_id, text=game.players_and_names[user_id] + " has drawn " +
                                                str(game.last_num_cards_drawn) + " cards!")
-        bot.send_message(chat_id=user_id, text=game.get_state())
         send_hand(bot, chat_id, game, user_id)
 
 
 def play_handler(bot, update, chat_data, args):
     chat_id = update.message.chat.id
     user_id = update.message.from_user.id
-    game = chat_data.get("game_obj")
 
     if len(args) != 1:
         bot.send_message(chat_id=chat_id, text="Usage: /play card_id")
         return
 
+    play_card(bot, chat_id, chat_data, user_id, int(" ".join(args)))
+
+
+def play_card(bot, chat_id, chat_data, user_id, card_id):
+    game = chat_data.get("game_obj")
+
     if game is None:
-        text = open("static_responses/game_dne_failure.txt", "r").read()
+        text = responses.get("game_dne_failure")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
     if not game.get_ready_to_play():
-        text = open("static_responses/not_all_ready_failure.txt", "r").read()
+        text = responses.get("not_all_ready_failure")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
-    valid = game.play_card(user_id, int(" ".join(args)))
+    outcome = moves.play(game, user_id, card_id)
+    if outcome != moves.REJECTED:
+        record(chat_id, chat_data, "play", user_id, card_id)
+    publish(bot, game)
 
-    if not valid:
+    if outcome == moves.REJECTED:
         return
 
     player = game.get_player(user_id)
@@ -340,91 +584,94 @@ def play_handler(bot, update, chat_data, args):
         return
 
     if len(player.get_hand()) == 1:
-        game.set_uno_pending(True, user_id)
-        name = game.players_and_names[user_id]
-        # Gives the player playing from their hand time to switch to the main Uno chat.
-        time.sleep(5)
-        bot.send_message(chat_id=chat_id,
-                         text=name + " has Uno! Click the button to call it!",
-                         reply_markup=telegram.InlineKeyboardMarkup(
-                             [[telegram.InlineKeyboardButton(text="Uno", callback_data=user_id)]]))
+        start_uno_prompt(bot, chat_id, chat_data, game, user_id)
 
-    winner = game.check_for_win()
-    if winner is not None:
+    if outcome == moves.WON:
         bot.send_message(chat_id=chat_id, text="Last Card Played: " + str(game.get_topmost_card()))
-        bot.send_message(chat_id=chat_id, text=game.players_and_names[winner] + " has won!")
-        endgame_handler(bot, update, chat_data)
+        bot.send_message(chat_id=chat_id, text=game.players_and_names[game.check_for_win()] + " has won!")
+        end_game(bot, chat_id, chat_data)
         return
 
-    if game.is_uno_pending() or game.is_wild_pending() or (game.advanced_rules and game.is_seven_pending()):
+    if outcome == moves.WAITING:
         if game.get_hpt_lap() > 0:
-            chat_data.get("hpt").cancel()
+            chat_timers.cancel((HPT, chat_id))
         return
 
-    game.next_turn(1)
-    if game.is_skip_pending():
-        bot.send_message(chat_id=chat_id, text="The next player has been skipped!\n")
-        game.next_turn(1)
-        game.set_skip_pending(False)
     bot.send_message(chat_id=chat_id, text=game.get_state())
 
     send_hands(bot, chat_id, game, game.get_players())
 
     if game.get_hpt_lap() > 0:
-        chat_data.get("hpt").cancel()
-        chat_data["hpt"] = threading.Timer(game.get_hpt_lap(), hpt_turn, [bot, update, chat_data]).start()
+        start_hpt_timer(bot, chat_id, chat_data)
 
 
-def button_handler(bot, update, chat_data, user_data):
+def button_handler(bot, update, chat_data):
     query = update.callback_query
     chat_id = query.message.chat_id
     user_id = int(query.from_user.id)
 
     game = chat_data.get("game_obj")
 
-    if query.data[0] == "!":
-        split_callback_data = query.data.split("!")
-        card = game.get_player(user_id).get_hand()[int(split_callback_data[2])]
-        bot.send_message(chat_id=chat_id, text=game.players_and_names[user_id] + " played a " + str(card) + ".")
-        play_handler(bot, user_data["uno_update"], user_data["uno_chat_data"], [split_callback_data[2]])
+    if query.data == UNPLAYABLE_CALLBACK:
+        bot.answer_callback_query(query.id, text="This is not a valid card.")
+        return
+
+    if query.data.startswith(callbacks.PREFIX):
+        card_button(bot, query)
         return
 
     if game is None:
-        text = open("static_responses/game_dne_failure.txt", "r").read()
+        text = responses.get("game_dne_failure")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
     if not game.get_ready_to_play():
-        text = open("static_responses/not_all_ready_failure.txt", "r").read()
+        text = responses.get("not_all_ready_failure")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
     if game.is_uno_pending():
-        person_with_uno_id = int(query.data)
-
-        result = game.check_uno_caller(user_id)
-        if result == -1:
+        outcome = moves.call_uno(game, user_id)
+        if outcome != moves.REJECTED:
+            record(chat_id, chat_data, "uno", user_id)
+        publish(bot, game)
+        if outcome == moves.REJECTED:
             return
-        elif result == 0:
-            name = game.players_and_names[person_with_uno_id]
-            bot.send_message(chat_id=chat_id, text=name + " didn't call Uno first! They've drawn a card.")
-        elif result == 1:
-            name = game.players_and_names[person_with_uno_id]
-            bot.send_message(chat_id=chat_id, text=name + " called Uno first!")
-
-        if not game.is_wild_pending() and not game.is_seven_pending():
-            game.next_turn(1)
-            if game.is_skip_pending():
-                bot.send_message(chat_id=chat_id, text="The next player has been skipped!\n")
-                game.next_turn(1)
-                game.set_skip_pending(False)
+
+        if outcome == moves.ADVANCED:
             bot.send_message(chat_id=chat_id, text=game.get_state())
 
             send_hands(bot, chat_id, game, game.get_players())
 
     if game.get_hpt_lap() > 0:
-        chat_data.get("hpt").cancel()
-        chat_data["hpt"] = threading.Timer(game.get_hpt_lap(), hpt_turn, [bot, update, chat_data]).start()
+        start_hpt_timer(bot, chat_id, chat_data)
+
+
+def card_button(bot, query):
+    """
+    Plays the card on a tapped hand button, unless the button is from a game that has ended, from
+    someone else's hand, or from an older version of the player's hand, whose slots may have moved.
+    """
+    token = callbacks.decode(query.data)
+    route = game_routes.get(token[1]) if token is not None else None
+    if route is None or route[0] != token[0]:
+        bot.answer_callback_query(query.id, text="This game is over.")
+        return
+
+    chat_id, chat_data, game = route
+    user_id = int(query.from_user.id)
+    player = game.get_player(user_id)
+    if player is None:
+        bot.answer_callback_query(query.id, text="This is not your hand.")
+        return
+    if player.get_version() != token[2] or token[3] >= len(player.get_hand()):
+        bot.answer_callback_query(query.id, text="This hand is out of date. Use the newest one.")
+        return
+
+    bot.answer_callback_query(query.id)
+    card = player.get_hand()[token[3]]
+    bot.send_message(chat_id=chat_id, text=game.players_and_names[user_id] + " played a " + str(card) + ".")
+    play_card(bot, chat_id, chat_data, user_id, token[3])
 
 
 def wild_handler(bot, update, chat_data, args):
@@ -433,31 +680,33 @@ def wild_handler(bot, update, chat_data, args):
     game = chat_data.get("game_obj")
 
     if game is None:
-        text = open("static_responses/game_dne_failure.txt", "r").read()
+        text = responses.get("game_dne_failure")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
     if not game.get_ready_to_play():
-        text = open("static_responses/not_all_ready_failure.txt", "r").read()
+        text = responses.get("not_all_ready_failure")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
     winner = game.check_for_win()
     if winner is not None:
         bot.send_message(chat_id=chat_id, text=game.players_and_names[winner] + " has won!")
-        endgame_handler(bot, update, chat_data)
+        end_game(bot, chat_id, chat_data)
         return
 
-    result = game.set_wild_color(user_id, " ".join(args))
-    if result and not game.is_uno_pending() and not game.is_seven_pending():
-        game.next_turn(1)
+    color = " ".join(args)
+    outcome = moves.wild(game, user_id, color)
+    if outcome != moves.REJECTED:
+        record(chat_id, chat_data, "wild", user_id, color)
+    publish(bot, game)
+    if outcome == moves.ADVANCED:
         bot.send_message(chat_id=chat_id, text=game.get_state())
 
         send_hands(bot, chat_id, game, game.get_players())
 
         if game.get_hpt_lap() > 0:
-            chat_data.get("hpt").cancel()
-            chat_data["hpt"] = threading.Timer(game.get_hpt_lap(), hpt_turn, [bot, update, chat_data]).start()
+            start_hpt_timer(bot, chat_id, chat_data)
 
 
 def hand_handler(bot, update, chat_data):
@@ -466,12 +715,14 @@ def hand_handler(bot, update, chat_data):
     game = chat_data.get("game_obj")
 
     if game is None:
-        text = open("static_responses/game_dne_failure.txt", "r").read()
+        text = responses.get("game_dne_failure")
     elif not game.get_ready_to_play():
-        text = open("static_responses/not_all_ready_failure.txt", "r").read()
+        text = responses.get("not_all_ready_failure")
     elif user_id not in game.players_and_names:
-        text = open("static_responses/leave_id_missing_failure.txt", "r").read()
+        text = responses.get("leave_id_missing_failure")
     else:
+        # Asked for explicitly, so post a new message rather than editing one further up.
+        hand_messages.forget(chat_id, user_id)
         send_hand(bot, chat_id, game, user_id)
         return
 
@@ -483,59 +734,98 @@ def hpt_handler(bot, update, chat_data, args):
     user_id = update.message.from_user.id
 
     if not chat_data.get("is_game_pending", False):
-        text = open("static_responses/hpt_not_pending_failure.txt", "r").read()
+        text = responses.get("hpt_not_pending_failure")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
     if len(args) != 1:
-        text = open("static_responses/hpt_arg_length_failure.txt", "r").read()
+        text = responses.get("hpt_arg_length_failure")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
     if user_id not in chat_data.get("pending_players", {}):
-        text = open("static_responses/hpt_id_missing_failure.txt", "r").read()
+        text = responses.get("hpt_id_missing_failure")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
     try:
         hpt_lap = int(args[0])
     except ValueError:
-        text = open("static_responses/hpt_arg_not_int.txt", "r").read()
+        text = responses.get("hpt_arg_not_int")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
     chat_data["hpt_lap"] = hpt_lap
+    record(chat_id, chat_data, "hpt", hpt_lap)
     if hpt_lap <= 0:
-        text = open("static_responses/hpt_removed.txt")
+        text = responses.get("hpt_removed")
     else:
         text = "A Hot Potato timer of %d seconds per turn was added to the game." % hpt_lap
 
     bot.send_message(chat_id=chat_id, text=text)
 
 
-def hpt_turn(bot, update, chat_data):
-    chat_id = update.message.chat_id
+def start_hpt_timer(bot, chat_id, chat_data):
+    # The deadline outlives this update's outbox, so it keeps the real bot.
+    chat_timers.schedule((HPT, chat_id), chat_data.get("game_obj").get_hpt_lap(), post_to_chat, unwrap(bot), chat_id,
+                         chat_data, hpt_turn)
+
+
+def post_to_chat(generation, bot, chat_id, chat_data, fn, *args):
+    # Runs on the timer thread; fn itself runs on the chat's actor, or on the loop for a bot that runs on one.
+    call_soon = getattr(bot, "call_soon", None)
+    if call_soon is not None:
+        call_soon(fn, bot, chat_id, chat_data, generation, *args)
+    else:
+        chat_actors.tell(chat_id, fn, bot, chat_id, chat_data, generation, *args)
+
+
+@coalesced
+def hpt_turn(bot, chat_id, chat_data, generation):
     game = chat_data.get("game_obj")
 
-    if game is None:
+    # A move may have restarted or stopped the timer while this deadline waited for the chat.
+    if game is None or not chat_timers.is_current((HPT, chat_id), generation):
         return
 
     winner = game.check_for_win()
     if winner is not None:
         bot.send_message(chat_id=chat_id, text=game.players_and_names[winner] + " has won!")
-        endgame_handler(bot, update, chat_data)
+        end_game(bot, chat_id, chat_data)
         return
 
-    if game.is_uno_pending() or game.is_wild_pending():
+    outcome = moves.timeout(game)
+    publish(bot, game)
+    if outcome == moves.WAITING:
         return
+    record(chat_id, chat_data, "timeout")
 
-    game.draw_and_continue(game.get_player_id_by_num(game.turn))
-    game.next_turn(1)
     bot.send_message(chat_id=chat_id, text="Time's up! You had to draw a card.")
     bot.send_message(chat_id=chat_id, text=game.get_state())
     send_hands(bot, chat_id, game, game.get_players())
 
-    chat_data["hpt"] = threading.Timer(game.get_hpt_lap(), hpt_turn, [bot, update, chat_data]).start()
+    start_hpt_timer(bot, chat_id, chat_data)
+
+
+def start_uno_prompt(bot, chat_id, chat_data, game, user_id):
+    # Gives the player playing from their hand time to switch to the main Uno chat.
+    chat_timers.schedule((UNO_PROMPT, chat_id), UNO_PROMPT_DELAY, post_to_chat, unwrap(bot), chat_id, chat_data,
+                         uno_prompt, game, user_id)
+
+
+@coalesced
+def uno_prompt(bot, chat_id, chat_data, generation, game, user_id):
+    # Only if it's still the same game and nobody has called Uno on this card since.
+    if chat_data.get("game_obj") is not game or not chat_timers.is_current((UNO_PROMPT, chat_id), generation):
+        return
+    if not game.is_uno_pending() or game.get_uno_pending_id() != user_id:
+        return
+
+    name = game.players_and_names[user_id]
+    bot.send_message(chat_id=chat_id,
+                     text=name + " has Uno! Click the button to call it!",
+                     reply_markup=telegram.InlineKeyboardMarkup(
+                         [[telegram.InlineKeyboardButton(text="Uno", callback_data=user_id)]]))
 
 
 def blame_handler(bot, update, chat_data):
@@ -543,20 +833,19 @@ def blame_handler(bot, update, chat_data):
     game = chat_data.get("game_obj")
 
     if game is None:
-        text = open("static_responses/game_dne_failure.txt", "r").read()
+        text = responses.get("game_dne_failure")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
     if not game.get_ready_to_play():
-        text = open("static_responses/not_all_ready_failure.txt", "r").read()
+        text = responses.get("not_all_ready_failure")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
-    for user_id, nickname in game.get_players().items():
-        if game.get_player_id_by_num(game.turn) == user_id:
-            bot.send_message(chat_id=chat_id, text="[{}](tg://user?id={})".format(nickname, user_id),
-                             parse_mode=telegram.ParseMode.MARKDOWN)
-            return
+    user_id = game.get_player_id_by_num(game.turn)
+    nickname = game.get_players()[user_id]
+    bot.send_message(chat_id=chat_id, text="[{}](tg://user?id={})".format(nickname, user_id),
+                     parse_mode=telegram.ParseMode.MARKDOWN)
 
 
 def seven_handler(bot, update, chat_data, args):
@@ -565,43 +854,44 @@ def seven_handler(bot, update, chat_data, args):
     game = chat_data.get("game_obj")
 
     if game is None:
-        text = open("static_responses/game_dne_failure.txt", "r").read()
+        text = responses.get("game_dne_failure")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
     if not game.get_ready_to_play():
-        text = open("static_responses/not_all_ready_failure.txt", "r").read()
+        text = responses.get("not_all_ready_failure")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
     winner = game.check_for_win()
     if winner is not None:
         bot.send_message(chat_id=chat_id, text=game.players_and_names[winner] + " has won!")
-        endgame_handler(bot, update, chat_data)
+        end_game(bot, chat_id, chat_data)
         return
 
     try:
         num = int(" ".join(args))
     except ValueError:
-        text = open("static_responses/aa_arg_not_int.txt", "r").read()
+        text = responses.get("aa_arg_not_int")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
     user_id_2 = game.get_player_id_by_num(num)
-    result = game.play_seven(user_id, user_id_2)
-    if result and not game.is_uno_pending() and not game.is_wild_pending():
+    outcome = moves.seven(game, user_id, num)
+    if outcome != moves.REJECTED:
+        record(chat_id, chat_data, "seven", user_id, num)
+    publish(bot, game)
+    if outcome == moves.ADVANCED:
         name_1 = game.players_and_names[user_id]
         name_2 = game.players_and_names[user_id_2]
         bot.send_message(chat_id=chat_id, text=name_1 + " swapped hands with " + name_2 + "!")
 
-        game.next_turn(1)
         bot.send_message(chat_id=chat_id, text=game.get_state())
 
         send_hands(bot, chat_id, game, game.get_players())
 
         if game.get_hpt_lap() > 0:
-            chat_data.get("hpt").cancel()
-            chat_data["hpt"] = threading.Timer(game.get_hpt_lap(), hpt_turn, [bot, update, chat_data]).start()
+            start_hpt_timer(bot, chat_id, chat_data)
 
 
 def advanced_rules_handler(bot, update, chat_data):
@@ -609,22 +899,95 @@ def advanced_rules_handler(bot, update, chat_data):
     user_id = update.message.from_user.id
 
     if not chat_data.get("is_game_pending", False):
-        text = open("static_responses/aa_not_pending_failure.txt", "r").read()
+        text = responses.get("aa_not_pending_failure")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
     if user_id not in chat_data.get("pending_players", {}):
-        text = open("static_responses/aa_id_missing_failure.txt", "r").read()
+        text = responses.get("aa_id_missing_failure")
         bot.send_message(chat_id=chat_id, text=text)
         return
 
     chat_data["aa_rules"] = not chat_data.get("aa_rules", False)
+    record(chat_id, chat_data, "aa")
     if chat_data["aa_rules"]:
         bot.send_message(chat_id=chat_id, text="The game is using the advanced rules!")
     else:
         bot.send_message(chat_id=chat_id, text="The game is no longer using the advanced rules!")
 
 
+def record(chat_id, chat_data, op, *args):
+    """
+    Called right after a change to a chat's state; moves are only recorded once accepted.
+    """
+    if store is not None:
+        store.record(chat_id, chat_data, op, *args)
+    if move_log is not None and op in REPLAYED_MOVES:
+        move_log.record(chat_data.get("game_obj"), op, *args)
+
+
+REPLAYED_MOVES = {"draw": moves.draw, "play": moves.play, "uno": moves.call_uno, "wild": moves.wild,
+                  "seven": moves.seven, "timeout": moves.timeout}
+
+
+def replay(chat_id, chat_data, op, args):
+    """
+    Redoes one journaled change to a chat while recovering, without sending anything.
+    """
+    if op == "newgame":
+        reset_chat_data(chat_data)
+        chat_data["is_game_pending"] = True
+    elif op == "join":
+        chat_data["pending_players"][args[0]] = args[1]
+    elif op == "leave":
+        del chat_data["pending_players"][args[0]]
+    elif op == "hpt":
+        chat_data["hpt_lap"] = args[0]
+    elif op == "aa":
+        chat_data["aa_rules"] = not chat_data.get("aa_rules", False)
+    elif op == "start":
+        start_game(chat_id, chat_data, args[0])
+    elif op == "end":
+        if chat_data.get("is_game_pending", False):
+            chat_data["is_game_pending"] = False
+        else:
+            reset_chat_data(chat_data)
+    else:
+        game = chat_data.get("game_obj")
+        if op == "ready":
+            players_and_ready = game.get_players_and_ready()
+            players_and_ready[args[0]] = True
+            if all(ready for ready in players_and_ready.values()):
+                game.set_ready_to_play(True)
+                game.play_initial_card()
+        else:
+            REPLAYED_MOVES[op](game, *args)
+
+    if chat_data.get("game_obj") is not None:
+        chat_data["game_obj"].drain_events()
+
+
+def enable_persistence(bot, chat_data_for, post, directory=STATE_DIR):
+    """
+    Recovers every chat saved in directory into the dicts chat_data_for(chat_id)
+    returns and journals moves from then on. post(chat_id, fn, *args) runs fn
+    where the chat's updates run.
+    """
+    global store
+    store = Store(directory, replay, post)
+    for chat_id in store.recover(chat_data_for):
+        chat_data = chat_data_for(chat_id)
+        game = chat_data.get("game_obj")
+        if game is None:
+            continue
+        game_routes.add(game, chat_id, chat_data)
+        # Timers aren't saved, so the ones the game was waiting on start over.
+        if game.get_ready_to_play() and game.get_hpt_lap() > 0:
+            start_hpt_timer(bot, chat_id, chat_data)
+        if game.is_uno_pending():
+            start_uno_prompt(bot, chat_id, chat_data, game, game.get_uno_pending_id())
+
+
 def handle_error(bot, update, error):
     try:
         raise error
@@ -632,77 +995,192 @@ def handle_error(bot, update, error):
         logging.getLogger(__name__).warning('Telegram Error! %s caused by this update: %s', error, update)
 
 
-if __name__ == "__main__":
-    # Set up the bot
+join_aliases = ["join"]
+leave_aliases = ["leave", "unjoin"]
+listplayers_aliases = ["listplayers", "list"]
+draw_aliases = ["draw", "d", "itsasadday", "f"]
+play_aliases = ["play", "p"]
+wild_aliases = ["wild", "w"]
+feedback_aliases = ["feedback"]
+newgame_aliases = ["newgame"]
+startgame_aliases = ["startgame"]
+endgame_aliases = ["endgame"]
+hand_aliases = ["hand"]
+hpt_aliases = ["hpt", "hotpotato"]
+ready_aliases = ["ready", "r"]
+seven_aliases = ["seven", "s", "swap"]
+aa_aliases = ["advancedrules", "aa"]
+profile_aliases = ["profile"]
+
+# Commands that only answer with text, so dropping one under load loses nothing but the answer.
+SHEDDABLE_COMMANDS = STATIC_COMMANDS + listplayers_aliases + hand_aliases
+
+# (handler name, what the handler is passed, aliases). 0 passes args, 1 chat_data,
+# 2 chat_data and args.
+commands = [("feedback", 0, feedback_aliases),
+            ("newgame", 1, newgame_aliases),
+            ("join", 2, join_aliases),
+            ("leave", 1, leave_aliases),
+            ("listplayers", 1, listplayers_aliases),
+            ("startgame", 1, startgame_aliases),
+            ("endgame", 1, endgame_aliases),
+            ("draw", 1, draw_aliases),
+            ("play", 2, play_aliases),
+            ("wild", 2, wild_aliases),
+            ("hand", 1, hand_aliases),
+            ("hpt", 2, hpt_aliases),
+            ("ready", 1, ready_aliases),
+            ("seven", 2, seven_aliases),
+            ("advanced_rules", 1, aa_aliases),
+            ("profile", 0, profile_aliases)]
+
+
+def chat_key(update):
+    # Hand buttons are tapped in the player's private chat but belong to the game's chat.
+    query = update.callback_query
+    token = callbacks.decode(query.data) if query is not None else None
+    if token is not None:
+        return token[0]
+    return update.effective_chat.id
+
+
+def run_handler(handler, bot, update, *args, **kwargs):
+    try:
+        handler(bot, update, *args, **kwargs)
+    except TelegramError as e:
+        handle_error(bot, update, e)
+
+
+def on_chat_actor(handler):
+    """
+    Makes the dispatcher hand the update to its chat's actor instead of running the handler itself.
+    """
+    # python-telegram-bot passes chat_data, user_data and args by keyword.
+    def tell(bot, update, *args, **kwargs):
+        chat_actors.tell(chat_key(update), run_handler, handler, bot, update, *args, **kwargs)
+    return tell
 
-    bot = telegram.Bot(token=TOKEN)
-    updater = Updater(token=TOKEN)
-    dispatcher = updater.dispatcher
 
+def register_handlers(dispatcher):
     # Static command handlers
 
-    static_commands = ["start", "rules", "help"]
-    for c in static_commands:
+    for c in STATIC_COMMANDS:
         dispatcher.add_handler(static_handler(c))
 
     # Main command handlers
 
-    join_aliases = ["join"]
-    leave_aliases = ["leave", "unjoin"]
-    listplayers_aliases = ["listplayers", "list"]
-    draw_aliases = ["draw", "d", "itsasadday", "f"]
-    play_aliases = ["play", "p"]
-    wild_aliases = ["wild", "w"]
-    feedback_aliases = ["feedback"]
-    newgame_aliases = ["newgame"]
-    startgame_aliases = ["startgame"]
-    endgame_aliases = ["endgame"]
-    hand_aliases = ["hand"]
-    hpt_aliases = ["hpt", "hotpotato"]
-    ready_aliases = ["ready", "r"]
-    seven_aliases = ["seven", "s", "swap"]
-    aa_aliases = ["advancedrules", "aa"]
-
-    commands = [("feedback", 0, feedback_aliases),
-                ("newgame", 1, newgame_aliases),
-                ("join", 2, join_aliases),
-                ("leave", 1, leave_aliases),
-                ("listplayers", 1, listplayers_aliases),
-                ("startgame", 1, startgame_aliases),
-                ("endgame", 1, endgame_aliases),
-                ("draw", 1, draw_aliases),
-                ("play", 2, play_aliases),
-                ("wild", 2, wild_aliases),
-                ("hand", 1, hand_aliases),
-                ("hpt", 2, hpt_aliases),
-                ("ready", 3, ready_aliases),
-                ("seven", 2, seven_aliases),
-                ("advanced_rules", 1, aa_aliases)]
     for c in commands:
-        func = locals()[c[0] + "_handler"]
+        # Group messages produced while handling one update go out together.
+        func = on_chat_actor(metrics.timed(c[0], coalesced(globals()[c[0] + "_handler"])))
         if c[1] == 0:
             dispatcher.add_handler(CommandHandler(c[2], func, pass_args=True))
         elif c[1] == 1:
             dispatcher.add_handler(CommandHandler(c[2], func, pass_chat_data=True))
         elif c[1] == 2:
             dispatcher.add_handler(CommandHandler(c[2], func, pass_chat_data=True, pass_args=True))
-        elif c[1] == 3:
-            dispatcher.add_handler(CommandHandler(c[2], func, pass_chat_data=True, pass_user_data=True))
 
     # Uno button handler
 
-    dispatcher.add_handler(CallbackQueryHandler(button_handler, pass_chat_data=True, pass_user_data=True))
+    dispatcher.add_handler(CallbackQueryHandler(on_chat_actor(metrics.timed("button", coalesced(button_handler))),
+                                                pass_chat_data=True))
 
     # Error handlers
 
     dispatcher.add_error_handler(handle_error)
 
-    logging.basicConfig(
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        level=logging.INFO, filename='logging.txt', filemode='a')
 
+def count_games(chat_data):
+    games = {"active": 0, "pending": 0}
+    for data in list(chat_data.values()):
+        if data.get("game_obj") is not None:
+            games["active"] += 1
+        elif data.get("is_game_pending", False):
+            games["pending"] += 1
+    return dict(((state,), count) for state, count in games.items())
+
+
+def count_players(chat_data):
+    games = {}
+    for data in list(chat_data.values()):
+        game = data.get("game_obj")
+        if game is not None:
+            key = (len(game.get_players()),)
+            games[key] = games.get(key, 0) + 1
+    return games
+
+
+def register_metrics(chat_data, queue_depth, outbound=None):
+    """
+    Adds the gauges read from the bot's state. chat_data maps chat ids to
+    each chat's data; queue_depth returns how many updates await dispatch;
+    outbound is the OutboundScheduler, if sends are paced.
+    """
+    registry = metrics.registry
+    registry.add(metrics.Gauge("uno_games", "Games by state.", lambda: count_games(chat_data), ("state",)))
+    registry.add(metrics.Gauge("uno_games_by_players", "Running games by number of players.",
+                               lambda: count_players(chat_data), ("players",)))
+    registry.add(metrics.Gauge("uno_hpt_timers_pending", "Hot Potato deadlines waiting to fire.",
+                               lambda: chat_timers.get_pending(lambda key: key[0] == HPT)))
+    registry.add(metrics.Gauge("uno_dispatcher_queue_depth", "Updates received but not yet dispatched.", queue_depth))
+    registry.add(metrics.Gauge("uno_actor_queue_depth", "Updates and timer callbacks waiting for their chat.",
+                               chat_actors.get_queued))
+    if outbound is not None:
+        registry.add(metrics.Gauge("uno_outbound_queue_depth", "Sends waiting for Telegram's rate limits.",
+                                   outbound.get_queued))
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", metrics.CONTENT_TYPE)
+        self.write(metrics.registry.render())
+
+
+class MetricsWebhookApp(WebhookAppClass):
+    """
+    The webhook's web application, with /metrics served next to the webhook.
+    """
+
+    def __init__(self, webhook_path, bot, update_queue):
+        WebhookAppClass.__init__(self, webhook_path, bot, update_queue)
+        self.add_handlers(r".*$", [(r"/metrics", MetricsHandler)])
+
+
+def serve_metrics():
+    """
+    Has start_webhook build its web application with /metrics in it. The updater builds it on its
+    own thread just before its server starts, so nothing touches tornado from another thread.
+    """
+    telegram.ext.updater.WebhookAppClass = MetricsWebhookApp
+
+
+if __name__ == "__main__":
+    # Set up the bot
+
+    # The dispatcher's workers, the chat actors and the hands pool all make Bot API calls.
+    request = metrics.MeteredRequest(con_pool_size=4 + CHAT_WORKERS + HAND_WORKERS + 4)
+    updater = Updater(bot=telegram.Bot(token=TOKEN, base_url=BOT_API_URL, request=request))
+    # The webhook puts updates on this queue, which drops repeats and stays bounded; it must be in place
+    # before the webhook and the dispatcher start.
+    updater.update_queue = updater.dispatcher.update_queue = IngestionQueue(
+        INGEST_CAPACITY, INGEST_POLICY, SHEDDABLE_COMMANDS, chat_actors.get_queued)
+    # Handlers, and the timers they start, send through the scheduler, which keeps to Telegram's rate
+    # limits and makes the calls on the hands pool.
+    outbound = OutboundScheduler(hand_fanout) if PACE_OUTBOUND else None
+    if outbound is not None:
+        updater.dispatcher.bot = ScheduledBot(updater.bot, outbound)
+    register_handlers(updater.dispatcher)
+    register_metrics(updater.dispatcher.chat_data, updater.dispatcher.update_queue.qsize, outbound)
+
+    setup_logging('logging.txt')
+
+    enable_persistence(updater.dispatcher.bot, lambda chat_id: updater.dispatcher.chat_data[chat_id], chat_actors.tell)
+    move_log = MoveLog(MOVE_LOG_DIR)
+    if os.environ.get('PROFILE'):
+        profiler.start()
+
+    serve_metrics()
     updater.start_webhook(listen="0.0.0.0", port=PORT, url_path=TOKEN)
-    updater.bot.set_webhook("https://la-uno-bot.herokuapp.com/" + TOKEN)
+    updater.bot.set_webhook(WEBHOOK_URL + TOKEN)
 
     #updater.start_polling()
-    updater.idle()
\ No newline at end of file
+    updater.idle()
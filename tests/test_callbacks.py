@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import callbacks
+import uno
+
+GROUP = -1001234567890
+
+
+def get_game(seed=1):
+    return uno.Game(GROUP, {1: "alice", 2: "bob"}, seed)
+
+
+@pytest.mark.parametrize("values", [(GROUP, 2 ** 64 - 1, 0, 0), (42, 0, 1234, 107), (-1, 35, 36, 37)])
+def test_decode_returns_what_was_encoded(values):
+    data = callbacks.encode(*values)
+    assert data.startswith(callbacks.PREFIX)
+    assert callbacks.decode(data) == values
+
+
+def test_tokens_fit_in_callback_data():
+    # Telegram allows 64 bytes of callback data.
+    assert len(callbacks.encode(GROUP, 2 ** 64 - 1, 10 ** 6, 107).encode("utf-8")) <= 64
+
+
+@pytest.mark.parametrize("data", [None, "", "x", "#", "#1.2.3", "#1.2.3.4.5", "#1..3.4", "#1.2.3.4!",
+                                  "#1.2.3.-", "#1.2.-3.4", "#1.2.3. 4", "#1.2.3.+4",
+                                  "#1.2.3.4_0", "#1.2.3.A", "#１.2.3.4", "!1!2", "1.2.3.4"])
+def test_malformed_tokens_decode_to_none(data):
+    assert callbacks.decode(data) is None
+
+
+def test_routes_find_a_running_game_by_its_seed():
+    routes = callbacks.GameRoutes()
+    game = get_game()
+    chat_data = {"game_obj": game}
+    routes.add(game, GROUP, chat_data)
+
+    assert routes.get(game.seed) == (GROUP, chat_data, game)
+
+
+def test_routes_dont_find_an_unknown_seed():
+    routes = callbacks.GameRoutes()
+    game = get_game()
+    routes.add(game, GROUP, {"game_obj": game})
+
+    assert routes.get(game.seed + 1) is None
+
+
+def test_routes_dont_find_a_game_that_is_no_longer_its_chats_game():
+    routes = callbacks.GameRoutes()
+    old = get_game(1)
+    chat_data = {"game_obj": old}
+    routes.add(old, GROUP, chat_data)
+
+    chat_data["game_obj"] = get_game(2)
+    assert routes.get(old.seed) is None
+    del chat_data["game_obj"]
+    assert routes.get(old.seed) is None
+
+
+def test_removing_an_old_game_keeps_the_route_of_a_new_one_with_the_same_seed():
+    routes = callbacks.GameRoutes()
+    old = get_game()
+    new = get_game()
+    chat_data = {"game_obj": new}
+    routes.add(old, GROUP, chat_data)
+    routes.add(new, GROUP, chat_data)
+
+    routes.remove(old)
+    assert routes.get(new.seed) == (GROUP, chat_data, new)
+    routes.remove(new)
+    assert routes.get(new.seed) is None
+
+
+class Query:
+    def __init__(self, data, user_id):
+        self.id = "q1"
+        self.data = data
+        self.from_user = type(str("User"), (), {"id": user_id})
+
+
+class Bot:
+    def __init__(self):
+        self.answers = []
+        self.messages = []
+
+    def answer_callback_query(self, callback_query_id, text=None):
+        self.answers.append(text)
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.messages.append(text)
+
+
+@pytest.fixture
+def tap(monkeypatch):
+    """
+    Taps a hand button for a running game through card_button and returns what the bot did.
+    """
+    pytest.importorskip("telegram")
+    # telegram_interaction reads its token and responses relative to the repository.
+    monkeypatch.chdir(ROOT)
+    import telegram_interaction
+
+    game = get_game()
+    monkeypatch.setattr(telegram_interaction, "game_routes", callbacks.GameRoutes())
+    telegram_interaction.game_routes.add(game, GROUP, {"game_obj": game})
+
+    def tap(chat_id, game_id, version, slot, user_id=1):
+        bot = Bot()
+        telegram_interaction.card_button(bot, Query(callbacks.encode(chat_id, game_id, version, slot), user_id))
+        return bot
+    return game, tap
+
+
+def test_taps_on_an_older_hand_change_nothing(tap):
+    game, tap = tap
+    player = game.get_player(1)
+    version = player.get_version()
+    # A drawn card moves every slot of the old hand along by one.
+    player.insert_card(game.deck.draw_card(), 0)
+    hand = list(player.get_hand())
+
+    bot = tap(GROUP, game.seed, version, 0)
+    assert bot.answers == ["This hand is out of date. Use the newest one."]
+    assert bot.messages == []
+    assert player.get_hand() == hand
+
+
+def test_taps_past_the_end_of_the_hand_change_nothing(tap):
+    game, tap = tap
+    player = game.get_player(1)
+
+    bot = tap(GROUP, game.seed, player.get_version(), len(player.get_hand()))
+    assert bot.answers == ["This hand is out of date. Use the newest one."]
+    assert bot.messages == []
+
+
+def test_taps_for_another_game_or_chat_change_nothing(tap):
+    game, tap = tap
+    version = game.get_player(1).get_version()
+
+    assert tap(GROUP, game.seed + 1, version, 0).answers == ["This game is over."]
+    assert tap(GROUP + 1, game.seed, version, 0).answers == ["This game is over."]
+    assert tap(GROUP, game.seed, version, 0, user_id=3).answers == ["This is not your hand."]
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import queue
+import re
+import sys
+import threading
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+telegram = pytest.importorskip("telegram")
+from telegram.ext import Dispatcher
+
+GROUP = -100
+
+
+class RecordingBot:
+    """
+    Answers every Bot API method by remembering the call, under its snake_case name.
+    """
+
+    username = "unobot"
+
+    def __init__(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        name = re.sub("([A-Z])", lambda m: "_" + m.group(1).lower(), name)
+
+        def call(*args, **kwargs):
+            with self.lock:
+                self.calls.append((name, args, kwargs))
+        return call
+
+
+def get_dispatcher(monkeypatch, **handlers):
+    # telegram_interaction reads its token and responses relative to the repository.
+    monkeypatch.chdir(ROOT)
+    import telegram_interaction
+
+    for name, handler in handlers.items():
+        monkeypatch.setattr(telegram_interaction, name, handler)
+    dispatcher = Dispatcher(RecordingBot(), queue.Queue(), workers=1)
+    telegram_interaction.register_handlers(dispatcher)
+    return dispatcher
+
+
+@pytest.fixture
+def dispatcher(monkeypatch):
+    return get_dispatcher(monkeypatch)
+
+
+def get_user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": "Player%d" % user_id}
+
+
+def get_command(update_id, user_id, text, chat_id=GROUP):
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "text": text, "from": get_user(user_id),
+        "chat": {"id": chat_id, "type": "group", "title": "Test"},
+        "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]}}
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_commands_get_chat_data_and_args(dispatcher):
+    import telegram_interaction
+    for update_id, (user_id, text) in enumerate([(1, "/newgame"), (1, "/join alice")], 1):
+        dispatcher.process_update(telegram.Update.de_json(get_command(update_id, user_id, text), dispatcher.bot))
+
+    wait_for(lambda: dispatcher.chat_data[GROUP].get("pending_players") == {1: "alice"})
+    wait_for(lambda: any(name == "send_message" and kwargs.get("chat_id") == GROUP and
+                         kwargs.get("text") == telegram_interaction.responses.get("new_game")
+                         for name, args, kwargs in dispatcher.bot.calls))
+
+
+def test_callback_queries_get_chat_data(dispatcher):
+    import telegram_interaction
+    data = {"update_id": 1, "callback_query": {
+        "id": "q1", "from": get_user(1), "chat_instance": "1", "data": telegram_interaction.UNPLAYABLE_CALLBACK,
+        "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": 1, "type": "private"}}}}
+    dispatcher.process_update(telegram.Update.de_json(data, dispatcher.bot))
+
+    wait_for(lambda: any(name == "answer_callback_query" and "q1" in args + (kwargs.get("callback_query_id"),) and
+                         kwargs.get("text") == "This is not a valid card." for name, args, kwargs in dispatcher.bot.calls))
+
+
+def test_updates_for_one_chat_run_in_order_one_at_a_time(monkeypatch):
+    played = []
+    running = []
+    overlapped = []
+
+    def play_handler(bot, update, chat_data, args):
+        running.append(args[0])
+        overlapped.append(len(running) > 1)
+        time.sleep(0.01)
+        played.append(args[0])
+        running.remove(args[0])
+
+    dispatcher = get_dispatcher(monkeypatch, play_handler=play_handler)
+    cards = [str(i) for i in range(10)]
+    for update_id, card in enumerate(cards, 1):
+        dispatcher.process_update(telegram.Update.de_json(get_command(update_id, 1, "/play " + card),
+                                                          dispatcher.bot))
+
+    wait_for(lambda: len(played) == len(cards))
+    assert played == cards
+    assert not any(overlapped)
+
+
+def test_updates_for_different_chats_run_in_parallel(monkeypatch):
+    # Each handler waits for the other, so this only finishes if both chats run at once.
+    barrier = threading.Barrier(2, timeout=5)
+    met = []
+
+    def play_handler(bot, update, chat_data, args):
+        barrier.wait()
+        met.append(update.message.chat_id)
+
+    dispatcher = get_dispatcher(monkeypatch, play_handler=play_handler)
+    for update_id, chat_id in enumerate([GROUP, GROUP - 1], 1):
+        dispatcher.process_update(telegram.Update.de_json(get_command(update_id, 1, "/play 0", chat_id),
+                                                          dispatcher.bot))
+
+    wait_for(lambda: len(met) == 2)
+    assert sorted(met) == [GROUP - 1, GROUP]
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+pytest.importorskip("telegram")
+import ingestion
+import metrics
+
+SHEDDABLE = ("help", "hand")
+
+
+class Message:
+    def __init__(self, text):
+        self.text = text
+
+
+class Update:
+    def __init__(self, update_id, text=None, is_callback=False):
+        self.update_id = update_id
+        self.message = Message(text) if not is_callback else None
+        self.callback_query = object() if is_callback else None
+
+
+def get_count(outcome):
+    return metrics.updates.values.get((outcome,), 0)
+
+
+def test_recent_ids_forget_the_oldest_past_their_size():
+    recent = ingestion.RecentIds(3)
+    for i in range(5):
+        recent.add(i)
+
+    assert [i in recent for i in range(5)] == [False, False, True, True, True]
+
+
+def test_commands_are_read_from_message_text():
+    assert ingestion.get_command("/Help@UnoBot now") == "help"
+    assert ingestion.get_command("/play 3") == "play"
+    assert ingestion.get_command("hello") is None
+    assert ingestion.get_command(None) is None
+
+
+def test_redelivered_updates_are_dropped():
+    updates = ingestion.IngestionQueue(10, ingestion.SHED, SHEDDABLE)
+    duplicates = get_count(ingestion.DUPLICATE)
+    for update_id in (1, 2, 1, 3, 2):
+        updates.put(Update(update_id, "/play 0"))
+
+    assert [updates.get().update_id for i in range(updates.qsize())] == [1, 2, 3]
+    assert get_count(ingestion.DUPLICATE) == duplicates + 2
+
+
+def test_an_id_is_only_remembered_for_so_long():
+    admission = ingestion.Ingestion(lambda: 0, recent=2)
+    outcomes = [admission.admit(update_id) for update_id in (1, 2, 3, 1)]
+
+    assert outcomes == [ingestion.ACCEPTED] * 4
+
+
+def test_past_capacity_shed_drops_only_what_nothing_depends_on():
+    updates = ingestion.IngestionQueue(2, ingestion.SHED, SHEDDABLE)
+    shed = get_count(ingestion.SHEDDED)
+    arrivals = [Update(1, "/play 0"), Update(2, "/draw"), Update(3, "/help"), Update(4, "/hand@UnoBot"),
+                Update(5, "nice move"), Update(6, "/play 1"), Update(7, is_callback=True)]
+    for update in arrivals:
+        # Nothing is raised, so the webhook answers each of these with a 200.
+        updates.put(update)
+
+    assert [updates.get().update_id for i in range(updates.qsize())] == [1, 2, 6, 7]
+    assert get_count(ingestion.SHEDDED) == shed + 3
+
+
+def test_past_capacity_reject_drops_everything():
+    updates = ingestion.IngestionQueue(2, ingestion.REJECT, SHEDDABLE)
+    rejected = get_count(ingestion.REJECTED)
+    for update_id in range(1, 6):
+        updates.put(Update(update_id, "/play 0"))
+
+    assert [updates.get().update_id for i in range(updates.qsize())] == [1, 2]
+    assert get_count(ingestion.REJECTED) == rejected + 3
+
+    # A dropped update that comes again is a duplicate, as it was acknowledged the first time.
+    updates.put(Update(3, "/play 0"))
+    assert updates.qsize() == 0
+
+
+def test_capacity_counts_updates_taken_off_the_queue_but_not_yet_handled():
+    backlog = [0]
+    updates = ingestion.IngestionQueue(2, ingestion.REJECT, SHEDDABLE, lambda: backlog[0])
+    updates.put(Update(1, "/play 0"))
+    updates.get()
+    backlog[0] = 2
+    updates.put(Update(2, "/play 0"))
+    assert updates.qsize() == 0
+
+    backlog[0] = 1
+    updates.put(Update(3, "/play 0"))
+    assert updates.qsize() == 1
+
+
+def test_things_that_arent_updates_always_go_through():
+    updates = ingestion.IngestionQueue(0, ingestion.REJECT, SHEDDABLE)
+    stop = object()
+    updates.put(stop)
+
+    assert updates.get() is stop
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import collections
+import os
+import random
+import sys
+import threading
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import moves
+import persistence
+import uno
+
+CHATS = (-100, -200)
+MOVES = {"draw": moves.draw, "play": moves.play, "uno": moves.call_uno, "wild": moves.wild,
+         "seven": moves.seven}
+
+
+def apply(chat_id, chat_data, op, args):
+    """
+    Makes one move, the same way whether it is being made or replayed from the journal.
+    """
+    if op == "start":
+        seed, players, advanced = args
+        chat_data["pending_players"] = collections.OrderedDict((user_id, name) for user_id, name in players)
+        game = uno.Game(chat_id, chat_data["pending_players"], seed)
+        game.set_advanced_rules(advanced)
+        for user_id in game.get_players_and_ready():
+            game.get_players_and_ready()[user_id] = True
+        game.set_ready_to_play(True)
+        game.play_initial_card()
+        chat_data["game_obj"] = game
+    else:
+        MOVES[op](chat_data["game_obj"], *args)
+    chat_data["game_obj"].drain_events()
+
+
+def choose(chat_id, chat_data, rng):
+    """
+    Returns a legal (op, args) for whoever the chat's game is waiting on, or a new game once it is won.
+    """
+    game = chat_data.get("game_obj")
+    if game is None or game.check_for_win() is not None:
+        players = [[chat_id * 10 - i, "Player %d" % i] for i in range(4)]
+        return "start", [rng.getrandbits(64), players, True]
+    if game.is_wild_pending():
+        return "wild", [game.waiting_for_wild_id, rng.choice(uno.COLORS)]
+    if game.is_seven_pending():
+        seat = game.get_player(game.waiting_for_seven_id).get_id()
+        return "seven", [game.waiting_for_seven_id, (seat + 1) % len(game.seat_ids)]
+    if game.is_uno_pending():
+        return "uno", [rng.choice(game.seat_ids)]
+
+    user_id = game.get_player_id_by_num(game.turn)
+    playable = [i for i, c in enumerate(game.get_player(user_id).get_hand()) if game.deck.check_valid_play(c)]
+    if playable:
+        return "play", [user_id, rng.choice(playable)]
+    return "draw", [user_id]
+
+
+class Chats:
+    """
+    Chats whose moves are journaled to a Store in directory, the way the bot journals them.
+    """
+
+    def __init__(self, directory, snapshot_every):
+        self.chat_data = collections.defaultdict(dict)
+        # Checkpoints run at once, as nothing else touches these chats.
+        self.store = persistence.Store(directory, apply, lambda chat_id, fn, *args: fn(*args), snapshot_every)
+        self.store.recover(lambda chat_id: self.chat_data[chat_id])
+
+    def play(self, count, rng, journal=True):
+        for i in range(count):
+            chat_id = rng.choice(CHATS)
+            op, args = choose(chat_id, self.chat_data[chat_id], rng)
+            apply(chat_id, self.chat_data[chat_id], op, args)
+            if journal:
+                self.store.record(chat_id, self.chat_data[chat_id], op, *args)
+
+    def encode(self):
+        return dict((chat_id, persistence.encode_chat(chat_data)) for chat_id, chat_data in self.chat_data.items())
+
+
+def test_a_game_survives_being_encoded_and_decoded():
+    rng = random.Random(1)
+    chat_data = {}
+    for i in range(100):
+        apply(CHATS[0], chat_data, *choose(CHATS[0], chat_data, rng))
+
+    restored = {}
+    persistence.decode_chat(persistence.encode_chat(chat_data), CHATS[0], restored)
+    live, game = chat_data["game_obj"], restored["game_obj"]
+    assert persistence.encode_chat(restored) == persistence.encode_chat(chat_data)
+    assert [str(c) for c in game.deck.deck] == [str(c) for c in live.deck.deck]
+    assert [p.get_hand() for p in game.seat_players] == [p.get_hand() for p in live.seat_players]
+    assert [p.get_version() for p in game.seat_players] == [p.get_version() for p in live.seat_players]
+    assert game.get_players() is restored["pending_players"]
+
+
+@pytest.mark.parametrize("count", [3, 40, 500])
+def test_chats_recover_from_the_snapshot_and_the_journal(tmpdir, count):
+    live = Chats(str(tmpdir), snapshot_every=25)
+    live.play(count, random.Random(count))
+    live.store.close()
+    if count > 25:
+        assert os.path.exists(os.path.join(str(tmpdir), persistence.SNAPSHOT_FILE))
+    assert live.store.get_segments()
+
+    recovered = Chats(str(tmpdir), snapshot_every=25)
+    assert recovered.encode() == live.encode()
+
+    # The games go on the same way, down to what the shuffled deck deals next.
+    live.play(200, random.Random("after"), journal=False)
+    recovered.play(200, random.Random("after"))
+    assert recovered.encode() == live.encode()
+    recovered.store.close()
+
+
+def test_a_journal_line_cut_off_mid_write_is_skipped(tmpdir):
+    live = Chats(str(tmpdir), snapshot_every=25)
+    live.play(60, random.Random(2))
+    live.store.close()
+    expected = live.encode()
+
+    segment = live.store.get_segment_path(live.store.get_segments()[-1])
+    with open(segment, "a") as f:
+        f.write('[%d,%d,"play",%d,' % (live.store.seq + 1, CHATS[0], CHATS[0] * 10))
+
+    recovered = Chats(str(tmpdir), snapshot_every=25)
+    assert recovered.encode() == expected
+
+    # The torn line doesn't come back, and the moves after it are kept.
+    recovered.play(10, random.Random(3))
+    recovered.store.close()
+    again = Chats(str(tmpdir), snapshot_every=25)
+    assert again.encode() == recovered.encode()
+    again.store.close()
+
+
+def test_moves_are_recorded_without_waiting_for_the_disk(tmpdir, monkeypatch):
+    live = Chats(str(tmpdir), snapshot_every=25)
+    disk = threading.Event()
+    written = []
+    write = persistence.Store.write
+
+    def stalled_write(store, line):
+        disk.wait(5)
+        written.append(line)
+        write(store, line)
+    monkeypatch.setattr(persistence.Store, "write", stalled_write)
+
+    live.play(60, random.Random(4))
+    assert written == []
+    disk.set()
+    live.store.close()
+    assert len(written) == 60
+
+    recovered = Chats(str(tmpdir), snapshot_every=25)
+    assert recovered.encode() == live.encode()
+    recovered.store.close()
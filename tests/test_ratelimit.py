@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+pytest.importorskip("telegram")
+from telegram.error import RetryAfter
+
+import ratelimit
+
+GROUP = -100
+PRIVATE = 100
+# How long the scheduler's thread gets to send whatever the clock lets it.
+SETTLE = 0.05
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class InlineFanOut:
+    def submit(self, fn, jobs, on_done=None):
+        for key, args in jobs:
+            fn(*args)
+
+
+class Harness:
+    """
+    An OutboundScheduler on a fake clock, and what it has sent.
+    """
+
+    def __init__(self, **limits):
+        self.clock = Clock()
+        self.scheduler = ratelimit.OutboundScheduler(InlineFanOut(), clock=self.clock, **limits)
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def record(self, label):
+        with self.lock:
+            self.sent.append(label)
+
+    def submit(self, chat_id, label, priority=ratelimit.GAME, key=None):
+        self.scheduler.submit(chat_id, priority, key, self.record, label)
+
+    def advance(self, seconds):
+        self.clock.now += seconds
+        with self.scheduler.condition:
+            self.scheduler.condition.notify()
+
+    def get_sent(self):
+        time.sleep(SETTLE)
+        with self.lock:
+            return list(self.sent)
+
+
+def test_a_private_chat_gets_its_burst_then_its_rate():
+    harness = Harness(private_rate=1.0, private_burst=3)
+    for i in range(5):
+        harness.submit(PRIVATE, i)
+
+    assert harness.get_sent() == [0, 1, 2]
+    harness.advance(0.5)
+    assert harness.get_sent() == [0, 1, 2]
+    harness.advance(0.5)
+    assert harness.get_sent() == [0, 1, 2, 3]
+    harness.advance(1)
+    assert harness.get_sent() == [0, 1, 2, 3, 4]
+
+
+def test_a_group_gets_twenty_messages_a_minute():
+    harness = Harness()
+    for i in range(22):
+        harness.submit(GROUP, i)
+
+    assert harness.get_sent() == list(range(20))
+    harness.advance(2.9)
+    assert harness.get_sent() == list(range(20))
+    harness.advance(0.2)
+    assert harness.get_sent() == list(range(21))
+
+
+def test_a_busy_chat_doesnt_hold_up_the_others():
+    harness = Harness(private_rate=1.0, private_burst=1)
+    for i in range(3):
+        harness.submit(PRIVATE, "busy %d" % i)
+    harness.submit(PRIVATE + 1, "quiet")
+
+    assert harness.get_sent() == ["busy 0", "quiet"]
+
+
+def test_the_global_bucket_paces_all_chats_most_urgent_first():
+    harness = Harness(global_rate=2.0, global_burst=2)
+    harness.submit(PRIVATE - 1, "first")
+    harness.submit(PRIVATE - 2, "second")
+    assert harness.get_sent() == ["first", "second"]
+
+    # The bot's bucket is empty now, so these wait and go by priority, then by age.
+    harness.submit(PRIVATE, "background", ratelimit.BACKGROUND)
+    harness.submit(GROUP, "game", ratelimit.GAME)
+    harness.submit(GROUP - 1, "turn", ratelimit.TURN)
+    harness.submit(GROUP - 2, "later game", ratelimit.GAME)
+    assert harness.get_sent() == ["first", "second"]
+    harness.advance(0.25)
+    assert harness.get_sent() == ["first", "second"]
+    harness.advance(0.25)
+    assert harness.get_sent() == ["first", "second", "turn"]
+    harness.advance(1)
+    assert harness.get_sent() == ["first", "second", "turn", "game", "later game"]
+    harness.advance(0.5)
+    assert harness.get_sent() == ["first", "second", "turn", "game", "later game", "background"]
+
+
+def test_retry_after_holds_the_chat_and_tries_the_job_again_first():
+    harness = Harness()
+    failed = []
+
+    def flood(label):
+        if not failed:
+            failed.append(label)
+            raise RetryAfter(5)
+        harness.record(label)
+
+    harness.scheduler.submit(GROUP, ratelimit.GAME, None, flood, "first")
+    harness.submit(GROUP, "second")
+
+    assert harness.get_sent() == []
+    harness.advance(4.9)
+    assert harness.get_sent() == []
+    harness.advance(0.1)
+    assert harness.get_sent() == ["first", "second"]
+
+
+def test_a_waiting_job_is_replaced_by_a_newer_one_with_its_key():
+    harness = Harness(private_rate=1.0, private_burst=1)
+    harness.submit(PRIVATE, "hand 1", key=(PRIVATE, "hand"))
+    assert harness.get_sent() == ["hand 1"]
+
+    harness.submit(PRIVATE, "hand 2", key=(PRIVATE, "hand"))
+    harness.submit(PRIVATE, "hand 3", key=(PRIVATE, "hand"))
+    assert harness.get_sent() == ["hand 1"]
+    harness.advance(1)
+    assert harness.get_sent() == ["hand 1", "hand 3"]
+    harness.advance(1)
+    assert harness.get_sent() == ["hand 1", "hand 3"]
+
+
+def test_plain_text_waiting_for_a_chat_is_sent_as_one_message():
+    harness = Harness(group_burst=1)
+    messages = []
+
+    class Bot:
+        def send_message(self, chat_id, text, **kwargs):
+            messages.append((chat_id, text, kwargs))
+
+    bot = ratelimit.ScheduledBot(Bot(), harness.scheduler)
+    bot.send_message(GROUP, "zero")
+    harness.get_sent()
+    # The chat's bucket is empty now, so these wait.
+    bot.send_message(GROUP, "one")
+    bot.send_message(GROUP, "two")
+    bot.send_message(GROUP, "three", reply_markup="keyboard")
+    bot.send_message(GROUP, "four")
+
+    harness.get_sent()
+    assert messages == [(GROUP, "zero", {})]
+    for i in range(3):
+        harness.advance(3.1)
+        harness.get_sent()
+    assert messages == [(GROUP, "zero", {}), (GROUP, "one\n\ntwo", {}),
+                        (GROUP, "three", {"reply_markup": "keyboard"}), (GROUP, "four", {})]
+
+
+def test_send_now_skips_the_queue_and_raises_what_sending_raises():
+    harness = Harness(private_burst=1)
+
+    class Bot:
+        def send_message(self, chat_id, text, **kwargs):
+            raise RetryAfter(1)
+
+    bot = ratelimit.ScheduledBot(Bot(), harness.scheduler)
+    with pytest.raises(RetryAfter):
+        bot.send_now(PRIVATE, "Trying to start game!")
+    assert harness.scheduler.get_queued() == 0
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import sys
+import threading
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import timers
+
+
+class Clock:
+    """
+    A clock that only moves when advance is called. The wheel's thread sleeps on it, and advance
+    returns once the thread has handled every tick up to the new time and is asleep again.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.waking_at = None
+        self.condition = threading.Condition()
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        with self.condition:
+            self.waking_at = self.now + seconds
+            self.condition.notify_all()
+            while self.now < self.waking_at:
+                self.condition.wait()
+            self.waking_at = None
+
+    def advance(self, seconds):
+        with self.condition:
+            self.now += seconds
+            self.condition.notify_all()
+            assert self.condition.wait_for(lambda: self.waking_at is not None and self.waking_at > self.now, 5)
+
+
+class Harness:
+    def __init__(self, tick=1.0, slots=8):
+        self.clock = Clock()
+        self.wheel = timers.TimerWheel(tick, slots, clock=self.clock, sleep=self.clock.sleep)
+        self.fired = []
+
+    def schedule(self, key, delay):
+        return self.wheel.schedule(key, delay, self.fire, key)
+
+    def fire(self, generation, key):
+        self.fired.append((key, generation, self.clock.now))
+
+    def advance(self, seconds, step=1.0):
+        for i in range(int(round(seconds / step))):
+            self.clock.advance(step)
+
+
+@pytest.mark.parametrize("delay", [0, 0.5, 1, 2.5, 7, 8, 9, 15, 16, 17, 30])
+def test_a_deadline_fires_on_the_first_tick_at_or_after_it(delay):
+    harness = Harness()
+    harness.schedule("key", delay)
+
+    due = max(1, -(-delay // 1))
+    harness.advance(due - 1)
+    assert harness.fired == []
+    harness.advance(1)
+    assert [(key, when) for key, generation, when in harness.fired] == [("key", due)]
+    harness.advance(20)
+    assert len(harness.fired) == 1
+
+
+def test_deadlines_set_mid_turn_count_rounds_from_where_the_wheel_is():
+    harness = Harness()
+    harness.schedule("start", 1)
+    harness.advance(5)
+
+    # Now 5 ticks round the wheel; 11 more ticks wrap past the start and need one more round.
+    harness.schedule("wrapped", 11)
+    harness.schedule("far", 27)
+    harness.advance(40)
+    assert [(key, when) for key, generation, when in harness.fired] == [("start", 1), ("wrapped", 16), ("far", 32)]
+
+
+def test_a_deadline_more_than_a_turn_of_the_default_wheel_away():
+    # 512 slots of 0.1s turn once every 51.2s.
+    harness = Harness(timers.TICK, timers.SLOTS)
+    harness.schedule("hpt", 60)
+    harness.schedule("short", 8.8)
+
+    harness.advance(59.9, step=0.1)
+    assert [key for key, generation, when in harness.fired] == ["short"]
+    harness.advance(0.1, step=0.1)
+    assert [key for key, generation, when in harness.fired] == ["short", "hpt"]
+    assert harness.fired[1][2] == pytest.approx(60)
+
+
+def test_cancelled_deadlines_dont_fire():
+    harness = Harness()
+    harness.schedule("cancelled", 3)
+    harness.schedule("far", 20)
+    harness.schedule("kept", 3)
+    harness.wheel.cancel("cancelled")
+    harness.wheel.cancel("far")
+    harness.wheel.cancel("unknown")
+
+    assert harness.wheel.get_pending() == 1
+    harness.advance(30)
+    assert [key for key, generation, when in harness.fired] == ["kept"]
+    assert harness.wheel.get_pending() == 0
+
+
+def test_scheduling_a_key_again_replaces_its_deadline():
+    harness = Harness()
+    first = harness.schedule("key", 3)
+    harness.advance(2)
+    second = harness.wheel.reschedule("key", 10, harness.fire, "key")
+
+    assert second != first
+    assert not harness.wheel.is_current("key", first)
+    assert harness.wheel.is_current("key", second)
+    harness.advance(20)
+    assert harness.fired == [("key", second, 12)]
+    # The generation stays current after it fires, until the key is cancelled.
+    assert harness.wheel.is_current("key", second)
+    harness.wheel.cancel("key")
+    assert not harness.wheel.is_current("key", second)
+
+
+def test_a_callback_that_raises_doesnt_stop_the_wheel():
+    harness = Harness()
+    harness.wheel.schedule("broken", 1, lambda generation: 1 / 0)
+    harness.schedule("after", 2)
+
+    harness.advance(3)
+    assert [key for key, generation, when in harness.fired] == ["after"]
+
+
+def test_pending_deadlines_can_be_counted_by_key():
+    harness = Harness()
+    for chat_id in (1, 2):
+        harness.schedule(("hpt", chat_id), 5)
+    harness.schedule(("uno", 1), 5)
+
+    assert harness.wheel.get_pending() == 3
+    assert harness.wheel.get_pending(lambda key: key[0] == "hpt") == 2
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import itertools
+import logging
+import threading
+import time
+
+TICK = 0.1
+SLOTS = 512
+
+
+class TimerWheel:
+    """
+    Deadlines for any number of keys on a single thread. Each deadline sits
+    in the slot of the wheel it expires in, so scheduling, cancelling and
+    rescheduling a key are O(1), and each tick only looks at one slot.
+
+    A key has at most one deadline; scheduling it again replaces the old
+    one. Every deadline gets a new generation, which fn receives first when
+    it fires, so work queued by a deadline that has since been cancelled or
+    replaced can tell it is stale with is_current.
+    """
+
+    def __init__(self, tick=TICK, slots=SLOTS, name="timers", clock=time.monotonic, sleep=time.sleep):
+        self.tick = tick
+        self.clock = clock
+        self.sleep = sleep
+        self.slots = [{} for i in range(slots)]
+        self.cursor = 0
+        # key -> (slot, generation) of the key's pending or most recently fired deadline.
+        self.entries = {}
+        self.generations = itertools.count(1)
+        self.lock = threading.Lock()
+        self.name = name
+        self.thread = None
+
+    def schedule(self, key, delay, fn, *args):
+        """
+        Calls fn(generation, *args) on the timer thread in about delay seconds
+        and returns the generation. fn should hand real work off elsewhere.
+        """
+        ticks = max(1, int(-(-delay // self.tick)))
+        with self.lock:
+            self.remove(key)
+            generation = next(self.generations)
+            slot = (self.cursor + ticks) % len(self.slots)
+            self.slots[slot][key] = [(ticks - 1) // len(self.slots), generation, fn, args]
+            self.entries[key] = (slot, generation)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+                self.thread.start()
+        return generation
+
+    def reschedule(self, key, delay, fn, *args):
+        return self.schedule(key, delay, fn, *args)
+
+    def cancel(self, key):
+        with self.lock:
+            self.remove(key)
+            self.entries.pop(key, None)
+
+    def remove(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.slots[entry[0]].pop(key, None)
+
+    def is_current(self, key, generation):
+        return self.entries.get(key, (None, None))[1] == generation
+
+    def get_pending(self, match=None):
+        with self.lock:
+            if match is None:
+                return sum(len(slot) for slot in self.slots)
+            return sum(1 for slot in self.slots for key in slot if match(key))
+
+    def run(self):
+        next_tick = self.clock() + self.tick
+        while True:
+            delay = next_tick - self.clock()
+            if delay > 0:
+                self.sleep(delay)
+            next_tick += self.tick
+
+            expired = []
+            with self.lock:
+                self.cursor = (self.cursor + 1) % len(self.slots)
+                slot = self.slots[self.cursor]
+                for key, entry in list(slot.items()):
+                    if entry[0] > 0:
+                        entry[0] -= 1
+                    else:
+                        del slot[key]
+                        expired.append(entry)
+
+            for rounds, generation, fn, args in expired:
+                try:
+                    fn(generation, *args)
+                except Exception:
+                    logging.getLogger(__name__).exception("Timer callback failed")
@@ -1,36 +1,59 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-import telegram
-from telegram.error import Unauthorized, TelegramError
+import events
 
+import collections
 import random
 
 
 THRESHOLD_PLAYERS = 10
 
-with open("api_key.txt", 'r') as f:
-    TOKEN = f.read().rstrip()
-
-bot = telegram.Bot(token=TOKEN)
+COLORS = ['R', 'Y', 'G', 'B']
+LABELS = {10: " Skip", 11: " Reverse", 12: " Draw Two", 13: " Wild", 14: " Wild Draw Four"}
 
 
 class Player:
     def __init__(self, id, hand):
         self.hand = hand
         self.id = id
+        # Bumped whenever the hand changes so callers can tell if a rendered hand is stale.
+        self.version = 0
+        # How many cards of each color and each value the hand holds, kept up to date as cards
+        # come and go so playability checks don't walk the hand.
+        self.counts = count_cards(hand)
+        # The hand's "(i) card" labels, rebuilt only when the version moves on, and whatever a
+        # front end last rendered from it along with the key it rendered it for.
+        self.labels = None
+        self.labels_version = -1
+        self.rendered = None
 
     def get_hand(self):
         return self.hand
 
+    def get_counts(self):
+        return self.counts
+
     def get_id(self):
         return self.id
 
+    def get_version(self):
+        return self.version
+
     def remove_card(self, id):
         if 0 <= id < len(self.hand):
-            return self.hand.pop(id)
+            self.version += 1
+            card = self.hand.pop(id)
+            self.update_counts(card, -1)
+            return card
         return None
 
+    def get_labels(self):
+        if self.labels_version != self.version:
+            self.labels = ["(%d) %s" % (i, c) for i, c in enumerate(self.hand)]
+            self.labels_version = self.version
+        return self.labels
+
     def get_formatted_hand(self):
         text = "Your current hand:\n\n"
         for i in range(len(self.hand)):
@@ -38,16 +61,45 @@ class Player:
         return text
 
     def add_card(self, c):
+        self.version += 1
         self.hand.append(c)
+        self.update_counts(c, 1)
 
     def insert_card(self, c, i):
+        self.version += 1
         self.hand.insert(i, c)
+        self.update_counts(c, 1)
 
-    def set_hand(self, hand):
+    def set_hand(self, hand, counts=None):
+        self.version += 1
         self.hand = hand
+        self.counts = count_cards(hand) if counts is None else counts
 
+    def update_counts(self, c, n):
+        self.counts[c.value] = self.counts.get(c.value, 0) + n
+        if c.color:
+            self.counts[c.color] = self.counts.get(c.color, 0) + n
+
+    def count_value(self, value):
+        return self.counts.get(value, 0)
+
+    def has_playable_card(self, top):
+        if top is None:
+            return len(self.hand) > 0
+        return (self.counts.get(13, 0) + self.counts.get(14, 0) > 0 or
+                self.counts.get(top.color, 0) > 0 or self.counts.get(top.value, 0) > 0)
 
-class Card:
+
+def count_cards(hand):
+    counts = {}
+    for c in hand:
+        counts[c.value] = counts.get(c.value, 0) + 1
+        if c.color:
+            counts[c.color] = counts.get(c.color, 0) + 1
+    return counts
+
+
+class Card(object):
     """
     For a typical card, we have 0-9 as values. 10 implies a Skip,
     11 implies a Reverse, and 12 implies a Draw Two. Each of these
@@ -56,11 +108,32 @@ class Card:
     If a card has a value of 13, it's Wild. If it has a value of
     14, it's a Draw Four Wild.
 
+    Cards are immutable and interned: Card(value, color) always returns
+    the same instance for the same pair, and its label is built once.
+    A wild takes on a color by swapping in the colored card of the same
+    value instead of changing the one in the deck.
+
     """
 
-    def __init__(self, value, color):
-        self.value = value
-        self.color = color
+    __slots__ = ("value", "color", "label")
+
+    cards = {}
+
+    def __new__(cls, value, color):
+        card = cls.cards.get((value, color))
+        if card is None:
+            card = object.__new__(cls)
+            object.__setattr__(card, "value", value)
+            object.__setattr__(card, "color", color)
+            object.__setattr__(card, "label", color + LABELS.get(value, str(value)))
+            card = cls.cards.setdefault((value, color), card)
+        return card
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Cards are immutable.")
+
+    def __reduce__(self):
+        return Card, (self.value, self.color)
 
     def get_color(self):
         return self.color
@@ -69,90 +142,84 @@ class Card:
         return self.value
 
     def check_valid_color(self):
-        return self.color in ['R', 'Y', 'G', 'B']
+        return self.color in COLORS
 
     def check_valid_value(self):
         return self.value >= 0
 
     def is_wild(self):
-        if self.value == 13 or self.value == 14:
-            return True
-        return False
+        return self.value == 13 or self.value == 14
 
     # Just for wilds.
-    def set_color(self, c):
+    def with_color(self, c):
         if self.value == 13 or self.value == 14:
-            self.color = c
+            return Card(self.value, c)
+        return self
 
     def __str__(self):
-        text = self.color
-        if self.value < 10:
-            text += str(self.value)
-        elif self.value == 10:
-            text += " Skip"
-        elif self.value == 11:
-            text += " Reverse"
-        elif self.value == 12:
-            text += " Draw Two"
-        elif self.value == 13:
-            text += " Wild"
-        elif self.value == 14:
-            text += " Wild Draw Four"
-        return text
+        return self.label
+
+
+def build_deck_template():
+    cards = []
+    for i in range(0, 15):
+        for c in COLORS:
+            if i < 10:
+                cards.append(Card(i, c))
+                cards.append(Card(i, c))
+            elif i < 13:
+                cards.append(Card(i, c))
+            elif i < 15:
+                cards.append(Card(i, ''))
+    return tuple(cards)
+
+
+# One full deck; every Deck is built by copying this.
+DECK_TEMPLATE = build_deck_template()
 
 
 class Deck:
-    def __init__(self, num_players):
-        self.deck = []
-        self.played = []
-        for i in range(0, 15):
-            for c in ['R', 'Y', 'G', 'B']:
-                if i < 10:
-                    self.deck.append(Card(i, c))
-                    self.deck.append(Card(i, c))
-                elif i < 13:
-                    self.deck.append(Card(i, c))
-                elif i < 15:
-                    self.deck.append(Card(i, ''))
+    """
+    The draw pile is kept unshuffled and shuffled lazily: each draw swaps
+    a random card to the end and pops it, which is one step of a
+    Fisher-Yates shuffle. Cards put back go on a separate bottom pile that
+    is only drawn from once the main pile is empty, and recycling the
+    played pile swaps it in as the new draw pile while leaving the top
+    card where it is. All of these are O(1).
 
+    """
+
+    def __init__(self, num_players, rng=random):
+        self.rng = rng
         # If we have more than 10 players, add more cards in proportion.
-        for i in range(0, max(0, num_players - THRESHOLD_PLAYERS)):
-            for j in range(0, 15):
-                for c in ['R', 'Y', 'G', 'B']:
-                    if j < 10:
-                        self.deck.append(Card(i, c))
-                        self.deck.append(Card(i, c))
-                    elif j < 13:
-                        self.deck.append(Card(i, c))
-                    else:
-                        self.deck.append(Card(i, ''))
-
-        random.shuffle(self.deck)
+        self.deck = list(DECK_TEMPLATE) * (1 + max(0, num_players - THRESHOLD_PLAYERS))
+        self.bottom = collections.deque()
+        self.played = []
 
     def double_deck(self):
-        if len(self.deck) <= 0 and len(self.played) <= 0:
-            for i in range(0, 15):
-                for c in ['R', 'Y', 'G', 'B']:
-                    if i < 10:
-                        self.deck.append(Card(i, c))
-                        self.deck.append(Card(i, c))
-                    elif i < 13:
-                        self.deck.append(Card(i, c))
-                    elif i < 15:
-                        self.deck.append(Card(i, ''))
-            random.shuffle(self.deck)
+        if len(self.deck) <= 0 and len(self.bottom) <= 0:
+            self.deck.extend(DECK_TEMPLATE)
 
     def reshuffle(self):
-        if len(self.deck) <= 0 < len(self.played):
-            self.deck = random.shuffle(self.played[:-1])
-            self.played = self.played[-1]
+        if len(self.deck) <= 0 and len(self.bottom) <= 0 and len(self.played) > 1:
+            top = self.played.pop()
+            self.deck, self.played = self.played, [top]
 
     def draw_card(self):
-        if len(self.deck) <= 0 and len(self.played) <= 0:
+        if len(self.deck) <= 0 and len(self.bottom) <= 0:
+            self.reshuffle()
             self.double_deck()
         if len(self.deck) <= 0:
-            self.reshuffle()
-        return self.deck.pop()
+            return self.bottom.popleft()
+
+        last = len(self.deck) - 1
+        i = self.rng.randint(0, last)
+        self.deck[i], self.deck[last] = self.deck[last], self.deck[i]
+        card = self.deck.pop()
+        # Wilds coming back from the played pile lose the color they were given.
+        if card.is_wild():
+            card = card.with_color('')
+        return card
 
     def draw_n_cards(self, n):
         cards = []
@@ -188,22 +255,34 @@ class Deck:
         return False
 
     def return_card(self, c):
-        if c.check_valid_color() and c.check_valid_value():
-            self.deck.insert(0, c)
+        if c.is_wild() or (c.check_valid_color() and c.check_valid_value()):
+            self.bottom.append(c)
 
     def set_wild(self, c):
         if c.lower() in ['r', 'y', 'g', 'b'] and self.get_topmost_card().is_wild():
-            self.played[-1].set_color(c.upper())
+            self.played[-1] = self.played[-1].with_color(c.upper())
 
 
 class Game:
-    def __init__(self, chat_id, players):
+    """
+    The rules engine for one chat's game. It doesn't talk to Telegram: what
+    happens is recorded as events (see events.py) for the caller to drain
+    and deliver after the move, and all randomness comes from a
+    random.Random seeded with seed, so a game can be run and replayed
+    offline.
+
+    """
+
+    def __init__(self, chat_id, players, seed=None):
         self.turn = 0
         self.players = {}
         self.players_and_names = players
         self.players_and_ready = {}
         self.ready_to_play = False
-        self.deck = Deck(len(players))
+        self.events = []
+        self.seed = seed if seed is not None else random.getrandbits(64)
+        self.rng = random.Random(self.seed)
+        self.deck = Deck(len(players), self.rng)
 
         self.waiting_for_wild = False
         self.waiting_for_wild_id = ""
@@ -225,20 +304,32 @@ class Game:
         self.waiting_for_seven_id = ""
         self.waiting_for_seven_name = ""
 
+        # Seat number -> user id and Player, so turn lookups don't scan self.players.
+        self.seat_ids = []
+        self.seat_players = []
+
+        # The state text, with the turn and top card it was built for.
+        self.state = None
+        self.state_key = None
+
         self.last_num_cards_drawn = 0
         count = 0
         for user_id, name in players.items():
-            self.send_message(name + " has been added to the game.\n")
+            self.emit(events.PlayerAdded(name))
             self.players[user_id] = Player(count, self.deck.draw_hand())
             self.players_and_ready[user_id] = False
+            self.seat_ids.append(user_id)
+            self.seat_players.append(self.players[user_id])
             count += 1
-        self.send_message("Everything has been set up. Waiting for players to /ready.\n")
+        self.emit(events.GameSetUp())
+
+    def emit(self, event):
+        self.events.append(event)
 
-    def send_message(self, text):
-        try:
-            bot.send_message(chat_id=self.chat_id, text=text)
-        except TelegramError as e:
-            raise e
+    def drain_events(self):
+        drained = self.events
+        self.events = []
+        return drained
 
     def set_hpt_lap(self, lap):
         self.hpt_lap = lap
@@ -251,7 +342,7 @@ class Game:
 
     def set_ready_to_play(self, val):
         if val != False and val != True:
-            self.send_message("Ready to play must be a Boolean value.")
+            self.emit(events.InvalidPlay(events.NOT_BOOLEAN, "Ready to play"))
             return
         self.ready_to_play = val
 
@@ -260,7 +351,7 @@ class Game:
 
     def set_advanced_rules(self, val):
         if val != False and val != True:
-            self.send_message("Advanced rules to play must be a Boolean value.")
+            self.emit(events.InvalidPlay(events.NOT_BOOLEAN, "Advanced rules to play"))
             return
         self.advanced_rules = val
 
@@ -275,7 +366,7 @@ class Game:
                 card = self.deck.draw_card()
             self.deck.play_card(card)
         else:
-            self.send_message("The starting card has already been played.")
+            self.emit(events.InvalidPlay(events.INITIAL_CARD_PLAYED))
 
     def check_for_win(self):
         for p in self.players.keys():
@@ -284,75 +375,58 @@ class Game:
         return None
 
     def get_player_id_by_num(self, n):
-        for p in self.players.keys():
-            player = self.players[p]
-            if player.get_id() == n:
-                return p
+        if 0 <= n < len(self.seat_ids):
+            return self.seat_ids[n]
         return ""
 
     def get_player_name_by_num(self, n):
-        for p in self.players.keys():
-            player = self.players[p]
-            if player.get_id() == n:
-                return self.players_and_names[p]
+        if 0 <= n < len(self.seat_ids):
+            return self.players_and_names[self.seat_ids[n]]
         return ""
 
     def get_player_by_num(self, n):
-        for p in self.players.keys():
-            player = self.players[p]
-            if player.get_id() == n:
-                return player
+        if 0 <= n < len(self.seat_players):
+            return self.seat_players[n]
         return None
 
     def play_zero(self):
+        # Every hand moves one seat against the direction of play.
         dir = -1 if self.reversed else 1
-        last_hand = None
-
-        if dir == 1:
-            iter_range = range(len(self.players))
-        else:
-            iter_range = range(len(self.players) - 1, -1, -1)
-
-        for i in iter_range:
-            player = self.get_player_by_num(i)
-            next_player = self.get_player_by_num((i + dir) % len(self.players))
-            if last_hand is None:
-                last_hand = player.get_hand()
-            player.set_hand(next_player.get_hand())
-            if i == len(self.players) - 1:
-                player.set_hand(last_hand)
+        hands = [(player.get_hand(), player.get_counts()) for player in self.seat_players]
+        for i, player in enumerate(self.seat_players):
+            player.set_hand(*hands[(i + dir) % len(hands)])
 
     def play_seven(self, user_id_1, user_id_2):
         player_1 = self.players.get(user_id_1)
         player_2 = self.players.get(user_id_2)
 
         if self.players.get(user_id_1).get_id() != self.turn:
-            self.send_message("It is not currently your turn!")
+            self.emit(events.InvalidPlay(events.NOT_YOUR_TURN))
             return False
 
         if not self.waiting_for_seven:
-            self.send_message("A seven is not on top of the played pile.")
+            self.emit(events.InvalidPlay(events.NO_SEVEN))
             return False
 
         if user_id_1 != self.waiting_for_seven_id:
-            self.send_message("You cannot swap! Waiting for %s to swap." % self.waiting_for_seven_name)
+            self.emit(events.InvalidPlay(events.SEVEN_WAITING, self.waiting_for_seven_name))
             return False
 
         if player_1 is None:
-            self.send_message("You don't seem to exist!")
+            self.emit(events.InvalidPlay(events.UNKNOWN_PLAYER))
             return False
 
         if player_2 is None:
-            self.send_message("The player you chose doesn't seem to exist!")
+            self.emit(events.InvalidPlay(events.UNKNOWN_TARGET))
             return False
 
         if user_id_1 == user_id_2:
-            self.send_message("You cannot swap hands with yourself!")
+            self.emit(events.InvalidPlay(events.SELF_SWAP))
             return False
 
-        temp_hand = player_1.get_hand()
-        player_1.set_hand(player_2.get_hand())
-        player_2.set_hand(temp_hand)
+        temp_hand, temp_counts = player_1.get_hand(), player_1.get_counts()
+        player_1.set_hand(player_2.get_hand(), player_2.get_counts())
+        player_2.set_hand(temp_hand, temp_counts)
 
         self.waiting_for_seven = False
         self.waiting_for_seven_id = ""
@@ -364,60 +438,58 @@ class Game:
         player = self.players.get(id)
 
         if player is None:
-            self.send_message("You don't seem to exist!")
+            self.emit(events.InvalidPlay(events.UNKNOWN_PLAYER))
             return False
 
         if player.get_id() != self.turn:
-            self.send_message("It is not currently your turn!")
+            self.emit(events.InvalidPlay(events.NOT_YOUR_TURN))
             return False
 
         if self.advanced_rules and self.waiting_for_seven:
-            self.send_message("You cannot play a card; waiting for %s to choose a player for swapping hands." %
-                              self.waiting_for_seven_name)
+            self.emit(events.InvalidPlay(events.PLAY_SEVEN_WAITING, self.waiting_for_seven_name))
             return False
 
         if self.waiting_for_wild:
-            self.send_message("You cannot play a card; waiting for %s to set the wild color." %
-                              self.waiting_for_wild_name)
+            self.emit(events.InvalidPlay(events.PLAY_WILD_WAITING, self.waiting_for_wild_name))
             return False
 
         if self.uno_pending:
-            self.send_message("You cannot play a card; Uno is pending.")
+            self.emit(events.InvalidPlay(events.PLAY_UNO_PENDING))
 
         if self.waiting_for_seven:
-            self.send_message("You cannot play a card; a seven is pending.")
+            self.emit(events.InvalidPlay(events.PLAY_SEVEN_PENDING))
 
         card = player.remove_card(card_id)
 
         if card is None:
-            self.send_message("You cannot remove the card with this ID.")
+            self.emit(events.InvalidPlay(events.NO_SUCH_CARD))
             return False
 
         if not self.deck.check_valid_play(card):
-            self.send_message("This is not a valid card.")
+            self.emit(events.InvalidPlay(events.INVALID_CARD))
             player.insert_card(card, card_id)
             return False
 
         self.deck.play_card(card)
         if self.advanced_rules and card.get_value() == 0:
             self.play_zero()
-            self.send_message("Everyone's hands have rotated!")
+            self.emit(events.HandsRotated())
         if self.advanced_rules and card.get_value() == 7:
             self.waiting_for_seven = True
             self.waiting_for_seven_id = id
             self.waiting_for_seven_name = self.players_and_names[id]
-            self.send_message("Now choose a player with whom you'll swap hands using /seven [player_num]!")
+            self.emit(events.SevenPending())
         if card.is_wild():
             self.waiting_for_wild = True
             self.waiting_for_wild_id = id
             self.waiting_for_wild_name = self.players_and_names[id]
-            self.send_message("Now choose a color using /wild R, Y, G, or B!")
+            self.emit(events.WildPending())
         if card.get_value() == 10:
             self.skip_pending = True
             return True
         if card.get_value() == 11:
             self.reversed = not self.reversed
-            self.send_message("The direction of the game has been reversed!")
+            self.emit(events.DirectionReversed())
         if card.get_value() == 12:
             self.draw_twos_pending += 1
         if card.get_value() == 14:
@@ -428,6 +500,9 @@ class Game:
     def is_uno_pending(self):
         return self.uno_pending
 
+    def get_uno_pending_id(self):
+        return self.uno_pending_id
+
     def is_skip_pending(self):
         return self.skip_pending
 
@@ -436,23 +511,26 @@ class Game:
 
     def set_skip_pending(self, val):
         if val != False and val != True:
-            self.send_message("Skip pending must be a Boolean value.")
+            self.emit(events.InvalidPlay(events.NOT_BOOLEAN, "Skip pending"))
             return
         self.skip_pending = val
 
     def check_uno_caller(self, id):
         if self.players_and_names.get(id) is None:
-            self.send_message("You are not in the game!")
+            self.emit(events.InvalidPlay(events.NOT_IN_GAME))
             return -1
 
+        name = self.players_and_names[self.uno_pending_id]
         if id != self.uno_pending_id:
             self.players[self.uno_pending_id].add_card(self.deck.draw_card())
             self.uno_pending = False
             self.uno_pending_id = ""
+            self.emit(events.UnoCalled(name, False))
             return 0
 
         self.uno_pending = False
         self.uno_pending_id = ""
+        self.emit(events.UnoCalled(name, True))
         return 1
 
     def account_draw_twos(self):
@@ -463,8 +541,7 @@ class Game:
                 next_player.add_card(c)
 
         if self.draw_twos_pending > 0:
-            self.send_message(self.get_player_name_by_num(self.turn) +
-                              " has to draw %d cards!" % (self.draw_twos_pending * 2))
+            self.emit(events.ForcedDraw(self.get_player_name_by_num(self.turn), self.draw_twos_pending * 2))
             self.turn = (self.turn + dir) % len(self.players)
             self.draw_twos_pending = 0
 
@@ -476,18 +553,17 @@ class Game:
                 next_player.add_card(c)
 
         if self.draw_fours_pending > 0:
-            self.send_message(self.get_player_name_by_num(self.turn) +
-                              " has to draw %d cards!" % (self.draw_fours_pending * 4))
+            self.emit(events.ForcedDraw(self.get_player_name_by_num(self.turn), self.draw_fours_pending * 4))
             self.turn = (self.turn + dir) % len(self.players)
             self.draw_fours_pending = 0
 
     def next_turn(self, step):
         # This has to happen before in case the last player didn't stack.
         if self.draw_twos_pending > 0 and self.deck.get_topmost_card().get_value() != 12:
-            self.send_message(self.get_player_name_by_num(self.turn) + " failed to stack their draw two!")
+            self.emit(events.StackMissed(self.get_player_name_by_num(self.turn), 12))
             self.account_draw_twos()
         if self.draw_fours_pending > 0 and self.deck.get_topmost_card().get_value() != 14:
-            self.send_message(self.get_player_name_by_num(self.turn) + " failed to stack their draw four!")
+            self.emit(events.StackMissed(self.get_player_name_by_num(self.turn), 14))
             self.account_draw_fours()
 
         dir = -1 if self.reversed else 1
@@ -495,34 +571,40 @@ class Game:
         next_player = self.get_player_by_num(self.turn)
 
         # This happens after in case the next player cannot stack.
-        if self.draw_twos_pending > 0 and len(list(filter(lambda c: c.get_value() == 12, next_player.get_hand()))) <= 0:
-            self.send_message(self.get_player_name_by_num(self.turn) + " couldn't stack a draw two!")
+        if self.draw_twos_pending > 0 and next_player.count_value(12) <= 0:
+            self.emit(events.CannotStack(self.get_player_name_by_num(self.turn), 12))
             self.account_draw_twos()
-        if self.draw_fours_pending > 0 and len(list(filter(lambda c: c.get_value() == 14, next_player.get_hand()))) <= 0:
-            self.send_message(self.get_player_name_by_num(self.turn) + " couldn't stack a draw four!")
+        if self.draw_fours_pending > 0 and next_player.count_value(14) <= 0:
+            self.emit(events.CannotStack(self.get_player_name_by_num(self.turn), 14))
             self.account_draw_fours()
 
+    def finish_turn(self):
+        self.next_turn(1)
+        if self.skip_pending:
+            self.emit(events.PlayerSkipped())
+            self.next_turn(1)
+            self.skip_pending = False
+
     def draw_and_continue(self, id):
         player = self.players.get(id, None)
 
         if player is None:
-            self.send_message("You don't seem to exist!")
+            self.emit(events.InvalidPlay(events.UNKNOWN_PLAYER))
             return False
 
         if player.get_id() != self.turn:
-            self.send_message("It is not currently your turn!")
+            self.emit(events.InvalidPlay(events.NOT_YOUR_TURN))
             return False
 
         if self.waiting_for_wild:
-            self.send_message("You cannot draw a card; waiting for %s to set the wild color." %
-                              self.waiting_for_wild_name)
+            self.emit(events.InvalidPlay(events.DRAW_WILD_WAITING, self.waiting_for_wild_name))
             return
 
         if self.uno_pending:
-            self.send_message("You cannot draw a card; Uno is pending.")
+            self.emit(events.InvalidPlay(events.DRAW_UNO_PENDING))
 
         if self.waiting_for_seven:
-            self.send_message("You cannot draw a card; a seven is pending.")
+            self.emit(events.InvalidPlay(events.DRAW_SEVEN_PENDING))
 
         self.last_num_cards_drawn = 0
 
@@ -541,19 +623,19 @@ class Game:
 
     def set_wild_color(self, id, c):
         if self.players.get(id, None).get_id() != self.turn:
-            self.send_message("It is not currently your turn!")
+            self.emit(events.InvalidPlay(events.NOT_YOUR_TURN))
             return False
 
         if not self.waiting_for_wild:
-            self.send_message("An uncolored Wild card is not on top of the played pile.")
+            self.emit(events.InvalidPlay(events.NO_WILD))
             return False
 
         if id != self.waiting_for_wild_id:
-            self.send_message("You cannot set the wild color. Waiting for %s to set it." % self.waiting_for_wild_name)
+            self.emit(events.InvalidPlay(events.WILD_WAITING, self.waiting_for_wild_name))
             return False
 
         if not c.lower() in ['r', 'y', 'g', 'b']:
-            self.send_message("That is not a valid color. Choose R, G, B, or Y.")
+            self.emit(events.InvalidPlay(events.INVALID_COLOR))
             return False
 
         self.deck.set_wild(c)
@@ -564,7 +646,7 @@ class Game:
 
     def set_uno_pending(self, val, id):
         if val != True and val != False:
-            self.send_message("Uno pending must be a Boolean value.")
+            self.emit(events.InvalidPlay(events.NOT_BOOLEAN, "Uno pending"))
             return
 
         self.uno_pending = val
@@ -589,10 +671,11 @@ class Game:
         return self.deck.get_topmost_card()
 
     def get_state(self):
-        text = "Current Turn: " + self.get_player_name_by_num(self.turn) + "\n"
+        # Cards are interned, so the top card itself tells whether the state text is still good.
         top_card = self.get_topmost_card()
-        if top_card is None:
-            text += "Topmost Card: None"
-        else:
-            text += "Topmost Card: " + str(top_card)
-        return text
\ No newline at end of file
+        key = (self.turn, top_card)
+        if self.state_key != key:
+            self.state = "Current Turn: %s\nTopmost Card: %s" % (self.get_player_name_by_num(self.turn),
+                                                                 "None" if top_card is None else top_card)
+            self.state_key = key
+        return self.state
\ No newline at end of file